@@ -0,0 +1,561 @@
+"""
+Caches that save Goatcabin from asking GitHub the same questions over and over.
+"""
+
+import os
+import time
+import hashlib
+import threading
+import tempfile
+from collections import OrderedDict
+try: import simplejson as json
+except ImportError: import json
+
+import github3
+
+from utils import git_blob_sha
+
+# how long (in seconds) we trust that a branch has not moved since we last checked it.
+# after that, one cheap request for the branch ref tells us whether the cached tree is still good.
+TREE_CACHE_MAX_AGE = 10
+
+DEFAULT_BLOB_CACHE_MB = 512
+
+# once a cache on disk goes over its size limit, it is cut down to this fraction of the limit, so that it doesn't have to
+# evict something again on the very next put
+EVICT_TO_FRACTION = 0.9
+
+# entries in the org snapshot older than this are not trusted any more and get fetched again
+DEFAULT_SNAPSHOT_TTL_HOURS = 24
+
+# people's names hardly ever change, so the name directory is trusted for longer
+DEFAULT_NAMES_TTL_HOURS = 24*7
+
+# bump this when the way grades are worked out changes, so that grades from older tabulations are not reused
+TABULATION_MANIFEST_VERSION = 2
+
+
+""" Per-run cache of repository trees.
+    Trees are stored by (repo, commit sha), which never goes stale, and branches are mapped to the commit
+    they point at by (repo, branch). Commits that this process makes are recorded as they happen, so the
+    cache stays up to date without refetching. If someone else pushes, the next ref check notices. """
+class TreeCache(object):
+
+    def __init__(self, max_age=TREE_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self._trees = dict() # (repo, commit sha) -> {"tree" : root tree sha, "blobs" : {path : {"sha", "mode"}}, "truncated" : bool}
+        self._heads = dict() # (repo, branch) -> (commit sha, time we last checked it)
+        self._lock = threading.Lock()
+
+    # the sha of the commit at the tip of branch, or None if there is no such branch (or the repo is empty)
+    def head(self, repo, branch="master"):
+        key = (repo.full_name, branch)
+        with self._lock:
+            head = self._heads.get(key)
+        if head and time.time() - head[1] < self.max_age:
+            return head[0]
+
+        try:
+            ref = repo.ref("heads/%s" % branch) or None # github3 gives a (falsy) NullObject for a 404
+        except github3.exceptions.ClientError: # e.g. 409 because the repo is empty
+            ref = None
+        with self._lock:
+            if ref is None:
+                self._heads.pop(key, None)
+                return None
+            self._heads[key] = (ref.object.sha, time.time())
+        return ref.object.sha
+
+    # the tree of a particular commit
+    def tree_at(self, repo, commit_sha):
+        key = (repo.full_name, commit_sha)
+        with self._lock:
+            entry = self._trees.get(key)
+        if entry is not None:
+            return entry
+
+        tree = repo.tree("%s?recursive=1" % commit_sha).as_dict()
+        entry = {
+            "tree" : tree["sha"],
+            "blobs" : {elem["path"] : {"sha" : elem["sha"], "mode" : elem["mode"]} for elem in tree["tree"] if elem["type"] == "blob"},
+            "truncated" : tree["truncated"]
+        }
+        with self._lock:
+            self._trees[key] = entry
+        return entry
+
+    # the tree at the tip of branch, or None if there is no such branch (or the repo is empty)
+    def get(self, repo, branch="master"):
+        commit_sha = self.head(repo, branch)
+        if commit_sha is None:
+            return None
+        return self.tree_at(repo, commit_sha)
+
+    """ Record a commit that we just made on top of parent_sha, so that we don't have to refetch the tree.
+        blobs is a dict from path to blob sha for the files that the commit wrote. """
+    def record_commit(self, repo, branch, parent_sha, commit_sha, tree_sha, blobs):
+        with self._lock:
+            parent = self._trees.get((repo.full_name, parent_sha))
+            if parent is None: # don't know what else is in the tree. it will be fetched if anyone asks
+                self._heads.pop((repo.full_name, branch), None)
+                return
+            new_blobs = dict(parent["blobs"])
+            for path, blob_sha in blobs.items():
+                new_blobs[path] = {"sha" : blob_sha, "mode" : parent["blobs"].get(path, {}).get("mode", "100644")}
+            self._trees[(repo.full_name, commit_sha)] = {"tree" : tree_sha, "blobs" : new_blobs, "truncated" : parent["truncated"]}
+            self._heads[(repo.full_name, branch)] = (commit_sha, time.time())
+
+    # forget where branch points, e.g. after a write whose resulting commit we don't know
+    def invalidate(self, repo, branch="master"):
+        with self._lock:
+            self._heads.pop((repo.full_name, branch), None)
+
+
+""" Per-run index of the open issues in repos, so that checking whether an issue is already open (or finding the ones
+    to close) lists a repo's issues once per run instead of every time. Issues that this process opens or closes are
+    recorded as that happens. """
+class OpenIssueIndex(object):
+
+    def __init__(self):
+        self._issues = dict() # repo full name -> [open issue, ...]
+        self._lock = threading.Lock()
+
+    def _open_issues(self, repo):
+        with self._lock:
+            issues = self._issues.get(repo.full_name)
+        if issues is None:
+            listed = list(repo.issues(state="open"))
+            with self._lock:
+                issues = self._issues.setdefault(repo.full_name, listed)
+        return issues
+
+    # an open issue in repo with this title, or None
+    def find(self, repo, title):
+        for issue in self._open_issues(repo):
+            if issue.title == title:
+                return issue
+        return None
+
+    # the open issues in repo with this label
+    def with_label(self, repo, label):
+        return [issue for issue in self._open_issues(repo) if label in [l["name"] for l in issue.as_dict().get("labels") or []]]
+
+    def opened(self, repo, issue):
+        with self._lock:
+            if repo.full_name in self._issues:
+                self._issues[repo.full_name].append(issue)
+
+    def closed(self, issue):
+        with self._lock:
+            issues = self._issues.get("/".join(issue.repository))
+            if issues is not None:
+                self._issues["/".join(issue.repository)] = [i for i in issues if i.number != issue.number]
+
+
+""" The files of a cache on disk (directory/<first two characters of the key>/<the rest of the key><suffix>), kept under
+    max_bytes by removing the least recently used ones. The directory is scanned only once, the first time it's needed,
+    and ordered by the files' modification times (which used() bumps, so the order carries over to the next run).
+    After that the order is kept in memory, so a put costs no more than writing the file. Not thread-safe on its own:
+    the caches that use it call it with their lock held. """
+class LRUFiles(object):
+
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._sizes = None # key -> size, least recently used first. read from disk the first time it's needed
+        self.total_bytes = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + self.suffix)
+
+    def _load(self):
+        if self._sizes is not None:
+            return
+        found = []
+        if os.path.isdir(self.directory):
+            for prefix in os.scandir(self.directory):
+                if prefix.is_dir() and len(prefix.name) == 2:
+                    for entry in os.scandir(prefix.path):
+                        if entry.name.endswith(self.suffix) and not entry.name.startswith("."): # skip half-written temporary files
+                            stat = entry.stat()
+                            found.append((stat.st_mtime, prefix.name + entry.name[:len(entry.name) - len(self.suffix)], stat.st_size))
+        self._sizes = OrderedDict((key, size) for _, key, size in sorted(found))
+        self.total_bytes = sum(self._sizes.values())
+
+    def __contains__(self, key):
+        self._load()
+        return key in self._sizes
+
+    # the file for key was just read, so it is now the most recently used
+    def used(self, key):
+        self._load()
+        try:
+            os.utime(self.path(key))
+        except OSError: # evicted by someone else in the meantime
+            pass
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+
+    # the file for key was just written (size bytes). if that takes us over max_bytes, the least recently used files go
+    def added(self, key, size):
+        self._load()
+        self.total_bytes += size - self._sizes.pop(key, 0)
+        self._sizes[key] = size
+        if self.total_bytes > self.max_bytes:
+            while self._sizes and self.total_bytes > self.max_bytes*EVICT_TO_FRACTION:
+                old_key, old_size = self._sizes.popitem(last=False)
+                try:
+                    os.remove(self.path(old_key))
+                except OSError:
+                    pass
+                self.total_bytes -= old_size
+
+
+""" On-disk store of file contents, addressed by their git blob sha.
+    The same sha always means the same contents, so an entry never needs revalidating: once we have seen a
+    blob (in any repo, in any run) we never need to download it again. The store is kept under max_bytes by
+    evicting the least recently used blobs. """
+class BlobStore(object):
+
+    def __init__(self, directory, max_bytes=DEFAULT_BLOB_CACHE_MB*2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = LRUFiles(directory, max_bytes)
+        self._lock = threading.Lock()
+
+    def _path(self, sha):
+        return self._files.path(sha)
+
+    def __contains__(self, sha):
+        return os.path.isfile(self._path(sha))
+
+    # returns the contents (bytes) or None if we don't have them
+    def get(self, sha):
+        try:
+            with open(self._path(sha), "rb") as f:
+                contents = f.read()
+        except OSError: # not there, or evicted by someone else in the meantime
+            return None
+        with self._lock:
+            self._files.used(sha) # mark as recently used
+        return contents
+
+    def put(self, sha, contents):
+        if git_blob_sha(contents) != sha:
+            print("Warning: contents of blob %s do not match its sha. Not caching it." % sha)
+            return
+        path = self._path(sha)
+        with self._lock:
+            if sha in self._files:
+                return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file and then move it into place so that nobody ever reads half a blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._files.added(sha, len(contents))
+
+
+""" Snapshot on disk of what we learned about an org's teams, repos and members in previous runs.
+    Each entry remembers when it was last seen on GitHub, and entries older than the TTL are dropped
+    when the snapshot is loaded, so they get fetched again. """
+class OrgSnapshot(object):
+
+    def __init__(self, path, ttl_hours=DEFAULT_SNAPSHOT_TTL_HOURS):
+        self.path = path
+        self.listings = dict() # kind (e.g. "repos") -> {name : {"seen" : time, "json" : the object's json}}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        oldest_allowed = time.time() - ttl_hours*3600
+        try:
+            with open(path, "r") as f:
+                listings = json.load(f)
+        except (OSError, ValueError):
+            listings = dict()
+        for kind, entries in listings.items():
+            self.listings[kind] = {name : entry for name, entry in entries.items() if entry["seen"] >= oldest_allowed}
+
+    def get(self, kind, name):
+        with self._lock:
+            entry = self.listings.get(kind, {}).get(name)
+        return entry["json"] if entry else None
+
+    def put(self, kind, name, obj_json):
+        with self._lock:
+            self.listings.setdefault(kind, dict())[name] = {"seen" : time.time(), "json" : obj_json}
+            self._dirty = True
+
+    # replace everything we know about kind with a complete listing
+    def replace(self, kind, objs_json):
+        now = time.time()
+        with self._lock:
+            self.listings[kind] = {name : {"seen" : now, "json" : obj_json} for name, obj_json in objs_json.items()}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.listings, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+""" On-disk directory of people's display names, by login, so that showing a cohort's names doesn't cost
+    a request per person. It is meant to be filled in bulk, e.g. from one listing of all the org's members, and
+    entries older than ttl_hours are not trusted any more. It also remembers which login a token belongs to (by a
+    hash of the token, never the token itself), so that finding out who we are doesn't cost a request either. """
+class NameDirectory(object):
+
+    def __init__(self, path, ttl_hours=DEFAULT_NAMES_TTL_HOURS):
+        self.path = path
+        self.people = dict() # login -> {"name", "seen" : time}
+        self.tokens = dict() # sha256 of a token -> {"login", "seen" : time}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        oldest_allowed = time.time() - ttl_hours*3600
+        try:
+            with open(path, "r") as f:
+                directory = json.load(f)
+        except (OSError, ValueError):
+            directory = dict()
+        for key in ("people", "tokens"):
+            setattr(self, key, {k : entry for k, entry in directory.get(key, dict()).items() if entry["seen"] >= oldest_allowed})
+
+    def __contains__(self, login):
+        with self._lock:
+            return login in self.people
+
+    # the display name of login, or None if they haven't set one (or we don't know them; see __contains__)
+    def name(self, login):
+        with self._lock:
+            return self.people.get(login, dict()).get("name")
+
+    def put(self, login, name):
+        with self._lock:
+            self.people[login] = {"name" : name or None, "seen" : time.time()}
+            self._dirty = True
+
+    def _token_key(self, token):
+        return hashlib.sha256(token.encode("UTF-8")).hexdigest()
+
+    # the login that token belongs to, if we have seen it before
+    def login_for_token(self, token):
+        with self._lock:
+            entry = self.tokens.get(self._token_key(token))
+        return entry["login"] if entry else None
+
+    def put_token(self, token, login):
+        with self._lock:
+            self.tokens[self._token_key(token)] = {"login" : login, "seen" : time.time()}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"people" : self.people, "tokens" : self.tokens}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+""" Record on disk of the grades worked out by previous tabulations, so that only the forms that changed get graded again.
+    Entries are kept by assessment and group, and are only used if the blob sha of the form and the weights key
+    (which stands for weights.json and anything else that changes the grades) are still the ones they were made with. """
+class TabulationManifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict() # aname -> {group : {"form" : blob sha, "weights" : weights key, "result" : the grades}}
+        self._dirty = False
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = dict()
+        if manifest.get("version") == TABULATION_MANIFEST_VERSION:
+            self.entries = manifest["assessments"]
+
+    # the grades from last time, or None if the form or the weights have changed since (or we never saw them)
+    def get(self, aname, group, form_sha, weights_key):
+        entry = self.entries.get(aname, {}).get(group)
+        if form_sha is None or entry is None or entry["form"] != form_sha or entry["weights"] != weights_key:
+            return None
+        return entry["result"]
+
+    def put(self, aname, group, form_sha, weights_key, result):
+        if form_sha is None: # can't tell next time whether it changed
+            return
+        self.entries.setdefault(aname, dict())[group] = {"form" : form_sha, "weights" : weights_key, "result" : result}
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version" : TABULATION_MANIFEST_VERSION, "assessments" : self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+""" On-disk store of parsed rubrics: the grades form and weights that rubrics.parse_rubric_snippets made from an
+    assessment's main file. An entry is named after everything the result depends on (the blob sha of the main file,
+    the hash of rubric_config.json, the doctype and whether there is peer review), so it never goes stale. """
+class RubricCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    # (grades form, weights), or None if this rubric has not been parsed before
+    def get(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            return None
+        return entry["form"], entry["weights"]
+
+    def put(self, key, grades_form, weights):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(OrderedDict([("form", grades_form), ("weights", weights)]), f)
+        os.replace(tmp_path, self._path(key))
+
+
+""" A dict-like view of the org's teams, repos or members that is only filled in when somebody looks something up.
+    Lookups are answered, in order, from: what we already have in memory, the snapshot from previous runs,
+    a request for just that one item (if fetch_one is given), and finally a listing of everything.
+    Something found in the snapshot might have been deleted or renamed since. That is fine for most lookups,
+    but exists() checks it with GitHub first (with revalidate), for deciding whether to create something. """
+class LazyOrgIndex(object):
+
+    def __init__(self, kind, list_all, from_json, snapshot=None, fetch_one=None, revalidate=None):
+        self.kind = kind
+        self._list_all = list_all # () -> iterable of (name, object)
+        self._from_json = from_json # json -> object
+        self._fetch_one = fetch_one # name -> object, or None if it does not exist
+        self._revalidate = revalidate # (name, object from the snapshot) -> the object as it is now, or None if it is gone
+        self._snapshot = snapshot
+        self._items = dict()
+        self._confirmed = set() # names of the items that came from GitHub in this run, not from the snapshot
+        self._missing = set() # names we know do not exist
+        self._listed = False
+        self._lock = threading.Lock()
+
+    def _list(self):
+        if self._listed:
+            return
+        items = dict(self._list_all())
+        with self._lock:
+            self._items.update(items)
+            self._confirmed.update(items)
+            self._missing.difference_update(items)
+            self._listed = True
+        if self._snapshot is not None:
+            self._snapshot.replace(self.kind, {name : obj.as_dict() for name, obj in self._items.items()})
+
+    # remember what GitHub said about name in this run: obj, or None if it does not exist
+    def _found(self, name, obj):
+        with self._lock:
+            if obj is None:
+                self._items.pop(name, None)
+                self._missing.add(name)
+            else:
+                self._items[name] = obj
+                self._confirmed.add(name)
+        if obj is not None and self._snapshot is not None:
+            self._snapshot.put(self.kind, name, obj.as_dict())
+
+    def _lookup(self, name, confirm=False):
+        with self._lock:
+            if name in self._items and (not confirm or self._revalidate is None or name in self._confirmed):
+                return self._items[name]
+            if name in self._missing or (self._listed and name not in self._items):
+                return None
+            obj = self._items.get(name) # from the snapshot, but not checked yet
+
+        if obj is None:
+            obj_json = self._snapshot.get(self.kind, name) if self._snapshot is not None else None
+            if obj_json is not None:
+                obj = self._from_json(obj_json)
+                if not (confirm and self._revalidate is not None):
+                    with self._lock:
+                        self._items[name] = obj
+                    return obj
+            elif self._fetch_one is None:
+                self._list()
+                return self._items.get(name)
+            else:
+                obj = self._fetch_one(name)
+                self._found(name, obj)
+                return obj
+
+        # check the snapshot's obj with GitHub
+        current = self._revalidate(name, obj)
+        if current is None and self._fetch_one is None and not self._listed: # gone, or maybe renamed. only a listing can tell
+            with self._lock:
+                self._items.pop(name, None)
+            self._list()
+            return self._items.get(name)
+        self._found(name, current)
+        return current
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
+    # like name in self, but never just on the word of the snapshot
+    def exists(self, name):
+        return self._lookup(name, confirm=True) is not None
+
+    def __getitem__(self, name):
+        obj = self._lookup(name)
+        if obj is None:
+            raise KeyError(name)
+        return obj
+
+    def get(self, name, default=None):
+        obj = self._lookup(name)
+        return default if obj is None else obj
+
+    def __setitem__(self, name, obj):
+        with self._lock:
+            self._items[name] = obj
+            self._missing.discard(name)
+        if self._snapshot is not None:
+            self._snapshot.put(self.kind, name, obj.as_dict())
+
+    def __iter__(self):
+        self._list()
+        return iter(list(self._items))
+
+    def __len__(self):
+        self._list()
+        return len(self._items)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        self._list()
+        return list(self._items.values())
+
+    def items(self):
+        self._list()
+        return list(self._items.items())
@@ -0,0 +1,1605 @@
+"""
+A fake GitHub Enterprise server, so that Rhomboid can be run (and tested, and benchmarked) without
+touching a real organization.
+
+FakeGitHub keeps users, organizations, teams and repositories (git objects and refs, issues, pull
+requests, collaborators and events) in memory, optionally backed by a JSON file on disk, and serves
+the part of the GitHub REST API v3 that Goatcabin uses under /api/v3, and the part of the GraphQL
+API that it uses at /api/graphql. A config file whose "url" points at it works just like one that
+points at GitHub Enterprise. It also behaves like GitHub in the ways that matter when working on
+performance:
+  * responses carry ETags, and conditional requests get a 304 that does not count against the rate limit,
+  * listings are paginated (per_page / page) with Link headers,
+  * every response can be delayed by a fixed latency,
+  * there is a primary rate limit, with the usual X-RateLimit-* headers and a 403 once it is used up,
+  * every request is counted by endpoint, e.g. "GET /repos/:owner/:repo/git/trees/:sha".
+
+Permissions are not checked. Any token is accepted and acts as the user it was registered for with
+add_token, or as the default user otherwise.
+
+Run it on its own with
+    python fake_ghe.py --port 8000 --state fake_ghe.json --latency 0.05 --rate-limit 5000
+or start it from Python with start_server(), which runs it on a background thread.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import tarfile
+import zipfile
+import signal
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+from collections import OrderedDict, Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try: import simplejson as json
+except ImportError: import json
+
+API_PREFIX = "/api/v3"
+GRAPHQL_PATH = "/api/graphql"
+DEFAULT_PER_PAGE = 30
+MAX_PER_PAGE = 100
+# like GitHub, only this many of the results of a search can be paged through (total_count still counts all of them)
+MAX_SEARCH_RESULTS = 1000
+DEFAULT_RATE_LIMIT_WINDOW = 3600 # seconds
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SHA_MEDIA_TYPE = "application/vnd.github.v3.sha"
+
+
+# a response body that is a file download rather than text or JSON
+class _Download(bytes):
+    content_type = "application/octet-stream"
+
+
+class FakeGitHubError(Exception):
+
+    def __init__(self, status, message):
+        super(FakeGitHubError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _timestamp(t):
+    return time.strftime(TIME_FORMAT, time.gmtime(t))
+
+def _parse_timestamp(s):
+    if not s:
+        return None
+    try:
+        t = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        raise FakeGitHubError(422, "Invalid timestamp %s" % s)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+def _git_sha(kind, data):
+    return hashlib.sha1(b"%s %d\0" % (kind.encode(), len(data)) + data).hexdigest()
+
+
+# -------------------------------------------------------------------------------------------
+# just enough GraphQL: a query (the operation name and variable definitions are skipped) is a
+# selection set. a selection is ("field", alias, name, {argument : value}, selections or None) or
+# ("fragment", type name, selections) for an inline fragment. values are Python values, with
+# $variables as _GraphQLVariable
+
+_GRAPHQL_TOKEN = re.compile(r'(?P<skip>[\s,]+|#[^\n]*)|(?P<punct>\.\.\.|[{}():!$=\[\]@])|(?P<name>[_A-Za-z][_0-9A-Za-z]*)'
+                            r'|(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)|(?P<string>"(?:[^"\\\n]|\\.)*")')
+
+class _GraphQLVariable(object):
+
+    def __init__(self, name):
+        self.name = name
+
+class _GraphQLParser(object):
+
+    def __init__(self, text):
+        self.tokens = []
+        position = 0
+        while position < len(text):
+            match = _GRAPHQL_TOKEN.match(text, position)
+            if match is None:
+                raise ValueError("Parse error on \"%s\" at position %d" % (text[position], position))
+            if match.lastgroup != "skip":
+                self.tokens.append((match.lastgroup, match.group()))
+            position = match.end()
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index] if self.index < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind is None or (kind and token_kind != kind) or (value and token_value != value):
+            raise ValueError("Parse error on %s" % ('"%s"' % token_value if token_value else "end of query"))
+        self.index += 1
+        return token_value
+
+    def document(self):
+        if self.peek() == ("name", "mutation"):
+            raise ValueError("Mutations are not supported")
+        if self.peek() == ("name", "query"):
+            self.take()
+            if self.peek()[0] == "name":
+                self.take()
+            if self.peek() == ("punct", "("): # variable definitions; the types are not checked
+                depth = 0
+                while True:
+                    token = self.take()
+                    depth += {"(" : 1, ")" : -1}.get(token, 0)
+                    if depth == 0:
+                        break
+        selections = self.selection_set()
+        if self.peek()[0] is not None:
+            raise ValueError("Only one operation per query is supported")
+        return selections
+
+    def selection_set(self):
+        self.take("punct", "{")
+        selections = []
+        while self.peek() != ("punct", "}"):
+            selections.append(self.selection())
+        self.take("punct", "}")
+        return selections
+
+    def selection(self):
+        if self.peek() == ("punct", "..."):
+            self.take()
+            self.take("name", "on")
+            return ("fragment", self.take("name"), self.selection_set())
+        alias = name = self.take("name")
+        if self.peek() == ("punct", ":"):
+            self.take()
+            name = self.take("name")
+        arguments = OrderedDict()
+        if self.peek() == ("punct", "("):
+            self.take()
+            while self.peek() != ("punct", ")"):
+                argument = self.take("name")
+                self.take("punct", ":")
+                arguments[argument] = self.value()
+            self.take()
+        selections = self.selection_set() if self.peek() == ("punct", "{") else None
+        return ("field", alias, name, arguments, selections)
+
+    def value(self):
+        kind, token = self.peek()
+        if token == "$":
+            self.take()
+            return _GraphQLVariable(self.take("name"))
+        if kind == "string":
+            return json.loads(self.take())
+        if kind == "number":
+            token = self.take()
+            return float(token) if any(c in token for c in ".eE") else int(token)
+        if token == "[":
+            self.take()
+            values = []
+            while self.peek() != ("punct", "]"):
+                values.append(self.value())
+            self.take()
+            return values
+        if token == "{":
+            self.take()
+            values = OrderedDict()
+            while self.peek() != ("punct", "}"):
+                key = self.take("name")
+                self.take("punct", ":")
+                values[key] = self.value()
+            self.take()
+            return values
+        token = self.take("name")
+        return {"true" : True, "false" : False, "null" : None}.get(token, token) # anything else is an enum value
+
+def _graphql_value(value, variables):
+    if isinstance(value, _GraphQLVariable):
+        return variables.get(value.name)
+    if isinstance(value, list):
+        return [_graphql_value(v, variables) for v in value]
+    if isinstance(value, dict):
+        return OrderedDict((k, _graphql_value(v, variables)) for k, v in value.items())
+    return value
+
+
+class FakeGitHub(object):
+
+    def __init__(self, latency=0.0, rate_limit=None, rate_limit_window=DEFAULT_RATE_LIMIT_WINDOW, state_path=None):
+        self.latency = latency # seconds added to every response
+        self.rate_limit = rate_limit # requests per window, or None for no limit
+        self.rate_limit_window = rate_limit_window
+        self.state_path = state_path # if given, the state is loaded from and saved to this file
+        self.clock = time.time # replace to make time stand still, or jump ahead
+
+        self.request_counts = Counter() # endpoint -> number of requests
+        self.not_modified_counts = Counter() # endpoint -> number of those that were answered with 304
+        self.request_seconds = Counter() # endpoint -> total time spent answering, including the latency
+        self._rate_limit_used = 0
+        self._rate_limit_reset = None
+        self._lock = threading.RLock()
+
+        self.state = {
+            "next_id" : 1,
+            "default_user" : None,
+            "tokens" : dict(), # token -> login
+            "users" : OrderedDict(), # login -> user
+            "orgs" : OrderedDict(), # login -> org
+            "teams" : OrderedDict(), # str(id) -> team
+            "repos" : OrderedDict() # "owner/name" -> repo
+        }
+        if state_path and os.path.isfile(state_path):
+            with open(state_path, "r") as f:
+                self.state = json.load(f, object_pairs_hook=OrderedDict)
+
+        self._routes = []
+        self._add_routes()
+        self._add_graphql_types()
+
+    # -------------------------------------------------------------------------------------------
+    # setting things up
+
+    def _next_id(self):
+        self.state["next_id"] += 1
+        return self.state["next_id"] - 1
+
+    def add_user(self, login, name=None, email=None):
+        with self._lock:
+            if login not in self.state["users"]:
+                self.state["users"][login] = {"login" : login, "id" : self._next_id(), "name" : name, "email" : email}
+                if self.state["default_user"] is None:
+                    self.state["default_user"] = login
+            return self.state["users"][login]
+
+    def add_token(self, token, login):
+        with self._lock:
+            self.add_user(login)
+            self.state["tokens"][token] = login
+
+    def add_org(self, login, members=()):
+        with self._lock:
+            if login not in self.state["orgs"]:
+                self.state["orgs"][login] = {"login" : login, "id" : self._next_id(), "name" : login, "members" : []}
+            for member in members:
+                self.add_org_member(login, member)
+            return self.state["orgs"][login]
+
+    def add_org_member(self, org, login):
+        with self._lock:
+            self.add_user(login)
+            if login not in self.state["orgs"][org]["members"]:
+                self.state["orgs"][org]["members"].append(login)
+
+    def add_team(self, org, name, members=(), privacy="closed", permission="pull"):
+        with self._lock:
+            team = self._find_team(org, name)
+            if team is None:
+                team_id = self._next_id()
+                team = {"id" : team_id, "org" : org, "name" : name, "slug" : re.sub("[^a-z0-9_]+", "-", name.lower()),
+                        "description" : None, "privacy" : privacy, "permission" : permission, "members" : [], "repos" : OrderedDict()}
+                self.state["teams"][str(team_id)] = team
+            for member in members:
+                self.add_org_member(org, member)
+                if member not in team["members"]:
+                    team["members"].append(member)
+            return team
+
+    def add_repo(self, owner, name, private=True, files=None, message="Initial commit.", author=None):
+        with self._lock:
+            full_name = "%s/%s" % (owner, name)
+            if full_name not in self.state["repos"]:
+                now = _timestamp(self.clock())
+                self.state["repos"][full_name] = {
+                    "id" : self._next_id(), "owner" : owner, "name" : name, "private" : private, "description" : "",
+                    "created_at" : now, "updated_at" : now, "pushed_at" : None, "default_branch" : "master",
+                    "collaborators" : OrderedDict(), "protected" : [],
+                    "blobs" : dict(), "trees" : dict(), "commits" : dict(), "refs" : OrderedDict(),
+                    "issues" : OrderedDict(), "next_number" : 1, "events" : []
+                }
+                self._add_event(self.state["repos"][full_name], "CreateEvent", {"ref" : None, "ref_type" : "repository"}, author)
+            repo = self.state["repos"][full_name]
+            if files:
+                self.commit_files(owner, name, files, message=message, author=author)
+            return repo
+
+    """ Commit files (a dict from path to str or bytes contents; None deletes the path) on top of branch,
+        as if they had been pushed. date (unix time) lets the commit be backdated. Returns the commit sha. """
+    def commit_files(self, owner, name, files, message="Update files.", branch="master", author=None, date=None):
+        with self._lock:
+            repo = self._repo(owner, name)
+            parent = repo["refs"].get("refs/heads/" + branch)
+            flat = self._flatten_tree(repo, repo["commits"][parent]["tree"]) if parent else dict()
+            for path, contents in files.items():
+                if contents is None:
+                    flat.pop(path, None)
+                else:
+                    flat[path] = ("100644", self._store_blob(repo, contents if isinstance(contents, bytes) else contents.encode("UTF-8")))
+            tree_sha = self._build_tree(repo, flat)
+            commit_sha = self._store_commit(repo, message, tree_sha, [parent] if parent else [], author, date)
+            self._move_ref(repo, "refs/heads/" + branch, commit_sha, author)
+            return commit_sha
+
+    """ Set up an org for a course described by a Rhomboid config file: the staff team and repo (holding
+        course_config.json and any other files given), the students team(s) and repo, and the people in them. """
+    def seed_course(self, config, instructor, students, course_config, files=None, tas=()):
+        with self._lock:
+            self.add_user(instructor)
+            org = config["org"]
+            self.add_org(org, members=[instructor] + list(tas) + list(students))
+            self.add_team(org, config["staff-team"], members=[instructor] + list(tas))
+            students_teams = config["students-team"] if isinstance(config["students-team"], list) else [config["students-team"]]
+            for i, students_team in enumerate(students_teams):
+                self.add_team(org, students_team, members=students[i::len(students_teams)])
+            staff_files = OrderedDict([("README.md", "# %s\n" % config["name"]),
+                                       ("course_config.json", json.dumps(course_config, indent=4))])
+            staff_files.update(files or dict())
+            self.add_repo(org, config["staff-repo"], files=staff_files, author=instructor)
+            self.add_repo(org, config["students-repo"], files={"README.md" : "# %s\n" % config["name"]}, author=instructor)
+
+    def add_issue(self, owner, name, title, body, user=None, labels=()):
+        with self._lock:
+            repo = self._repo(owner, name)
+            issue = self._new_issue(repo, title, body, user or self.state["default_user"])
+            issue["labels"] = list(labels)
+            self._add_event(repo, "IssuesEvent", {"action" : "opened", "number" : issue["number"]}, issue["user"])
+            return issue
+
+    # the contents (bytes) of every file in a branch, as {path : contents}. for checking what a run did
+    def read_files(self, owner, name, branch="master"):
+        with self._lock:
+            repo = self._repo(owner, name)
+            if "refs/heads/" + branch not in repo["refs"]:
+                return dict()
+            flat = self._flatten_tree(repo, repo["commits"][repo["refs"]["refs/heads/" + branch]]["tree"])
+            return {path : self._blob(repo, sha) for path, (mode, sha) in flat.items()}
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts.clear()
+            self.not_modified_counts.clear()
+            self.request_seconds.clear()
+
+    def save(self, path=None):
+        path = path or self.state_path
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, path)
+
+    # -------------------------------------------------------------------------------------------
+    # git objects
+
+    def _repo(self, owner, name):
+        repo = self.state["repos"].get("%s/%s" % (owner, name))
+        if repo is None:
+            raise FakeGitHubError(404, "Not Found")
+        return repo
+
+    def _store_blob(self, repo, data):
+        sha = _git_sha("blob", data)
+        repo["blobs"][sha] = base64.b64encode(data).decode("ascii")
+        return sha
+
+    def _blob(self, repo, sha):
+        if sha not in repo["blobs"]:
+            raise FakeGitHubError(404, "Not Found")
+        return base64.b64decode(repo["blobs"][sha])
+
+    # trees are stored like git stores them: one object per directory, {name : [mode, type, sha]}
+    def _store_tree(self, repo, entries):
+        def sort_key(name):
+            return name + "/" if entries[name][1] == "tree" else name
+        data = b""
+        for name in sorted(entries, key=sort_key):
+            mode, kind, sha = entries[name]
+            data += b"%s %s\0" % (mode.lstrip("0").encode(), name.encode()) + bytes.fromhex(sha)
+        sha = _git_sha("tree", data)
+        repo["trees"][sha] = OrderedDict((name, entries[name]) for name in sorted(entries, key=sort_key))
+        return sha
+
+    # flat is {path : (mode, blob sha)}
+    def _build_tree(self, repo, flat):
+        children = defaultdict(dict)
+        entries = dict()
+        for path, (mode, sha) in flat.items():
+            if "/" in path:
+                directory, rest = path.split("/", 1)
+                children[directory][rest] = (mode, sha)
+            else:
+                entries[path] = [mode, "blob", sha]
+        for directory, sub_flat in children.items():
+            entries[directory] = ["040000", "tree", self._build_tree(repo, sub_flat)]
+        return self._store_tree(repo, entries)
+
+    def _flatten_tree(self, repo, tree_sha, prefix=""):
+        flat = dict()
+        for name, (mode, kind, sha) in repo["trees"][tree_sha].items():
+            if kind == "tree":
+                flat.update(self._flatten_tree(repo, sha, prefix + name + "/"))
+            else:
+                flat[prefix + name] = (mode, sha)
+        return flat
+
+    def _store_commit(self, repo, message, tree_sha, parents, author=None, date=None, committer=None):
+        user = self.state["users"].get(author or self.state["default_user"], {"login" : "unknown"})
+        date = self.clock() if date is None else date
+        signature = {"name" : user.get("name") or user["login"], "email" : user.get("email") or "%s@example.com" % user["login"], "date" : _timestamp(date)}
+        committer = committer or signature
+        data = "tree %s\n" % tree_sha
+        for parent in parents:
+            data += "parent %s\n" % parent
+        for role, who in (("author", signature), ("committer", committer)):
+            data += "%s %s <%s> %d +0000\n" % (role, who["name"], who["email"], _parse_timestamp(who["date"]))
+        data += "\n" + message
+        sha = _git_sha("commit", data.encode("UTF-8"))
+        repo["commits"][sha] = {"tree" : tree_sha, "parents" : list(parents), "message" : message,
+                                "author" : signature, "committer" : committer, "login" : user["login"]}
+        return sha
+
+    def _move_ref(self, repo, ref, sha, pusher=None):
+        before = repo["refs"].get(ref)
+        repo["refs"][ref] = sha
+        if ref.startswith("refs/heads/"):
+            repo["pushed_at"] = repo["updated_at"] = _timestamp(self.clock())
+            if before is None and len(repo["refs"]) > 1:
+                self._add_event(repo, "CreateEvent", {"ref" : ref[len("refs/heads/"):], "ref_type" : "branch"}, pusher)
+            commits = [sha] if before is None else self._commits_between(repo, before, sha)
+            self._add_event(repo, "PushEvent", {
+                "ref" : ref, "head" : sha, "before" : before or "0"*40, "size" : len(commits), "distinct_size" : len(commits),
+                "commits" : [{"sha" : c, "message" : repo["commits"][c]["message"], "distinct" : True,
+                              "author" : {k : repo["commits"][c]["author"][k] for k in ("name", "email")}} for c in reversed(commits)]
+            }, pusher)
+
+    def _add_event(self, repo, kind, payload, actor=None):
+        repo["events"].append({"id" : str(self._next_id()), "type" : kind, "actor" : actor or self.state["default_user"],
+                               "payload" : payload, "created_at" : _timestamp(self.clock())})
+
+    # all commits reachable from sha, newest first
+    def _history(self, repo, sha):
+        seen = set()
+        stack = [sha]
+        while stack:
+            c = stack.pop()
+            if c in seen:
+                continue
+            seen.add(c)
+            stack.extend(repo["commits"][c]["parents"])
+        return sorted(seen, key=lambda c: _parse_timestamp(repo["commits"][c]["committer"]["date"]), reverse=True)
+
+    # commits reachable from head but not from base
+    def _commits_between(self, repo, base, head):
+        base_history = set(self._history(repo, base))
+        return [c for c in self._history(repo, head) if c not in base_history]
+
+    # a branch name, a full ref or a commit sha -> commit sha
+    def _resolve(self, repo, name):
+        if not repo["refs"]:
+            raise FakeGitHubError(409, "Git Repository is empty.")
+        for ref in (name, "refs/heads/" + name, "refs/tags/" + name):
+            if ref in repo["refs"]:
+                return repo["refs"][ref]
+        if name in repo["commits"]:
+            return name
+        matches = [sha for sha in repo["commits"] if len(name) >= 7 and sha.startswith(name)]
+        if len(matches) == 1:
+            return matches[0]
+        raise FakeGitHubError(404, "No commit found for SHA: %s" % name)
+
+    # -------------------------------------------------------------------------------------------
+    # json representations
+
+    def _user_json(self, req, login):
+        user = self.state["users"].get(login) or {"login" : login, "id" : 0, "name" : None, "email" : None}
+        return {
+            "login" : user["login"], "id" : user["id"], "type" : "User", "site_admin" : False,
+            "name" : user["name"], "email" : user["email"],
+            "url" : "%s/users/%s" % (req.api, login), "html_url" : "%s/%s" % (req.web, login),
+            "avatar_url" : "", "gravatar_id" : "", "repos_url" : "%s/users/%s/repos" % (req.api, login)
+        }
+
+    def _org_json(self, req, org):
+        return {
+            "login" : org["login"], "id" : org["id"], "name" : org["name"], "type" : "Organization",
+            "url" : "%s/orgs/%s" % (req.api, org["login"]), "html_url" : "%s/%s" % (req.web, org["login"]),
+            "repos_url" : "%s/orgs/%s/repos" % (req.api, org["login"]), "members_url" : "%s/orgs/%s/members{/member}" % (req.api, org["login"]),
+            "public_repos" : 0, "avatar_url" : "", "description" : None
+        }
+
+    def _team_json(self, req, team):
+        return {
+            "id" : team["id"], "name" : team["name"], "slug" : team["slug"], "description" : team["description"],
+            "privacy" : team["privacy"], "permission" : team["permission"],
+            "url" : "%s/teams/%d" % (req.api, team["id"]),
+            "members_url" : "%s/teams/%d/members{/member}" % (req.api, team["id"]),
+            "repositories_url" : "%s/teams/%d/repos" % (req.api, team["id"]),
+            "members_count" : len(team["members"]), "repos_count" : len(team["repos"])
+        }
+
+    def _repo_json(self, req, repo):
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        url = "%s/repos/%s" % (req.api, full_name)
+        owner = self.state["orgs"].get(repo["owner"])
+        return {
+            "id" : repo["id"], "name" : repo["name"], "full_name" : full_name,
+            "owner" : self._org_json(req, owner) if owner else self._user_json(req, repo["owner"]),
+            "private" : repo["private"], "fork" : False, "description" : repo["description"],
+            "url" : url, "html_url" : "%s/%s" % (req.web, full_name),
+            "clone_url" : "%s/%s.git" % (req.web, full_name), "git_url" : "%s/%s.git" % (req.web, full_name),
+            "ssh_url" : "git@%s:%s.git" % (urllib.parse.urlparse(req.web).netloc, full_name),
+            "created_at" : repo["created_at"], "updated_at" : repo["updated_at"], "pushed_at" : repo["pushed_at"],
+            "default_branch" : repo["default_branch"], "size" : 0, "has_issues" : True, "has_wiki" : False,
+            "open_issues_count" : len([i for i in repo["issues"].values() if i["state"] == "open"]),
+            "permissions" : {"admin" : True, "push" : True, "pull" : True},
+            "issues_url" : url + "/issues{/number}", "pulls_url" : url + "/pulls{/number}",
+            "contents_url" : url + "/contents/{+path}", "trees_url" : url + "/git/trees{/sha}",
+            "blobs_url" : url + "/git/blobs{/sha}", "git_refs_url" : url + "/git/refs{/sha}",
+            "commits_url" : url + "/commits{/sha}", "git_commits_url" : url + "/git/commits{/sha}",
+            "branches_url" : url + "/branches{/branch}", "compare_url" : url + "/compare/{base}...{head}",
+            "collaborators_url" : url + "/collaborators{/collaborator}", "events_url" : url + "/events",
+            "archive_url" : url + "/{archive_format}{/ref}", "teams_url" : url + "/teams"
+        }
+
+    def _commit_json(self, req, repo, sha):
+        commit = repo["commits"][sha]
+        url = "%s/repos/%s/%s/git/commits/%s" % (req.api, repo["owner"], repo["name"], sha)
+        return {
+            "sha" : sha, "url" : url, "message" : commit["message"],
+            "author" : commit["author"], "committer" : commit["committer"],
+            "tree" : {"sha" : commit["tree"], "url" : "%s/repos/%s/%s/git/trees/%s" % (req.api, repo["owner"], repo["name"], commit["tree"])},
+            "parents" : [{"sha" : p, "url" : "%s/repos/%s/%s/git/commits/%s" % (req.api, repo["owner"], repo["name"], p)} for p in commit["parents"]]
+        }
+
+    def _repo_commit_json(self, req, repo, sha):
+        commit = repo["commits"][sha]
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        return {
+            "sha" : sha, "url" : "%s/repos/%s/commits/%s" % (req.api, full_name, sha),
+            "html_url" : "%s/%s/commit/%s" % (req.web, full_name, sha),
+            "commit" : self._commit_json(req, repo, sha),
+            "author" : self._user_json(req, commit["login"]), "committer" : self._user_json(req, commit["login"]),
+            "parents" : [{"sha" : p, "url" : "%s/repos/%s/commits/%s" % (req.api, full_name, p)} for p in commit["parents"]]
+        }
+
+    def _ref_json(self, req, repo, ref):
+        sha = repo["refs"][ref]
+        return {
+            "ref" : ref, "url" : "%s/repos/%s/%s/git/%s" % (req.api, repo["owner"], repo["name"], ref),
+            "object" : {"sha" : sha, "type" : "commit", "url" : "%s/repos/%s/%s/git/commits/%s" % (req.api, repo["owner"], repo["name"], sha)}
+        }
+
+    def _tree_json(self, req, repo, tree_sha, recursive):
+        base = "%s/repos/%s/%s/git" % (req.api, repo["owner"], repo["name"])
+        def entries(sha, prefix):
+            for name, (mode, kind, entry_sha) in repo["trees"][sha].items():
+                entry = {"path" : prefix + name, "mode" : mode, "type" : kind, "sha" : entry_sha,
+                         "url" : "%s/%ss/%s" % (base, kind, entry_sha)}
+                if kind == "blob":
+                    entry["size"] = len(self._blob(repo, entry_sha))
+                yield entry
+                if kind == "tree" and recursive:
+                    for sub_entry in entries(entry_sha, prefix + name + "/"):
+                        yield sub_entry
+        return {"sha" : tree_sha, "url" : "%s/trees/%s" % (base, tree_sha), "tree" : list(entries(tree_sha, "")), "truncated" : False}
+
+    def _contents_json(self, req, repo, path, mode, sha, ref, with_content=True):
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        kind = "dir" if mode == "040000" else "file"
+        contents = {
+            "type" : kind, "name" : path.split("/")[-1], "path" : path, "sha" : sha,
+            "url" : "%s/repos/%s/contents/%s?ref=%s" % (req.api, full_name, path, ref),
+            "git_url" : "%s/repos/%s/git/%ss/%s" % (req.api, full_name, "tree" if kind == "dir" else "blob", sha),
+            "html_url" : "%s/%s/blob/%s/%s" % (req.web, full_name, ref, path),
+            "download_url" : None, "_links" : {}
+        }
+        if kind == "file":
+            data = self._blob(repo, sha)
+            contents["size"] = len(data)
+            if with_content:
+                contents["encoding"] = "base64"
+                contents["content"] = base64.b64encode(data).decode("ascii")
+        else:
+            contents["size"] = 0
+        return contents
+
+    def _issue_json(self, req, repo, issue):
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        url = "%s/repos/%s/issues/%d" % (req.api, full_name, issue["number"])
+        result = {
+            "id" : issue["id"], "number" : issue["number"], "title" : issue["title"], "body" : issue["body"],
+            "state" : issue["state"], "locked" : False, "comments" : 0,
+            "user" : self._user_json(req, issue["user"]),
+            "labels" : [{"name" : label, "color" : "ededed", "url" : "%s/repos/%s/labels/%s" % (req.api, full_name, urllib.parse.quote(label))}
+                        for label in issue["labels"]],
+            "assignee" : self._user_json(req, issue["assignees"][0]) if issue["assignees"] else None,
+            "assignees" : [self._user_json(req, login) for login in issue["assignees"]],
+            "milestone" : None,
+            "url" : url, "repository_url" : "%s/repos/%s" % (req.api, full_name),
+            "labels_url" : url + "/labels{/name}", "comments_url" : url + "/comments", "events_url" : url + "/events",
+            "html_url" : "%s/%s/issues/%d" % (req.web, full_name, issue["number"]),
+            "created_at" : issue["created_at"], "updated_at" : issue["updated_at"], "closed_at" : issue["closed_at"]
+        }
+        if "head" in issue:
+            result["pull_request"] = {"url" : "%s/repos/%s/pulls/%d" % (req.api, full_name, issue["number"]),
+                                      "html_url" : "%s/%s/pull/%d" % (req.web, full_name, issue["number"])}
+        return result
+
+    def _pull_json(self, req, repo, pull):
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        url = "%s/repos/%s/pulls/%d" % (req.api, full_name, pull["number"])
+        def destination(branch, sha):
+            return {"label" : "%s:%s" % (repo["owner"], branch), "ref" : branch, "sha" : sha,
+                    "user" : self._user_json(req, repo["owner"]), "repo" : self._repo_json(req, repo)}
+        # like on GitHub, an open pull request follows its branches
+        if pull["state"] == "open":
+            pull["head_sha"] = repo["refs"].get("refs/heads/" + pull["head"], pull["head_sha"])
+            pull["base_sha"] = repo["refs"].get("refs/heads/" + pull["base"], pull["base_sha"])
+        return {
+            "id" : pull["id"], "number" : pull["number"], "title" : pull["title"], "body" : pull["body"],
+            "state" : pull["state"], "locked" : False, "merged" : False, "mergeable" : True, "merged_at" : None,
+            "user" : self._user_json(req, pull["user"]),
+            "head" : destination(pull["head"], pull["head_sha"]), "base" : destination(pull["base"], pull["base_sha"]),
+            "url" : url, "html_url" : "%s/%s/pull/%d" % (req.web, full_name, pull["number"]),
+            "issue_url" : "%s/repos/%s/issues/%d" % (req.api, full_name, pull["number"]),
+            "commits_url" : url + "/commits", "comments_url" : "%s/repos/%s/issues/%d/comments" % (req.api, full_name, pull["number"]),
+            "created_at" : pull["created_at"], "updated_at" : pull["updated_at"], "closed_at" : pull["closed_at"],
+            "_links" : {"self" : {"href" : url}}
+        }
+
+    def _event_json(self, req, repo, event):
+        full_name = "%s/%s" % (repo["owner"], repo["name"])
+        return {
+            "id" : event["id"], "type" : event["type"], "public" : not repo["private"],
+            "actor" : self._user_json(req, event["actor"]), "payload" : event["payload"],
+            "repo" : {"id" : repo["id"], "name" : full_name, "url" : "%s/repos/%s" % (req.api, full_name)},
+            "org" : self._org_json(req, self.state["orgs"][repo["owner"]]) if repo["owner"] in self.state["orgs"] else None,
+            "created_at" : event["created_at"]
+        }
+
+    # -------------------------------------------------------------------------------------------
+    # the API
+
+    def _add_routes(self):
+        routes = [
+            ("GET",    "/rate_limit", self.get_rate_limit),
+            ("GET",    "/user", self.get_authenticated_user),
+            ("GET",    "/users/:user", self.get_user),
+            ("GET",    "/orgs/:org", self.get_org),
+            ("GET",    "/orgs/:org/members", self.list_org_members),
+            ("GET",    "/orgs/:org/members/:user", self.check_org_member),
+            ("GET",    "/orgs/:org/teams", self.list_teams),
+            ("POST",   "/orgs/:org/teams", self.create_team),
+            ("GET",    "/orgs/:org/repos", self.list_org_repos),
+            ("POST",   "/orgs/:org/repos", self.create_repo),
+            ("GET",    "/teams/:id", self.get_team),
+            ("GET",    "/teams/:id/members", self.list_team_members),
+            ("GET",    "/teams/:id/members/:user", self.check_team_member),
+            ("PUT",    "/teams/:id/memberships/:user", self.add_team_membership),
+            ("GET",    "/teams/:id/repos", self.list_team_repos),
+            ("PUT",    "/teams/:id/repos/:owner/:repo", self.add_team_repo),
+            ("GET",    "/repos/:owner/:repo", self.get_repo),
+            ("GET",    "/repos/:owner/:repo/collaborators", self.list_collaborators),
+            ("GET",    "/repos/:owner/:repo/collaborators/:user", self.check_collaborator),
+            ("PUT",    "/repos/:owner/:repo/collaborators/:user", self.add_collaborator),
+            ("DELETE", "/repos/:owner/:repo/collaborators/:user", self.remove_collaborator),
+            ("GET",    "/repos/:owner/:repo/git/refs/*ref", self.get_ref),
+            ("POST",   "/repos/:owner/:repo/git/refs", self.create_ref),
+            ("PATCH",  "/repos/:owner/:repo/git/refs/*ref", self.update_ref),
+            ("GET",    "/repos/:owner/:repo/git/trees/:sha", self.get_tree),
+            ("POST",   "/repos/:owner/:repo/git/trees", self.create_tree),
+            ("GET",    "/repos/:owner/:repo/git/blobs/:sha", self.get_blob),
+            ("POST",   "/repos/:owner/:repo/git/blobs", self.create_blob),
+            ("GET",    "/repos/:owner/:repo/git/commits/:sha", self.get_git_commit),
+            ("POST",   "/repos/:owner/:repo/git/commits", self.create_commit),
+            ("GET",    "/repos/:owner/:repo/branches/:branch", self.get_branch),
+            ("PATCH",  "/repos/:owner/:repo/branches/:branch", self.protect_branch),
+            ("PUT",    "/repos/:owner/:repo/branches/:branch/protection", self.protect_branch),
+            ("GET",    "/repos/:owner/:repo/commits", self.list_commits),
+            ("GET",    "/repos/:owner/:repo/commits/:ref", self.get_commit),
+            ("GET",    "/repos/:owner/:repo/compare/:basehead", self.compare),
+            ("GET",    "/repos/:owner/:repo/tarball", lambda req, owner, repo: self.get_archive(req, owner, repo, "tarball")),
+            ("GET",    "/repos/:owner/:repo/tarball/*ref", lambda req, owner, repo, ref: self.get_archive(req, owner, repo, "tarball", ref)),
+            ("GET",    "/repos/:owner/:repo/zipball", lambda req, owner, repo: self.get_archive(req, owner, repo, "zipball")),
+            ("GET",    "/repos/:owner/:repo/zipball/*ref", lambda req, owner, repo, ref: self.get_archive(req, owner, repo, "zipball", ref)),
+            ("GET",    "/repos/:owner/:repo/contents", self.get_contents),
+            ("GET",    "/repos/:owner/:repo/contents/*path", self.get_contents),
+            ("PUT",    "/repos/:owner/:repo/contents/*path", self.put_contents),
+            ("GET",    "/repos/:owner/:repo/issues", self.list_issues),
+            ("POST",   "/repos/:owner/:repo/issues", self.create_issue),
+            ("GET",    "/repos/:owner/:repo/issues/:number", self.get_issue),
+            ("PATCH",  "/repos/:owner/:repo/issues/:number", self.update_issue),
+            ("GET",    "/repos/:owner/:repo/pulls", self.list_pulls),
+            ("POST",   "/repos/:owner/:repo/pulls", self.create_pull),
+            ("GET",    "/repos/:owner/:repo/pulls/:number", self.get_pull),
+            ("PATCH",  "/repos/:owner/:repo/pulls/:number", self.update_pull),
+            ("GET",    "/repos/:owner/:repo/events", self.list_events),
+            ("GET",    "/search/issues", self.search_issues),
+            ("POST",   "/graphql", self.graphql), # served at /api/graphql, not under /api/v3
+        ]
+        for method, template, handler in routes:
+            pattern = re.sub(r":(\w+)", r"(?P<\1>[^/]+)", template)
+            pattern = re.sub(r"\*(\w+)", r"(?P<\1>.+)", pattern)
+            self._routes.append((method, template.replace("*", ":"), re.compile("^%s$" % pattern), handler))
+
+    def _org(self, org):
+        if org not in self.state["orgs"]:
+            raise FakeGitHubError(404, "Not Found")
+        return self.state["orgs"][org]
+
+    def _team(self, team_id):
+        if team_id not in self.state["teams"]:
+            raise FakeGitHubError(404, "Not Found")
+        return self.state["teams"][team_id]
+
+    def _find_team(self, org, name):
+        for team in self.state["teams"].values():
+            if team["org"] == org and team["name"] == name:
+                return team
+        return None
+
+    def _issue(self, repo, number):
+        issue = repo["issues"].get(number)
+        if issue is None:
+            raise FakeGitHubError(404, "Not Found")
+        return issue
+
+    def get_rate_limit(self, req):
+        core = {"limit" : self.rate_limit or 0, "remaining" : self._rate_limit_remaining(), "reset" : int(self._rate_limit_reset or 0)}
+        return 200, {"resources" : {"core" : core}, "rate" : core}
+
+    def get_authenticated_user(self, req):
+        return 200, self._user_json(req, req.user)
+
+    def get_user(self, req, user):
+        if user not in self.state["users"]:
+            raise FakeGitHubError(404, "Not Found")
+        return 200, self._user_json(req, user)
+
+    def get_org(self, req, org):
+        return 200, self._org_json(req, self._org(org))
+
+    def list_org_members(self, req, org):
+        return 200, [self._user_json(req, login) for login in self._org(org)["members"]]
+
+    def check_org_member(self, req, org, user):
+        return (204 if user in self._org(org)["members"] else 404), None
+
+    def list_teams(self, req, org):
+        self._org(org)
+        return 200, [self._team_json(req, team) for team in self.state["teams"].values() if team["org"] == org]
+
+    def create_team(self, req, org):
+        self._org(org)
+        name = req.json.get("name")
+        if not name:
+            raise FakeGitHubError(422, "Validation Failed")
+        if self._find_team(org, name) is not None:
+            raise FakeGitHubError(422, "Validation Failed: name must be unique for this org")
+        team = self.add_team(org, name, privacy=req.json.get("privacy") or "secret", permission=req.json.get("permission") or "pull")
+        for full_name in req.json.get("repo_names") or []:
+            team["repos"][full_name] = team["permission"]
+        return 201, self._team_json(req, team)
+
+    def list_org_repos(self, req, org):
+        self._org(org)
+        return 200, [self._repo_json(req, repo) for repo in self.state["repos"].values() if repo["owner"] == org]
+
+    def create_repo(self, req, org):
+        self._org(org)
+        name = req.json.get("name")
+        if not name:
+            raise FakeGitHubError(422, "Validation Failed")
+        if "%s/%s" % (org, name) in self.state["repos"]:
+            raise FakeGitHubError(422, "Validation Failed: name already exists on this account")
+        repo = self.add_repo(org, name, private=bool(req.json.get("private")), author=req.user)
+        repo["description"] = req.json.get("description") or ""
+        if req.json.get("auto_init"):
+            self.commit_files(org, name, {"README.md" : "# %s\n" % name}, message="Initial commit", author=req.user)
+        return 201, self._repo_json(req, repo)
+
+    def get_team(self, req, id):
+        return 200, self._team_json(req, self._team(id))
+
+    def list_team_members(self, req, id):
+        return 200, [self._user_json(req, login) for login in self._team(id)["members"]]
+
+    def check_team_member(self, req, id, user):
+        return (204 if user in self._team(id)["members"] else 404), None
+
+    def add_team_membership(self, req, id, user):
+        team = self._team(id)
+        if user not in self.state["users"]:
+            raise FakeGitHubError(404, "Not Found")
+        self.add_org_member(team["org"], user)
+        if user not in team["members"]:
+            team["members"].append(user)
+        return 200, {"state" : "active", "role" : (req.json or {}).get("role", "member"), "url" : "%s/teams/%s/memberships/%s" % (req.api, id, user)}
+
+    def list_team_repos(self, req, id):
+        team = self._team(id)
+        return 200, [self._repo_json(req, self.state["repos"][full_name]) for full_name in team["repos"] if full_name in self.state["repos"]]
+
+    def add_team_repo(self, req, id, owner, repo):
+        team = self._team(id)
+        self._repo(owner, repo)
+        team["repos"]["%s/%s" % (owner, repo)] = (req.json or {}).get("permission") or team["permission"]
+        return 204, None
+
+    def get_repo(self, req, owner, repo):
+        return 200, self._repo_json(req, self._repo(owner, repo))
+
+    def list_collaborators(self, req, owner, repo):
+        return 200, [self._user_json(req, login) for login in self._repo(owner, repo)["collaborators"]]
+
+    def check_collaborator(self, req, owner, repo, user):
+        return (204 if user in self._repo(owner, repo)["collaborators"] else 404), None
+
+    def add_collaborator(self, req, owner, repo, user):
+        repo = self._repo(owner, repo)
+        if user not in self.state["users"]:
+            raise FakeGitHubError(404, "Not Found")
+        repo["collaborators"][user] = (req.json or {}).get("permission") or "push"
+        return 204, None
+
+    def remove_collaborator(self, req, owner, repo, user):
+        self._repo(owner, repo)["collaborators"].pop(user, None)
+        return 204, None
+
+    def get_ref(self, req, owner, repo, ref):
+        repo = self._repo(owner, repo)
+        if not repo["refs"]:
+            raise FakeGitHubError(409, "Git Repository is empty.")
+        ref = "refs/" + ref.rstrip("/")
+        if ref in repo["refs"]:
+            return 200, self._ref_json(req, repo, ref)
+        # like GitHub, a partial ref gives all the refs that start with it
+        matching = [self._ref_json(req, repo, r) for r in repo["refs"] if r.startswith(ref + "/")]
+        if not matching:
+            raise FakeGitHubError(404, "Not Found")
+        return 200, matching
+
+    def create_ref(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        ref, sha = req.json.get("ref"), req.json.get("sha")
+        if not ref or not ref.startswith("refs/") or ref.count("/") < 2:
+            raise FakeGitHubError(422, "Reference name is invalid")
+        if ref in repo["refs"]:
+            raise FakeGitHubError(422, "Reference already exists")
+        if sha not in repo["commits"]:
+            raise FakeGitHubError(422, "Object does not exist")
+        self._move_ref(repo, ref, sha, req.user)
+        return 201, self._ref_json(req, repo, ref)
+
+    def update_ref(self, req, owner, repo, ref):
+        repo = self._repo(owner, repo)
+        ref = "refs/" + ref
+        sha = req.json.get("sha")
+        if ref not in repo["refs"]:
+            raise FakeGitHubError(422, "Reference does not exist")
+        if sha not in repo["commits"]:
+            raise FakeGitHubError(422, "Object does not exist")
+        if not req.json.get("force") and repo["refs"][ref] not in self._history(repo, sha):
+            raise FakeGitHubError(422, "Update is not a fast forward")
+        self._move_ref(repo, ref, sha, req.user)
+        return 200, self._ref_json(req, repo, ref)
+
+    def get_tree(self, req, owner, repo, sha):
+        repo = self._repo(owner, repo)
+        if sha not in repo["trees"]:
+            sha = repo["commits"][self._resolve(repo, sha)]["tree"]
+        return 200, self._tree_json(req, repo, sha, recursive=req.query.get("recursive") not in (None, "0", "false"))
+
+    def create_tree(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        if not repo["refs"]:
+            raise FakeGitHubError(409, "Git Repository is empty.")
+        base_tree = req.json.get("base_tree")
+        if base_tree and base_tree not in repo["trees"]:
+            raise FakeGitHubError(422, "Invalid tree info")
+        flat = self._flatten_tree(repo, base_tree) if base_tree else dict()
+        for entry in req.json.get("tree") or []:
+            path = entry["path"]
+            if entry.get("type") == "tree":
+                for p in [p for p in flat if p.startswith(path + "/")]:
+                    del flat[p]
+                if entry.get("sha"):
+                    flat.update({path + "/" + p : v for p, v in self._flatten_tree(repo, entry["sha"]).items()})
+            elif "content" in entry:
+                flat[path] = (entry.get("mode", "100644"), self._store_blob(repo, entry["content"].encode("UTF-8")))
+            elif entry.get("sha"):
+                self._blob(repo, entry["sha"])
+                flat[path] = (entry.get("mode", "100644"), entry["sha"])
+            else: # sha: null deletes the file
+                flat.pop(path, None)
+        return 201, self._tree_json(req, repo, self._build_tree(repo, flat), recursive=False)
+
+    def get_blob(self, req, owner, repo, sha):
+        repo = self._repo(owner, repo)
+        data = self._blob(repo, sha)
+        return 200, {"sha" : sha, "size" : len(data), "encoding" : "base64", "content" : repo["blobs"][sha],
+                     "url" : "%s/repos/%s/%s/git/blobs/%s" % (req.api, repo["owner"], repo["name"], sha)}
+
+    def create_blob(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        if not repo["refs"]:
+            raise FakeGitHubError(409, "Git Repository is empty.")
+        content = req.json.get("content", "")
+        data = base64.b64decode(content) if req.json.get("encoding") == "base64" else content.encode("UTF-8")
+        sha = self._store_blob(repo, data)
+        return 201, {"sha" : sha, "url" : "%s/repos/%s/%s/git/blobs/%s" % (req.api, repo["owner"], repo["name"], sha)}
+
+    def get_git_commit(self, req, owner, repo, sha):
+        repo = self._repo(owner, repo)
+        if sha not in repo["commits"]:
+            raise FakeGitHubError(404, "Not Found")
+        return 200, self._commit_json(req, repo, sha)
+
+    def create_commit(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        tree, parents = req.json.get("tree"), req.json.get("parents") or []
+        if tree not in repo["trees"] or any(p not in repo["commits"] for p in parents):
+            raise FakeGitHubError(422, "Tree SHA does not exist")
+        author = req.json.get("author")
+        date = _parse_timestamp(author["date"]) if author and author.get("date") else None
+        sha = self._store_commit(repo, req.json.get("message", ""), tree, parents, req.user, date)
+        return 201, self._commit_json(req, repo, sha)
+
+    def get_branch(self, req, owner, repo, branch):
+        repo = self._repo(owner, repo)
+        ref = "refs/heads/" + branch
+        if ref not in repo["refs"]:
+            raise FakeGitHubError(404, "Branch not found")
+        url = "%s/repos/%s/%s/branches/%s" % (req.api, repo["owner"], repo["name"], branch)
+        protected = branch in repo["protected"]
+        return 200, {"name" : branch, "commit" : self._repo_commit_json(req, repo, repo["refs"][ref]),
+                     "_links" : {"self" : url, "html" : "%s/%s/%s/tree/%s" % (req.web, repo["owner"], repo["name"], branch)},
+                     "protected" : protected,
+                     "protection" : {"enabled" : protected, "required_status_checks" : {"enforcement_level" : "off", "contexts" : []}}}
+
+    def protect_branch(self, req, owner, repo, branch):
+        repo = self._repo(owner, repo)
+        if "refs/heads/" + branch not in repo["refs"]:
+            raise FakeGitHubError(404, "Branch not found")
+        enabled = (req.json or {}).get("protection", {}).get("enabled", True)
+        if enabled and branch not in repo["protected"]:
+            repo["protected"].append(branch)
+        elif not enabled and branch in repo["protected"]:
+            repo["protected"].remove(branch)
+        return self.get_branch(req, owner, repo["name"], branch)
+
+    def list_commits(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        history = self._history(repo, self._resolve(repo, req.query.get("sha") or repo["default_branch"]))
+        until, since = _parse_timestamp(req.query.get("until")), _parse_timestamp(req.query.get("since"))
+        path = req.query.get("path")
+        commits = []
+        for sha in history:
+            date = _parse_timestamp(repo["commits"][sha]["committer"]["date"])
+            if (until is not None and date > until) or (since is not None and date < since):
+                continue
+            if path and not self._touches(repo, sha, path):
+                continue
+            commits.append(self._repo_commit_json(req, repo, sha))
+        return 200, commits
+
+    # whether the commit changed anything at or under path
+    def _touches(self, repo, sha, path):
+        def at_path(commit_sha):
+            return {p : v for p, v in self._flatten_tree(repo, repo["commits"][commit_sha]["tree"]).items() if p == path or p.startswith(path.rstrip("/") + "/")}
+        parents = repo["commits"][sha]["parents"]
+        return at_path(sha) != (at_path(parents[0]) if parents else dict())
+
+    def get_commit(self, req, owner, repo, ref):
+        repo = self._repo(owner, repo)
+        sha = self._resolve(repo, ref)
+        if SHA_MEDIA_TYPE in req.headers.get("Accept", ""):
+            return 200, sha.encode("ascii")
+        return 200, self._repo_commit_json(req, repo, sha)
+
+    # GitHub redirects to a download server for these. here the archive is served straight away
+    def get_archive(self, req, owner, repo, archive_format, ref=None):
+        repo = self._repo(owner, repo)
+        sha = self._resolve(repo, ref or repo["default_branch"])
+        prefix = "%s-%s-%s/" % (repo["owner"], repo["name"], sha[:7])
+        files = self._flatten_tree(repo, repo["commits"][sha]["tree"])
+        mtime = _parse_timestamp(repo["commits"][sha]["committer"]["date"])
+        buffer = io.BytesIO()
+        if archive_format == "tarball":
+            with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+                for path in sorted(files):
+                    mode, blob_sha = files[path]
+                    contents = self._blob(repo, blob_sha)
+                    info = tarfile.TarInfo(prefix + path)
+                    info.size = len(contents)
+                    info.mtime = mtime
+                    info.mode = 0o755 if mode == "100755" else 0o644
+                    archive.addfile(info, io.BytesIO(contents))
+            download = _Download(buffer.getvalue())
+            download.content_type = "application/x-gzip"
+        else:
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+                for path in sorted(files):
+                    archive.writestr(prefix + path, self._blob(repo, files[path][1]))
+            download = _Download(buffer.getvalue())
+            download.content_type = "application/zip"
+        return 200, download
+
+    def compare(self, req, owner, repo, basehead):
+        repo = self._repo(owner, repo)
+        if "..." not in basehead:
+            raise FakeGitHubError(404, "Not Found")
+        base, head = (self._resolve(repo, name) for name in basehead.split("...", 1))
+        ahead = self._commits_between(repo, base, head)
+        behind = self._commits_between(repo, head, base)
+        base_history = set(self._history(repo, base))
+        merge_base = next((c for c in self._history(repo, head) if c in base_history), None)
+        status = "identical" if not ahead and not behind else "ahead" if not behind else "behind" if not ahead else "diverged"
+        return 200, {
+            "status" : status, "ahead_by" : len(ahead), "behind_by" : len(behind), "total_commits" : len(ahead),
+            "base_commit" : self._repo_commit_json(req, repo, base),
+            "merge_base_commit" : self._repo_commit_json(req, repo, merge_base) if merge_base else None,
+            "commits" : [self._repo_commit_json(req, repo, c) for c in reversed(ahead)], "files" : [],
+            "url" : "%s/repos/%s/%s/compare/%s" % (req.api, repo["owner"], repo["name"], basehead)
+        }
+
+    def get_contents(self, req, owner, repo, path=""):
+        repo = self._repo(owner, repo)
+        ref = req.query.get("ref") or repo["default_branch"]
+        if not repo["refs"]:
+            raise FakeGitHubError(404, "This repository is empty.")
+        commit_sha = self._resolve(repo, ref)
+        path = path.strip("/")
+        flat = self._flatten_tree(repo, repo["commits"][commit_sha]["tree"])
+        if path in flat:
+            return 200, self._contents_json(req, repo, path, flat[path][0], flat[path][1], ref)
+        # a directory: list what is directly in it
+        tree_sha = repo["commits"][commit_sha]["tree"]
+        for name in path.split("/") if path else []:
+            entry = repo["trees"][tree_sha].get(name)
+            if entry is None or entry[1] != "tree":
+                raise FakeGitHubError(404, "Not Found")
+            tree_sha = entry[2]
+        return 200, [self._contents_json(req, repo, (path + "/" + name).lstrip("/"), mode, sha, ref, with_content=False)
+                     for name, (mode, kind, sha) in repo["trees"][tree_sha].items()]
+
+    def put_contents(self, req, owner, repo, path):
+        repo = self._repo(owner, repo)
+        branch = req.json.get("branch") or repo["default_branch"]
+        ref = "refs/heads/" + branch
+        parent = repo["refs"].get(ref)
+        if parent is None and repo["refs"]:
+            raise FakeGitHubError(404, "Branch %s not found" % branch)
+        flat = self._flatten_tree(repo, repo["commits"][parent]["tree"]) if parent else dict()
+        existing = flat.get(path)
+        if existing and req.json.get("sha") != existing[1]:
+            raise FakeGitHubError(409 if req.json.get("sha") else 422, "%s does not match" % path if req.json.get("sha") else "\"sha\" wasn't supplied.")
+        flat[path] = (existing[0] if existing else "100644", self._store_blob(repo, base64.b64decode(req.json.get("content", ""))))
+        commit_sha = self._store_commit(repo, req.json.get("message", ""), self._build_tree(repo, flat), [parent] if parent else [], req.user)
+        self._move_ref(repo, ref, commit_sha, req.user)
+        return (200 if existing else 201), {"content" : self._contents_json(req, repo, path, flat[path][0], flat[path][1], branch, with_content=False),
+                                            "commit" : self._commit_json(req, repo, commit_sha)}
+
+    def list_issues(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        state = req.query.get("state") or "open"
+        labels = [label for label in (req.query.get("labels") or "").split(",") if label]
+        since = _parse_timestamp(req.query.get("since"))
+        issues = []
+        for issue in reversed(list(repo["issues"].values())): # newest first
+            if state != "all" and issue["state"] != state:
+                continue
+            if any(label not in issue["labels"] for label in labels):
+                continue
+            if since is not None and _parse_timestamp(issue["updated_at"]) < since:
+                continue
+            issues.append(self._issue_json(req, repo, issue))
+        return 200, issues
+
+    def _new_issue(self, repo, title, body, user):
+        if not title:
+            raise FakeGitHubError(422, "Validation Failed")
+        now = _timestamp(self.clock())
+        issue = {"id" : self._next_id(), "number" : repo["next_number"], "title" : title, "body" : body, "state" : "open",
+                 "user" : user, "labels" : [], "assignees" : [], "created_at" : now, "updated_at" : now, "closed_at" : None}
+        repo["issues"][str(issue["number"])] = issue
+        repo["next_number"] += 1
+        return issue
+
+    def create_issue(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        issue = self._new_issue(repo, req.json.get("title"), req.json.get("body"), req.user)
+        issue["labels"] = list(req.json.get("labels") or [])
+        issue["assignees"] = list(req.json.get("assignees") or ([req.json["assignee"]] if req.json.get("assignee") else []))
+        self._add_event(repo, "IssuesEvent", {"action" : "opened", "number" : issue["number"]}, req.user)
+        return 201, self._issue_json(req, repo, issue)
+
+    def get_issue(self, req, owner, repo, number):
+        repo = self._repo(owner, repo)
+        return 200, self._issue_json(req, repo, self._issue(repo, number))
+
+    def _update_state(self, repo, issue, new_state, user):
+        if new_state and new_state != issue["state"]:
+            issue["state"] = new_state
+            issue["closed_at"] = _timestamp(self.clock()) if new_state == "closed" else None
+            self._add_event(repo, "PullRequestEvent" if "head" in issue else "IssuesEvent",
+                            {"action" : "closed" if new_state == "closed" else "reopened", "number" : issue["number"]}, user)
+
+    def update_issue(self, req, owner, repo, number):
+        repo = self._repo(owner, repo)
+        issue = self._issue(repo, number)
+        for key in ("title", "body"):
+            if key in req.json:
+                issue[key] = req.json[key]
+        if "labels" in req.json:
+            issue["labels"] = list(req.json["labels"] or [])
+        if "assignees" in req.json or "assignee" in req.json:
+            issue["assignees"] = list(req.json.get("assignees") or ([req.json["assignee"]] if req.json.get("assignee") else []))
+        self._update_state(repo, issue, req.json.get("state"), req.user)
+        issue["updated_at"] = _timestamp(self.clock())
+        return 200, self._issue_json(req, repo, issue)
+
+    """ Search issues and pull requests. Understands the qualifiers org:, user:, repo:, type: and is: (issue or pr),
+        state: and is: (open or closed) and in: (title or body), and words or "quoted phrases", which must all appear
+        (ignoring case) in the title or body. Results are newest first. """
+    def search_issues(self, req):
+        qualifiers = defaultdict(list)
+        words = []
+        for term in re.findall(r'(?:\w+:)?"[^"]*"|\S+', req.query.get("q", "")):
+            m = re.match(r'(\w+):(.*)$', term)
+            if m and m.group(1) in ("org", "user", "repo", "type", "is", "state", "in"):
+                qualifiers[m.group(1)].append(m.group(2).strip('"').lower())
+            else:
+                words.append(term.strip('"').lower())
+        kinds = {value for value in qualifiers["type"] + qualifiers["is"] if value in ("issue", "pr")}
+        states = {value for value in qualifiers["state"] + qualifiers["is"] if value in ("open", "closed")}
+        where = set(qualifiers["in"]) or {"title", "body"}
+
+        results = []
+        for repo in self.state["repos"].values():
+            if qualifiers["org"] + qualifiers["user"] and repo["owner"].lower() not in qualifiers["org"] + qualifiers["user"]:
+                continue
+            if qualifiers["repo"] and ("%s/%s" % (repo["owner"], repo["name"])).lower() not in qualifiers["repo"]:
+                continue
+            for issue in repo["issues"].values():
+                if kinds and ("pr" if "head" in issue else "issue") not in kinds:
+                    continue
+                if states and issue["state"] not in states:
+                    continue
+                text = " ".join((issue[key] or "") for key in ("title", "body") if key in where).lower()
+                if all(word in text for word in words):
+                    results.append((issue["created_at"], issue["id"], repo, issue))
+        results.sort(key=lambda result: result[:2], reverse=True)
+        items = [dict(self._issue_json(req, repo, issue), score=1.0) for _, _, repo, issue in results]
+        return 200, {"total_count" : len(items), "incomplete_results" : False, "items" : items}
+
+    def list_pulls(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        state = req.query.get("state") or "open"
+        head, base = req.query.get("head"), req.query.get("base")
+        pulls = []
+        for pull in reversed(list(repo["issues"].values())):
+            if "head" not in pull or (state != "all" and pull["state"] != state):
+                continue
+            if head and head not in (pull["head"], "%s:%s" % (repo["owner"], pull["head"])):
+                continue
+            if base and base != pull["base"]:
+                continue
+            pulls.append(self._pull_json(req, repo, pull))
+        return 200, pulls
+
+    def create_pull(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        head, base = req.json.get("head", ""), req.json.get("base", "")
+        head = head.split(":", 1)[1] if ":" in head else head
+        if "refs/heads/" + head not in repo["refs"] or "refs/heads/" + base not in repo["refs"]:
+            raise FakeGitHubError(422, "Validation Failed: head or base branch does not exist")
+        for issue in repo["issues"].values():
+            if issue.get("head") == head and issue.get("base") == base and issue["state"] == "open":
+                raise FakeGitHubError(422, "Validation Failed: A pull request already exists for %s:%s." % (repo["owner"], head))
+        head_sha, base_sha = repo["refs"]["refs/heads/" + head], repo["refs"]["refs/heads/" + base]
+        if not self._commits_between(repo, base_sha, head_sha):
+            raise FakeGitHubError(422, "Validation Failed: No commits between %s and %s" % (base, head))
+        pull = self._new_issue(repo, req.json.get("title"), req.json.get("body"), req.user)
+        pull.update({"head" : head, "base" : base, "head_sha" : head_sha, "base_sha" : base_sha})
+        self._add_event(repo, "PullRequestEvent", {"action" : "opened", "number" : pull["number"]}, req.user)
+        return 201, self._pull_json(req, repo, pull)
+
+    def _pull(self, repo, number):
+        pull = self._issue(repo, number)
+        if "head" not in pull:
+            raise FakeGitHubError(404, "Not Found")
+        return pull
+
+    def get_pull(self, req, owner, repo, number):
+        repo = self._repo(owner, repo)
+        return 200, self._pull_json(req, repo, self._pull(repo, number))
+
+    def update_pull(self, req, owner, repo, number):
+        repo = self._repo(owner, repo)
+        pull = self._pull(repo, number)
+        for key in ("title", "body", "base"):
+            if req.json.get(key) is not None:
+                pull[key] = req.json[key]
+        self._update_state(repo, pull, req.json.get("state"), req.user)
+        pull["updated_at"] = _timestamp(self.clock())
+        return 200, self._pull_json(req, repo, pull)
+
+    def list_events(self, req, owner, repo):
+        repo = self._repo(owner, repo)
+        return 200, [self._event_json(req, repo, event) for event in reversed(repo["events"])]
+
+    # -------------------------------------------------------------------------------------------
+    # the GraphQL API (POST /api/graphql): the part of GitHub's schema that Goatcabin asks for.
+    # like GitHub, errors in one field (e.g. a repository that doesn't exist) make that field null
+    # and are listed under "errors", and the rest of the query is still answered
+
+    def _add_graphql_types(self):
+        def field(kind, get):
+            return lambda req, obj, **arguments: (kind, get(obj, **arguments))
+        def ref(repo, qualified_name):
+            return (repo, qualified_name) if qualified_name in repo["refs"] else None
+        # each type is {field name : resolver}, and a resolver returns (type of the value, value)
+        self._graphql_types = {
+            "Query" : {
+                "repository" : lambda req, obj, owner, name: ("Repository", self._graphql_repository(owner, name)),
+                "organization" : lambda req, obj, login: ("Organization", self._org(login)),
+                "viewer" : lambda req, obj: ("User", req.user),
+            },
+            "Organization" : { # an org
+                "login" : field(None, lambda org: org["login"]),
+                "name" : field(None, lambda org: org["name"]),
+                "membersWithRole" : lambda req, org, first=None, after=None: ("UserConnection", self._graphql_page(org["members"], first, after)),
+            },
+            "UserConnection" : { # (logins on this page, whether there are more, cursor of the last one, total)
+                "nodes" : field("User", lambda page: list(page[0])),
+                "pageInfo" : field("PageInfo", lambda page: page),
+                "totalCount" : field(None, lambda page: page[3]),
+            },
+            "PageInfo" : {
+                "hasNextPage" : field(None, lambda page: page[1]),
+                "endCursor" : field(None, lambda page: page[2]),
+            },
+            "User" : { # a login
+                "login" : field(None, lambda login: login),
+                "name" : field(None, lambda login: self.state["users"][login].get("name")),
+                "email" : field(None, lambda login: self.state["users"][login].get("email") or ""), # "" if it isn't public, like GitHub
+            },
+            "Repository" : { # a repo
+                "name" : field(None, lambda repo: repo["name"]),
+                "nameWithOwner" : field(None, lambda repo: "%s/%s" % (repo["owner"], repo["name"])),
+                "pushedAt" : field(None, lambda repo: repo["pushed_at"]),
+                "isEmpty" : field(None, lambda repo: not repo["refs"]),
+                "defaultBranchRef" : field("Ref", lambda repo: ref(repo, "refs/heads/" + repo["default_branch"])),
+                "ref" : field("Ref", lambda repo, qualifiedName: ref(repo, qualifiedName if qualifiedName.startswith("refs/") else "refs/heads/" + qualifiedName)),
+                "object" : lambda req, repo, expression: self._graphql_object(repo, expression),
+            },
+            "Ref" : { # (repo, full ref name)
+                "name" : field(None, lambda r: r[1].split("/", 2)[-1]),
+                "target" : field("Commit", lambda r: (r[0], r[0]["refs"][r[1]])),
+            },
+            "Commit" : { # (repo, sha)
+                "oid" : field(None, lambda c: c[1]),
+                "committedDate" : field(None, lambda c: c[0]["commits"][c[1]]["committer"]["date"]),
+                "authoredDate" : field(None, lambda c: c[0]["commits"][c[1]]["author"]["date"]),
+                "message" : field(None, lambda c: c[0]["commits"][c[1]]["message"]),
+                "tree" : field("Tree", lambda c: (c[0], c[0]["commits"][c[1]]["tree"])),
+                "history" : lambda req, c, first=None, until=None, since=None: ("CommitHistoryConnection", self._graphql_history(c[0], c[1], first, until, since)),
+            },
+            "CommitHistoryConnection" : { # ((repo, sha), ...)
+                "nodes" : field("Commit", lambda commits: list(commits)),
+                "totalCount" : field(None, lambda commits: len(commits)),
+            },
+            "Tree" : { # (repo, sha)
+                "oid" : field(None, lambda t: t[1]),
+                "entries" : field("TreeEntry", lambda t: [(t[0], name, entry) for name, entry in t[0]["trees"][t[1]].items()]),
+            },
+            "TreeEntry" : { # (repo, name, [mode, type, sha])
+                "name" : field(None, lambda e: e[1]),
+                "type" : field(None, lambda e: e[2][1]),
+                "oid" : field(None, lambda e: e[2][2]),
+            },
+            "Blob" : { # (repo, sha)
+                "oid" : field(None, lambda b: b[1]),
+                "byteSize" : field(None, lambda b: len(self._blob(b[0], b[1]))),
+            },
+        }
+
+    def _graphql_repository(self, owner, name):
+        repo = self.state["repos"].get("%s/%s" % (owner, name))
+        if repo is None:
+            raise FakeGitHubError(404, "Could not resolve to a Repository with the name '%s/%s'." % (owner, name))
+        return repo
+
+    # the object at expression, e.g. "master:labs/lab1" or "master:" for the whole tree, as (type, (repo, sha))
+    def _graphql_object(self, repo, expression):
+        revision, path = expression.split(":", 1) if ":" in expression else (expression, None)
+        try:
+            sha = self._resolve(repo, revision)
+        except FakeGitHubError: # GitHub says null, not an error
+            return None, None
+        if path is None:
+            return "Commit", (repo, sha)
+        kind, sha = "tree", repo["commits"][sha]["tree"]
+        for name in [part for part in path.split("/") if part]:
+            if kind != "tree" or name not in repo["trees"][sha]:
+                return None, None
+            _, kind, sha = repo["trees"][sha][name]
+        return kind.capitalize(), (repo, sha)
+
+    # a page of a connection, like GitHub's: first is required (up to 100), and after is the endCursor of the page before
+    def _graphql_page(self, items, first, after):
+        if first is None or not 1 <= first <= MAX_PER_PAGE:
+            raise FakeGitHubError(422, "Requesting %s records on the connection exceeds the `first` limit of %d records." % (first, MAX_PER_PAGE))
+        start = int(base64.b64decode(after).decode("ascii").split(":")[1]) if after else 0
+        page = tuple(items[start:start + first])
+        end_cursor = base64.b64encode(("cursor:%d" % (start + len(page))).encode("ascii")).decode("ascii") if page else None
+        return (page, start + len(page) < len(items), end_cursor, len(items))
+
+    # the commits reachable from sha, newest first, committed between since and until
+    def _graphql_history(self, repo, sha, first, until, since):
+        until, since = _parse_timestamp(until), _parse_timestamp(since)
+        commits = []
+        for c in self._history(repo, sha):
+            date = _parse_timestamp(repo["commits"][c]["committer"]["date"])
+            if (until is None or date <= until) and (since is None or date >= since):
+                commits.append((repo, c))
+        return tuple(commits[:first] if first is not None else commits) # a tuple, because a list would be a list of objects
+
+    def _graphql_select(self, req, kind, obj, selections, variables, errors, path):
+        data = OrderedDict()
+        for selection in selections:
+            if selection[0] == "fragment":
+                if selection[1] == kind:
+                    data.update(self._graphql_select(req, kind, obj, selection[2], variables, errors, path))
+                continue
+            _, alias, name, arguments, subselections = selection
+            if name == "__typename":
+                data[alias] = kind
+                continue
+            resolver = self._graphql_types[kind].get(name)
+            if resolver is None:
+                errors.append({"path" : path + [alias], "message" : "Field '%s' doesn't exist on type '%s'" % (name, kind)})
+                data[alias] = None
+                continue
+            try:
+                child_kind, value = resolver(req, obj, **{k : _graphql_value(v, variables) for k, v in arguments.items()})
+            except TypeError:
+                errors.append({"path" : path + [alias], "message" : "Field '%s' got the wrong arguments" % name})
+                data[alias] = None
+                continue
+            except FakeGitHubError as e:
+                errors.append({"type" : "NOT_FOUND" if e.status == 404 else "UNPROCESSABLE", "path" : path + [alias], "message" : e.message})
+                data[alias] = None
+                continue
+            if value is None or subselections is None:
+                data[alias] = value
+            elif isinstance(value, list):
+                data[alias] = [self._graphql_select(req, child_kind, v, subselections, variables, errors, path + [alias, i]) for i, v in enumerate(value)]
+            else:
+                data[alias] = self._graphql_select(req, child_kind, value, subselections, variables, errors, path + [alias])
+        return data
+
+    def graphql(self, req):
+        try:
+            selections = _GraphQLParser(req.json.get("query") or "").document()
+        except ValueError as e:
+            return 200, {"errors" : [{"message" : str(e)}]}
+        errors = []
+        data = self._graphql_select(req, "Query", None, selections, req.json.get("variables") or dict(), errors, [])
+        return 200, OrderedDict([("data", data)] + ([("errors", errors)] if errors else []))
+
+    # -------------------------------------------------------------------------------------------
+    # dispatching requests
+
+    def _rate_limit_remaining(self):
+        if self.rate_limit is None:
+            return 5000
+        if self._rate_limit_reset is None or self.clock() >= self._rate_limit_reset:
+            self._rate_limit_used = 0
+            self._rate_limit_reset = self.clock() + self.rate_limit_window
+        return self.rate_limit - self._rate_limit_used
+
+    """ Answer one API request. path is the part after /api/v3, query a dict of query parameters, headers a
+        dict of request headers and body the raw request body. base_url is what the client called us by,
+        e.g. http://localhost:8000, and is used to build the urls in the responses.
+        Returns (status, response headers, response body). """
+    def handle(self, method, path, query, headers, body, base_url):
+        start_time = time.time()
+        if self.latency:
+            time.sleep(self.latency)
+
+        for route_method, template, regex, handler in self._routes:
+            match = regex.match(path)
+            if match and route_method == method:
+                break
+        else:
+            template, handler, match = None, None, None
+            if any(regex.match(path) for _, _, regex, _ in self._routes):
+                return self._error(405, "Method Not Allowed")
+
+        endpoint = "%s %s" % (method, template or path)
+        with self._lock:
+            self.request_counts[endpoint] += 1
+
+            remaining = self._rate_limit_remaining()
+            rate_headers = {"X-RateLimit-Limit" : str(self.rate_limit or 5000), "X-RateLimit-Reset" : str(int(self._rate_limit_reset or self.clock() + self.rate_limit_window))}
+            if self.rate_limit is not None and remaining <= 0:
+                rate_headers["X-RateLimit-Remaining"] = "0"
+                return self._error(403, "API rate limit exceeded for %s." % self._login(headers), rate_headers)
+
+            if handler is None:
+                status, response_headers, response_body = self._error(404, "Not Found")
+            else:
+                try:
+                    status, response_headers, response_body = self._dispatch(method, handler, match, query, headers, body, base_url)
+                except FakeGitHubError as e:
+                    status, response_headers, response_body = self._error(e.status, e.message)
+
+            if status == 304:
+                self.not_modified_counts[endpoint] += 1 # conditional requests that hit don't count against the limit
+            elif self.rate_limit is not None:
+                self._rate_limit_used += 1
+            rate_headers["X-RateLimit-Remaining"] = str(self._rate_limit_remaining())
+            response_headers.update(rate_headers)
+
+            if method != "GET" and status < 400 and self.state_path:
+                self.save()
+            self.request_seconds[endpoint] += time.time() - start_time
+        return status, response_headers, response_body
+
+    def _login(self, headers):
+        authorization = headers.get("Authorization", "")
+        token = authorization.split(" ", 1)[1] if " " in authorization else ""
+        return self.state["tokens"].get(token, self.state["default_user"])
+
+    def _dispatch(self, method, handler, match, query, headers, body, base_url):
+        class Request(object):
+            pass
+        req = Request()
+        req.query = query
+        req.headers = headers
+        req.web = base_url
+        req.api = base_url + API_PREFIX
+        req.user = self._login(headers)
+        try:
+            req.json = json.loads(body.decode("UTF-8"), object_pairs_hook=OrderedDict) if body else dict()
+        except ValueError:
+            raise FakeGitHubError(400, "Problems parsing JSON")
+        if req.json is None:
+            req.json = dict()
+
+        status, result = handler(req, **{k : urllib.parse.unquote(v) for k, v in match.groupdict().items()})
+        response_headers = dict()
+        if result is None:
+            return status, response_headers, b""
+
+        if isinstance(result, list) and method == "GET":
+            result = self._paginate(result, query, base_url, match.string, response_headers)
+        elif isinstance(result, dict) and "items" in result and method == "GET": # search results
+            result["items"] = self._paginate(result["items"][:MAX_SEARCH_RESULTS], query, base_url, match.string, response_headers)
+        if isinstance(result, _Download):
+            response_headers["Content-Type"] = result.content_type
+            response_body = bytes(result)
+        elif isinstance(result, bytes):
+            response_headers["Content-Type"] = "text/plain; charset=utf-8"
+            response_body = result
+        else:
+            response_headers["Content-Type"] = "application/json; charset=utf-8"
+            response_body = json.dumps(result).encode("UTF-8")
+
+        if method == "GET" and status == 200:
+            etag = '"%s"' % hashlib.sha1(response_body).hexdigest()
+            response_headers["ETag"] = etag
+            if headers.get("If-None-Match") == etag:
+                return 304, {"ETag" : etag}, b""
+        return status, response_headers, response_body
+
+    def _paginate(self, items, query, base_url, path, response_headers):
+        try:
+            per_page = min(MAX_PER_PAGE, max(1, int(query.get("per_page", DEFAULT_PER_PAGE))))
+            page = max(1, int(query.get("page", 1)))
+        except ValueError:
+            raise FakeGitHubError(422, "Invalid pagination parameters")
+        last_page = max(1, (len(items) + per_page - 1)//per_page)
+        def page_url(n):
+            return "%s%s%s?%s" % (base_url, API_PREFIX, path, urllib.parse.urlencode(dict(query, page=n, per_page=per_page)))
+        links = []
+        if page < last_page:
+            links.append('<%s>; rel="next"' % page_url(page + 1))
+            links.append('<%s>; rel="last"' % page_url(last_page))
+        if page > 1:
+            links.append('<%s>; rel="first"' % page_url(1))
+            links.append('<%s>; rel="prev"' % page_url(page - 1))
+        if links:
+            response_headers["Link"] = ", ".join(links)
+        return items[(page - 1)*per_page : page*per_page]
+
+    def _error(self, status, message, headers=None):
+        response_headers = {"Content-Type" : "application/json; charset=utf-8"}
+        response_headers.update(headers or dict())
+        return status, response_headers, json.dumps({"message" : message, "documentation_url" : "https://developer.github.com/v3"}).encode("UTF-8")
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # keep-alive, like the real thing
+    disable_nagle_algorithm = True # the headers and the body are written separately; don't wait for an ACK in between
+
+    def _handle(self):
+        fake = self.server.fake
+        parsed = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        base_url = "http://%s" % (self.headers.get("Host") or "%s:%d" % self.server.server_address[:2])
+        query = {k : v[-1] for k, v in urllib.parse.parse_qs(parsed.query, keep_blank_values=True).items()}
+        if parsed.path.rstrip("/") == GRAPHQL_PATH:
+            status, headers, response_body = fake.handle(self.command, "/graphql", query, dict(self.headers.items()), body, base_url)
+        elif not parsed.path.startswith(API_PREFIX):
+            status, headers, response_body = fake._error(404, "Not Found")
+        else:
+            status, headers, response_body = fake.handle(self.command, parsed.path[len(API_PREFIX):].rstrip("/") or "/",
+                                                         query, dict(self.headers.items()), body, base_url)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+""" Serve fake (a FakeGitHub) on a background thread. Returns the server; its url is
+    "http://localhost:%d" % server.server_address[1], and server.shutdown() stops it. """
+def start_server(fake, port=0, verbose=False):
+    server = ThreadingHTTPServer(("localhost", port), _RequestHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A fake GitHub Enterprise server for running Rhomboid offline.")
+    parser.add_argument("--port", default=8000, type=int, help="The port to listen on.")
+    parser.add_argument("--state", default=None, type=str, help="A JSON file to load the state from and save it to. If absent, the state is only kept in memory.")
+    parser.add_argument("--latency", default=0.0, type=float, help="Seconds to wait before answering each request.")
+    parser.add_argument("--rate-limit", default=None, type=int, help="How many requests are allowed per hour.")
+    parser.add_argument("--seed", default=None, type=str, help="A Rhomboid config file. Sets up its org, teams and repos, with a few made-up students.")
+    parser.add_argument("--verbose", action="store_true", help="If present, every request is logged.")
+    args = parser.parse_args()
+
+    fake = FakeGitHub(latency=args.latency, rate_limit=args.rate_limit, state_path=args.state)
+    if args.seed:
+        with open(args.seed, "r") as f:
+            config = json.load(f)
+        with open("default_course_config.json", "r") as f:
+            course_config = json.load(f, object_pairs_hook=OrderedDict)
+        fake.seed_course(config, "instructor", ["student%d" % i for i in range(1, 4)], course_config)
+        if args.state:
+            fake.save()
+    server = start_server(fake, port=args.port, verbose=args.verbose)
+    print("Fake GitHub Enterprise running at http://localhost:%d" % server.server_address[1])
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # stop cleanly on kill, too
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    server.shutdown()
+    if args.state:
+        fake.save()
+    print("Requests by endpoint:")
+    for endpoint, count in fake.request_counts.most_common():
+        print("%6d %s" % (count, endpoint))
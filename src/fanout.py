@@ -0,0 +1,148 @@
+"""
+Bounded concurrent fan-out for per-group work.
+
+Goatcabin does the same handful of API calls for every group in a course (create a repo, gift it,
+add collaborators, ...). FanOut runs that per-group work on a shared thread pool. Whatever a piece
+of work prints is buffered and replayed in the order the groups were submitted, so the console
+output is the same no matter how the threads were scheduled. Failures are collected per group and
+summarized once the whole batch is done, instead of stopping the batch half way through, and then
+raised as a FanOutError, so that whatever was meant to happen after the batch (e.g. marking an
+assessment as returned) doesn't happen for a batch that only partly worked.
+"""
+
+import sys
+import threading
+import traceback
+from io import StringIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 8
+
+
+# some items of a batch failed. results is an OrderedDict from item to what fn returned, for the items that
+# succeeded, and failures is a list of (item, exception) for the others
+class FanOutError(Exception):
+
+    def __init__(self, description, results, failures):
+        Exception.__init__(self, "%d of %d failed during %s" % (len(failures), len(results) + len(failures), description))
+        self.results = results
+        self.failures = failures
+
+
+# sys.stdout replacement that sends output to a per-thread buffer when one has been set up,
+# and straight through to the real stdout otherwise (e.g. on the main thread)
+class _ThreadLocalStdout(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class FanOut(object):
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, tracer=None):
+        self.max_workers = max(1, int(max_workers))
+        self.tracer = tracer # if tracing, each item becomes a span
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._in_worker = threading.local()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    # runs in a worker thread: call fn(item) with its output captured in stdout, a _ThreadLocalStdout
+    def _run_captured(self, fn, item, stdout):
+        self._in_worker.active = True
+        stdout.local.buffer = StringIO()
+        try:
+            try:
+                result, error = fn(item), None
+            except Exception as e:
+                traceback.print_exc(file=stdout.local.buffer)
+                result, error = None, e
+            return result, error, stdout.local.buffer.getvalue()
+        finally:
+            stdout.local.buffer = None
+            self._in_worker.active = False
+
+    # fn, but each call is a span named after the batch, carrying the item and what the caller was working on
+    # (the worker threads do not know that on their own)
+    def _traced(self, fn, description, key):
+        tracer = self.tracer
+        context = tracer.inherited()
+        def traced(item):
+            with tracer.span(description, category="fanout", **dict(context, group=key(item))):
+                return fn(item)
+        return traced
+
+    """ Call fn(item) for every item, using up to max_workers threads.
+        description is used when summarizing failures, and key(item) to name the item that failed.
+        Returns an OrderedDict from item to fn(item), in the original order. If any item failed, the failures
+        are printed and a FanOutError is raised once all the other items are done. """
+    def map(self, fn, items, description, key=None):
+        items = list(items)
+        if key is None:
+            key = lambda item: "_".join(sorted(item)) if isinstance(item, tuple) else str(item)
+        if self.tracer is not None and self.tracer.enabled:
+            fn = self._traced(fn, description, key)
+
+        results = OrderedDict()
+        failures = []
+
+        # run inline if there is no point in threads, or if we are already inside a worker
+        # (waiting on the pool from inside the pool could deadlock it)
+        if self.max_workers == 1 or len(items) <= 1 or getattr(self._in_worker, "active", False):
+            for item in items:
+                try:
+                    results[item] = fn(item)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stdout)
+                    failures.append((item, e))
+        else:
+            pool = self._get_pool()
+            # the workers' output is captured while the batch runs, and the real stdout is put back afterwards
+            real_stdout = sys.stdout
+            sys.stdout = stdout = _ThreadLocalStdout(real_stdout)
+            try:
+                futures = [pool.submit(self._run_captured, fn, item, stdout) for item in items]
+                # replay the output in submission order as soon as each piece of work is done
+                for item, future in zip(items, futures):
+                    result, error, output = future.result()
+                    real_stdout.write(output)
+                    if error is None:
+                        results[item] = result
+                    else:
+                        failures.append((item, error))
+            finally:
+                sys.stdout = real_stdout
+
+        if failures:
+            print("%d of %d failed during %s:" % (len(failures), len(items), description))
+            for item, error in failures:
+                print("    %-30s %s: %s" % (key(item), type(error).__name__, error))
+            raise FanOutError(description, results, failures)
+
+        return results
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
@@ -0,0 +1,162 @@
+"""
+Questions about many repos at once, through GitHub's GraphQL API.
+
+The REST API answers one question about one repo per request, so asking "when was each of these
+200 repos last pushed to?" costs at least 200 requests. A GraphQL query can look up many repos
+under aliases (r0: repository(...) { ... }, r1: ...), so the same question costs a couple of
+requests. RepoQueries uses this for the small questions that Goatcabin asks about every group's
+repo, such as whether it is empty. The queries go through the same requests session as github3, so
+they are authenticated, scheduled and traced like everything else (GraphQL queries are POSTs, but
+the scheduler knows that they only read).
+"""
+
+import threading
+try: import simplejson as json
+except ImportError: import json
+
+DEFAULT_BATCH_SIZE = 100 # repos per query. GitHub allows up to 500,000 nodes per query, so this is about keeping each answer quick
+
+
+class GraphQLError(Exception):
+    pass
+
+
+class GraphQL(object):
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+
+    """ Run a query, and return the "data" part of the answer. Errors raise GraphQLError, except that
+        with allow_not_found, things that don't exist are just null in the data. """
+    def query(self, query, variables=None, allow_not_found=False):
+        response = self.session.post(self.url, data=json.dumps({"query" : query, "variables" : variables or dict()}),
+                                     headers={"Content-Type" : "application/json"})
+        if response.status_code != 200:
+            raise GraphQLError("GraphQL query failed with status %d: %s" % (response.status_code, response.text[:200]))
+        result = response.json()
+        errors = [error for error in result.get("errors") or [] if not (allow_not_found and error.get("type") == "NOT_FOUND")]
+        if errors:
+            raise GraphQLError("GraphQL query failed: %s" % "; ".join(error.get("message", "") for error in errors))
+        return result.get("data") or dict()
+
+    """ Look up the repos called names in the org (or user) owner, batch_size repos per query. fields is
+        what to ask about each repo: the inside of a selection on a Repository, e.g. "pushedAt isEmpty".
+        Returns a dict from repo name to what GitHub said about it, or None if there is no such repo. """
+    def repositories(self, owner, names, fields, batch_size=DEFAULT_BATCH_SIZE):
+        names = sorted(set(names))
+        results = dict()
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            selections = "\n".join("  r%d: repository(owner: $owner, name: %s) { %s }" % (i, json.dumps(name), fields) for i, name in enumerate(batch))
+            data = self.query("query($owner: String!) {\n%s\n}" % selections, {"owner" : owner}, allow_not_found=True)
+            for i, name in enumerate(batch):
+                results[name] = data.get("r%d" % i)
+        return results
+
+    # every member of the org, as {"login", "name"} (name is None if they haven't set one), 100 per query. only asks for
+    # what a token with the read:org scope may see (e.g. not email, which needs user:email)
+    def organization_members(self, org):
+        members = []
+        after = None
+        while True:
+            data = self.query("""query($org: String!, $after: String) {
+  organization(login: $org) {
+    membersWithRole(first: 100, after: $after) { pageInfo { hasNextPage endCursor } nodes { login name } }
+  }
+}""", {"org" : org, "after" : after})
+            page = data["organization"]["membersWithRole"]
+            members.extend({"login" : node["login"], "name" : node["name"] or None} for node in page["nodes"])
+            if not page["pageInfo"]["hasNextPage"]:
+                return members
+            after = page["pageInfo"]["endCursor"]
+
+
+# a question about a repo is a tuple, (kind, branch, argument): how to ask it in GraphQL, and what to make of the answer
+def _selection(alias, question):
+    kind, branch, argument = question
+    if kind == "head":
+        return '%s: ref(qualifiedName: %s) { target { oid } }' % (alias, json.dumps("refs/heads/" + branch))
+    if kind == "top_level":
+        return '%s: object(expression: %s) { ... on Tree { entries { name } } }' % (alias, json.dumps(branch + ":"))
+    if kind == "file": # a directory is a Tree, which gives {} here
+        return '%s: object(expression: %s) { ... on Blob { oid } }' % (alias, json.dumps("%s:%s" % (branch, argument)))
+    if kind == "before":
+        return '%s: ref(qualifiedName: %s) { target { ... on Commit { history(first: 1, until: %s) { nodes { oid } } } } }' % \
+            (alias, json.dumps("refs/heads/" + branch), json.dumps(argument))
+    raise ValueError("Unknown question %s" % kind)
+
+def _answer(question, value):
+    kind = question[0]
+    if kind == "head":
+        return value["target"]["oid"] if value else None
+    if kind == "top_level":
+        return sorted(entry["name"] for entry in value["entries"]) if value and "entries" in value else None
+    if kind == "file":
+        return value is not None and "oid" in value
+    if kind == "before":
+        nodes = value["target"].get("history", dict()).get("nodes") if value else None
+        return nodes[0]["oid"] if nodes else None
+
+
+""" Small questions about the repos of one owner (an org), answered for up to batch_size repos per GraphQL
+    query and remembered until forget is called for the repo, e.g. after writing to it. Any of them can be
+    asked about a single repo, which costs one query, but the point is to prefetch the answers for all
+    the repos that a loop over the groups is going to ask about, so that the loop makes no requests. """
+class RepoQueries(object):
+
+    def __init__(self, graphql, owner, batch_size=DEFAULT_BATCH_SIZE):
+        self.graphql = graphql
+        self.owner = owner
+        self.batch_size = batch_size
+        self._answers = dict() # (repo name, question) -> answer
+        self._lock = threading.Lock()
+
+    """ Ask, in as few queries as possible, whatever hasn't been answered yet out of: where branch is (heads),
+        what is at the top of it (top_level), whether there is a file at each of files on it, and what the latest commit
+        on it at or before commits_before was, for each of the repos called names. """
+    def prefetch(self, names, heads=False, top_level=False, files=(), commits_before=None, branch="master"):
+        questions = [("head", branch, None)] if heads else []
+        questions += [("top_level", branch, None)] if top_level else []
+        questions += [("file", branch, path) for path in files]
+        questions += [("before", branch, commits_before)] if commits_before else []
+        with self._lock:
+            names = [name for name in set(names) if any((name, question) not in self._answers for question in questions)]
+        if not names or not questions:
+            return
+        fields = " ".join(_selection("q%d" % i, question) for i, question in enumerate(questions))
+        found = self.graphql.repositories(self.owner, names, fields, batch_size=self.batch_size)
+        with self._lock:
+            for name, repo in found.items():
+                for i, question in enumerate(questions):
+                    self._answers[(name, question)] = _answer(question, repo.get("q%d" % i) if repo else None)
+
+    def _ask(self, name, question, **prefetch_arguments):
+        with self._lock:
+            if (name, question) in self._answers:
+                return self._answers[(name, question)]
+        self.prefetch([name], branch=question[1], **prefetch_arguments)
+        with self._lock:
+            return self._answers.get((name, question))
+
+    # the sha of the commit at the tip of branch, or None if there is no such branch (or no such repo)
+    def head(self, name, branch="master"):
+        return self._ask(name, ("head", branch, None), heads=True)
+
+    # the sorted names of the files and directories at the top of branch, or None if there is no such branch
+    def top_level(self, name, branch="master"):
+        return self._ask(name, ("top_level", branch, None), top_level=True)
+
+    # whether there is a file (not a directory) at path on branch
+    def file_exists(self, name, path, branch="master"):
+        return bool(self._ask(name, ("file", branch, path), files=[path]))
+
+    # the sha of the latest commit on branch that was committed at or before until (a time as GitHub writes them), or None
+    def last_commit_before(self, name, until, branch="master"):
+        return self._ask(name, ("before", branch, until), commits_before=until)
+
+    # the repo has changed, so the answers about it are out of date
+    def forget(self, name):
+        with self._lock:
+            for key in [key for key in self._answers if key[0] == name]:
+                del self._answers[key]
@@ -2,6 +2,11 @@ from utils import *
 from rubrics import check_for_bonus, BONUS_ALIAS, DEFAULT_GRADES_FORM_SYMBOL
 from collections import defaultdict
 
+# what calculate_cohort_grades found in each form
+GRADED = "graded"
+NOT_GRADED = "not graded" # the TA left the first exercise they did not fill in ungraded: presumably not submitted, so the grade is 0
+INVALID = "invalid" # something in the form is not a non-negative number (or the form is not valid JSON, or nothing in it counts towards the total), so there is no grade
+
 # just totals up the assignment
 # grades is a dict from exercise names to final grades
 # FOR A PARTICULAR STUDENT OVER ALL ASSESSMENTS
@@ -40,6 +45,7 @@ def calculate_overall_course_grade_and_create_report(grades, course_config):
 # In: grades (dict) for a particular student, as read from a json marks form
 # Out: report (string)
 # if weights_dict is not provided, then the report will not show the weights, or subtotals or a total
+# to get the grades of a whole class without making reports, use calculate_cohort_grades (below) instead
 # FOR A PARTICULAR STUDENT AND A PARTICULAR ASSESSMENT
 def calculate_single_assessment_grade_and_create_report(raw_grades, weights_dict, grades_mapping, rubric_images=None, score_only=True):
 
@@ -194,3 +200,116 @@ def calculate_single_assessment_grade_and_create_report(raw_grades, weights_dict
 
     # don't round the assessment_overall_grade here because it will still be used in further calculations
     return {"report" : s_out, "grade" : assessment_overall_grade, "grades" : grades_dict}
+
+
+# In: forms, a dict from group names to the grades read from their json marks forms (or None if a form could
+#     not be read), and the weights and grade mapping for the assessment, as for calculate_single_assessment_grade_and_create_report
+# Out: {"groups" : list of the group names, "exercises" : list of the exercise names in the order they appear in the forms,
+#       "grade" : array with the grade of each group (NaN if INVALID, 0 if NOT_GRADED),
+#       "grades" : groups x exercises array of the grade of each exercise (NaN if the group has no grade for it),
+#       "status" : array with GRADED, NOT_GRADED or INVALID for each group}
+# The numbers are the same as calculate_single_assessment_grade_and_create_report's, but worked out for the whole
+# cohort at once on a groups x rubric rows array, and without making any reports.
+# FOR ALL STUDENTS AND A PARTICULAR ASSESSMENT
+def calculate_cohort_grades(forms, weights_dict, grades_mapping):
+    import numpy as np # only when grading, so that the other modes start quickly
+
+    groups = list(forms)
+
+    # the rubric rows of all forms, and where each value goes. also remember the order of the exercises in each
+    # form, since the first exercise that is ungraded or invalid decides what happens to the whole form.
+    exercises = OrderedDict() # exercise name -> column
+    rows = OrderedDict() # (exercise name, rubric name) -> column
+    cells = [] # (group index, row, value)
+    exercise_position = [] # (group index, exercise column, position in the form)
+    unreadable = np.zeros(len(groups), dtype=bool)
+    for g, group in enumerate(groups):
+        raw_grades = forms[group]
+        if raw_grades is None:
+            unreadable[g] = True
+            continue
+        position = 0
+        for exercise_name, exercise_grades in raw_grades.items():
+            if exercise_name == OVERALL_FEEDBACK_STR:
+                continue
+            e = exercises.setdefault(exercise_name, len(exercises))
+            exercise_position.append((g, e, position))
+            position += 1
+            for ev, value in exercise_grades.items():
+                if ev in ("feedback", "is_bonus"):
+                    continue
+                cells.append((g, rows.setdefault((exercise_name, ev), len(rows)), value))
+
+    num_groups, num_exercises, num_rows = len(groups), len(exercises), len(rows)
+
+    # per rubric row: which exercise it belongs to, its weight, and whether it is the bonus rubric
+    row_exercise = np.array([exercises[exercise_name] for exercise_name, _ in rows], dtype=int)
+    row_is_alias = np.array([ev == BONUS_ALIAS for _, ev in rows], dtype=bool)
+    row_weight = np.array([weights_dict[exercise_name][ev] for exercise_name, ev in rows], dtype=float)
+    exercise_is_bonus = np.array([bool(weights_dict[exercise_name].get("is_bonus", False)) or check_for_bonus(exercise_name) for exercise_name in exercises], dtype=bool)
+    row_to_exercise = np.zeros((num_rows, num_exercises))
+    row_to_exercise[np.arange(num_rows), row_exercise] = 1
+
+    # groups x rows: the scores, and which cells are there at all, ungraded, or not a non-negative number
+    score = np.zeros((num_groups, num_rows))
+    present = np.zeros((num_groups, num_rows), dtype=bool)
+    ungraded = np.zeros((num_groups, num_rows), dtype=bool)
+    invalid = np.zeros((num_groups, num_rows), dtype=bool)
+    for g, r, value in cells:
+        present[g, r] = True
+        if value == DEFAULT_GRADES_FORM_SYMBOL:
+            ungraded[g, r] = True
+            continue
+        try:
+            score[g, r] = float(value) # in case the TA writes "2" instead of 2, the code works anyway
+        except (TypeError, ValueError):
+            invalid[g, r] = True
+    invalid |= present & ~ungraded & ~invalid & (score < 0)
+
+    # the rubric rows that count: the bonus rubric is left out when it is 0
+    counted = present & ~ungraded & ~invalid & ~(row_is_alias & (score == 0))
+    if grades_mapping is not None:
+        scaled = np.zeros_like(score)
+        for value in np.unique(score[counted]):
+            scaled[counted & (score == value)] = grades_mapping[value]
+    else:
+        scaled = score
+    numerator = np.where(counted, scaled, 0.0)
+    denominator = np.where(counted & ~row_is_alias, row_weight, 0.0) # the bonus rubric doesn't add to the denominator
+
+    # groups x exercises
+    exercise_numerator = numerator @ row_to_exercise
+    exercise_denominator = denominator @ row_to_exercise
+    exercise_present = np.zeros((num_groups, num_exercises), dtype=bool)
+    position = np.full((num_groups, num_exercises), np.inf)
+    for g, e, p in exercise_position:
+        exercise_present[g, e] = True
+        position[g, e] = p
+    exercise_ungraded = (ungraded @ row_to_exercise) > 0
+    exercise_invalid = (invalid @ row_to_exercise) > 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exercise_grades = np.where(exercise_denominator == 0, exercise_numerator, exercise_numerator/exercise_denominator)
+        exercise_grades[~exercise_present] = np.nan
+        total_numerator = exercise_numerator.sum(axis=1)
+        total_denominator = np.where(exercise_is_bonus, 0.0, exercise_denominator).sum(axis=1)
+        grade = total_numerator/total_denominator*100.0
+
+    # the first exercise (in the order of the form) with an ungraded or invalid rubric decides: invalid beats ungraded
+    flagged_position = np.where(exercise_ungraded | exercise_invalid, position, np.inf)
+    any_flagged = np.isfinite(flagged_position).any(axis=1)
+    first_flagged_is_invalid = np.zeros(num_groups, dtype=bool)
+    if num_exercises > 0:
+        first_flagged_is_invalid = exercise_invalid[np.arange(num_groups), flagged_position.argmin(axis=1)]
+    is_invalid = unreadable | (any_flagged & first_flagged_is_invalid)
+    is_not_graded = any_flagged & ~is_invalid
+    # a fully graded form with nothing in the denominator (e.g. only bonus exercises) has no grade either.
+    # calculate_single_assessment_grade_and_create_report fails on those with a ZeroDivisionError
+    is_invalid |= ~is_not_graded & (total_denominator == 0)
+
+    grade[is_not_graded] = 0
+    grade[is_invalid] = np.nan
+    exercise_grades[is_not_graded | is_invalid] = np.nan
+    status = np.where(is_invalid, INVALID, np.where(is_not_graded, NOT_GRADED, GRADED))
+
+    return {"groups" : groups, "exercises" : list(exercises), "grade" : grade, "grades" : exercise_grades, "status" : status}
@@ -0,0 +1,143 @@
+"""
+A persistent HTTP cache for the GitHub API, built on conditional requests.
+
+GitHub answers a request that carries the ETag (or Last-Modified date) of a response we already
+have with 304 Not Modified, and those answers do not count against the rate limit. CachingAdapter
+sits under the requests session that github3 uses. It keeps the last 200 response for every GET on
+disk, sends If-None-Match / If-Modified-Since with the next GET for the same URL, and on a 304
+hands back the stored response as if it had just been downloaded. The cache is kept under a size
+limit by throwing away the least recently used responses (with caches.LRUFiles, like the blob store).
+"""
+
+import os
+import base64
+import hashlib
+import tempfile
+import threading
+try: import simplejson as json
+except ImportError: import json
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from caches import LRUFiles
+
+# bigger responses are not worth keeping (file contents are kept in the blob store anyway)
+MAX_ENTRY_BYTES = 2**20
+
+DEFAULT_HTTP_CACHE_MB = 256
+
+
+class CachingAdapter(BaseAdapter):
+
+    def __init__(self, directory, inner, max_bytes=DEFAULT_HTTP_CACHE_MB*2**20):
+        super(CachingAdapter, self).__init__()
+        self.directory = directory
+        self.inner = inner # the adapter that actually talks to the server
+        self.max_bytes = max_bytes
+        self.requests = 0 # GETs that could have been answered from the cache
+        self.hits = 0 # ... and the ones that were
+        self._files = LRUFiles(directory, max_bytes, suffix=".json")
+        self._lock = threading.Lock()
+
+    # different users (tokens) and different media types get different entries
+    def _key(self, request):
+        authorization = request.headers.get("Authorization", "")
+        key = "\n".join((request.url, request.headers.get("Accept", ""), hashlib.sha1(authorization.encode()).hexdigest()))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, key):
+        return self._files.path(key)
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # mark a stored response as recently used
+    def _touch(self, key):
+        with self._lock:
+            self._files.used(key)
+
+    def _store(self, key, response):
+        if len(response.content) > MAX_ENTRY_BYTES:
+            return
+        entry = {
+            "url" : response.url,
+            "status" : response.status_code,
+            "headers" : dict(response.headers),
+            "body" : base64.b64encode(response.content).decode("ascii")
+        }
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._files.added(key, size)
+
+    # rebuild the stored response, keeping the fresh headers of the 304 (e.g. the rate limit ones)
+    def _replay(self, entry, request, not_modified):
+        response = Response()
+        response.status_code = entry["status"]
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        for header in ("Date", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset"):
+            if header in not_modified.headers:
+                response.headers[header] = not_modified.headers[header]
+        response._content = base64.b64decode(entry["body"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = entry["url"]
+        response.request = request
+        response.elapsed = not_modified.elapsed
+        response.connection = self
+        return response
+
+    def send(self, request, **kwargs):
+        # only plain GETs are cached. leave alone anything streamed, or that already is a conditional request
+        # (e.g. github3 iterators that were given an etag)
+        if request.method != "GET" or kwargs.get("stream") or \
+                "If-None-Match" in request.headers or "If-Modified-Since" in request.headers:
+            return self.inner.send(request, **kwargs)
+
+        key = self._key(request)
+        entry = self._load(key)
+        if entry is not None:
+            etag = CaseInsensitiveDict(entry["headers"]).get("ETag")
+            last_modified = CaseInsensitiveDict(entry["headers"]).get("Last-Modified")
+            if etag:
+                request.headers["If-None-Match"] = etag
+            elif last_modified:
+                request.headers["If-Modified-Since"] = last_modified
+
+        response = self.inner.send(request, **kwargs)
+
+        with self._lock:
+            self.requests += 1
+            if response.status_code == 304 and entry is not None:
+                self.hits += 1
+        if response.status_code == 304 and entry is not None:
+            self._touch(key)
+            return self._replay(entry, request, response)
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self._store(key, response)
+        return response
+
+    def close(self):
+        self.inner.close()
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.hits = 0
+
+    def report(self):
+        with self._lock:
+            requests, hits = self.requests, self.hits
+        return "HTTP cache: %d of %d GET requests (%.0f%%) were not modified and served from the local cache (these do not count against the rate limit)." % \
+            (hits, requests, 100.0*hits/requests if requests else 0)
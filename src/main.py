@@ -6,16 +6,18 @@ Mike Gelbart, 2016.
 
 import github3 # docs at http://github3.readthedocs.io/en/develop/api.html
 from github3 import GitHubEnterprise
+from requests.adapters import HTTPAdapter
 from github3.models import __timeformat__ as gh3_time_fmt
 
-import pandas as pd
-import numpy as np
+# pandas and numpy take a while to import, so they are only imported by the methods that need them
 import os
 import os.path
 import sys
 import operator
 import functools
+import inspect
 import base64
+import tarfile
 try: import simplejson as json
 except ImportError: import json
 import argparse
@@ -30,6 +32,13 @@ from io import StringIO
 # import snipgen
 import grades
 import rubrics
+from fanout import FanOut, FanOutError, DEFAULT_MAX_WORKERS
+from http_cache import CachingAdapter, DEFAULT_HTTP_CACHE_MB
+from scheduler import SchedulingAdapter, DEFAULT_WRITE_INTERVAL, DEFAULT_MAX_RETRIES
+from tracing import Tracer, TracingAdapter
+from github_graphql import GraphQL, RepoQueries
+from caches import TreeCache, BlobStore, OrgSnapshot, LazyOrgIndex, TabulationManifest, RubricCache, OpenIssueIndex, NameDirectory, \
+    DEFAULT_BLOB_CACHE_MB, DEFAULT_SNAPSHOT_TTL_HOURS, DEFAULT_NAMES_TTL_HOURS
 from utils import *
 
 import pdb
@@ -48,6 +57,56 @@ class Goatcabin(object):
         # log in to GHE
         self.ghe = GitHubEnterprise(config["url"], token=token)
 
+        self.cache_dir = config.get("cache-dir", DEFAULT_CACHE_DIR)
+
+        # if tracing, API calls, Goatcabin methods and per-group work are timed as spans (see tracing.py)
+        self.tracer = Tracer(enabled=bool(config.get("trace")))
+
+        # per-group work is spread over a pool of threads. make sure there are enough connections for all of them
+        max_workers = config.get("max-workers", DEFAULT_MAX_WORKERS)
+        self.fanout = FanOut(max_workers, tracer=self.tracer)
+        adapter = HTTPAdapter(pool_connections=max(10, max_workers), pool_maxsize=max(10, max_workers))
+
+        # every API call goes through the scheduler, which paces writes, waits out rate limits and retries
+        self.scheduler = SchedulingAdapter(adapter, write_interval=config.get("write-interval", DEFAULT_WRITE_INTERVAL),
+            max_retries=config.get("max-retries", DEFAULT_MAX_RETRIES))
+        adapter = self.scheduler
+
+        # GETs are sent as conditional requests, and "304 Not Modified" answers are served from disk
+        if config.get("http-cache", True):
+            self.http_cache = CachingAdapter(os.path.join(self.cache_dir, "http"), inner=adapter,
+                max_bytes=config.get("http-cache-mb", DEFAULT_HTTP_CACHE_MB)*2**20)
+            adapter = self.http_cache
+        else:
+            self.http_cache = None
+
+        # outermost, so that the spans show what the caller waited for, from the cache or not
+        if self.tracer.enabled:
+            adapter = TracingAdapter(adapter, self.tracer)
+        self.ghe.session.mount(config["url"], adapter)
+
+        # for questions about many repos at once. on GitHub Enterprise the GraphQL API is at /api/graphql
+        self.graphql = GraphQL(self.ghe.session, config.get("graphql-url", config["url"].rstrip("/") + "/api/graphql"))
+
+        # whether repos are empty, whether files exist in them and so on, answered up to 100 repos per query
+        self.repo_queries = RepoQueries(self.graphql, config["org"])
+
+        # trees of the repos we look at, so that we only download each one once per run
+        self.trees = TreeCache()
+
+        # the open issues of the repos we open issues in, listed once per repo
+        self.open_issues = OpenIssueIndex()
+
+        # file contents we have downloaded before, in this run or previous ones
+        self.blobs = BlobStore(os.path.join(self.cache_dir, "blobs"), max_bytes=config.get("blob-cache-mb", DEFAULT_BLOB_CACHE_MB)*2**20)
+
+        # the grades worked out by previous tabulations, by the blob shas of the forms they came from
+        self.tabulation = TabulationManifest(os.path.join(self.cache_dir, "tabulation", "%s_%s_%s.json" % \
+            (urllib.parse.urlparse(config["url"]).netloc, config["org"], config["grades-repo"])))
+
+        # grades forms and weights parsed from the main files of assessments, by the blob sha of the main file
+        self.rubric_cache = RubricCache(os.path.join(self.cache_dir, "rubrics"))
+
         # get MDS org
         self.org = self.ghe.organization(config["org"])
 
@@ -56,14 +115,51 @@ class Goatcabin(object):
         # remove whitespace from course name
         # self.config["name"] = ''.join(self.config["name"].split())
 
-        self.teams = {team.name : team for team in self.org.teams()}
-        self.repos = {repo.name : repo for repo in self.org.repositories()}
-        self.members = {member.login : member for member in self.org.members()}
+        # teams, repos and members are only fetched when they are looked up, and what we learn is kept in
+        # a snapshot for next time. paging through every repo in an org that has years of courses in it is slow.
+        if config.get("org-snapshot", True):
+            snapshot_path = os.path.join(self.cache_dir, "snapshots", "%s_%s.json" % (urllib.parse.urlparse(config["url"]).netloc, config["org"]))
+            self.snapshot = OrgSnapshot(snapshot_path, ttl_hours=config.get("snapshot-ttl-hours", DEFAULT_SNAPSHOT_TTL_HOURS))
+        else:
+            self.snapshot = None
+        # before something is created because it isn't there, what the snapshot says is checked with GitHub (revalidate, see exists)
+        fetch_repo = lambda repo_name: self.ghe.repository(config["org"], repo_name) or None # github3 gives a (falsy) NullObject for a 404
+        self.teams = LazyOrgIndex("teams", lambda: ((team.name, team) for team in self.org.teams()),
+            from_json=lambda j: github3.orgs.Team(j, self.ghe), snapshot=self.snapshot,
+            revalidate=lambda team_name, team: self._current_team(team_name, team))
+        self.repos = LazyOrgIndex("repos", lambda: ((repo.name, repo) for repo in self.org.repositories()),
+            from_json=lambda j: github3.repos.Repository(j, self.ghe), snapshot=self.snapshot,
+            fetch_one=fetch_repo, revalidate=lambda repo_name, repo: fetch_repo(repo_name))
+        self.members = LazyOrgIndex("members", lambda: ((member.login, member) for member in self.org.members()),
+            from_json=lambda j: github3.users.User(j, self.ghe), snapshot=self.snapshot,
+            revalidate=lambda login, member: member if self.org.is_member(login) else None)
         # above: if you call memeber.refresh() it is slow, but has more info...!!!!
 
-        user = self.ghe.me()
-        self.userstr = user_to_str(user)
-        self.usercwl = user.login
+        # people's display names, kept between runs and filled in from one listing of all the org's members (see display_name)
+        self.names = NameDirectory(os.path.join(self.cache_dir, "names", "%s_%s.json" % (urllib.parse.urlparse(config["url"]).netloc, config["org"])),
+            ttl_hours=config.get("names-ttl-hours", DEFAULT_NAMES_TTL_HOURS))
+        self._listed_member_names = False
+
+        # who we are. the name directory remembers which login the token belongs to, so this is only asked once in a while
+        login = self.names.login_for_token(token)
+        if login is None or login not in self.names:
+            user = self.ghe.me()
+            login = user.login
+            self.names.put(login, user.name)
+            self.names.put_token(token, login)
+        my_name = self.names.name(login)
+        self.userstr = user_to_str(login, my_name)
+        self.usercwl = login
+
+        # with local-mirror, the staff and grades repos (and, if asked for, the students' grades repos) are read and written
+        # in local clones, and what changed is pushed at the end of the run (see mirror.py)
+        if config.get("local-mirror", False):
+            from mirror import MirrorSet # gitpython is only needed for this
+            self.mirrors = MirrorSet(os.path.join(self.cache_dir, "mirrors", "%s_%s" % (urllib.parse.urlparse(config["url"]).netloc, config["org"])),
+                config.get("mirror-url", config["url"].rstrip("/") + "/{org}/{repo}.git"), config["org"], token,
+                (my_name or login, "%s@users.noreply.%s" % (login, urllib.parse.urlparse(config["url"]).netloc)))
+        else:
+            self.mirrors = None
 
         # load course config if possible
         if config["staff-repo"] in self.repos:
@@ -80,6 +176,67 @@ class Goatcabin(object):
 
         self.dry_run = dry_run
 
+        # every public method becomes a span. wrapping the bound methods of this instance only leaves the class alone
+        if self.tracer.enabled:
+            for name, attribute in vars(Goatcabin).items():
+                if not name.startswith("_") and inspect.isfunction(attribute):
+                    setattr(self, name, self.tracer.wrap(getattr(self, name), name))
+
+    # remember what we learned about the org (and the names of the people in it) for the next run
+    def save_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.save()
+        self.names.save()
+
+    """ The display name of login, or None if they haven't set one. Names come from the name directory. The first time
+        in a run that somebody isn't in it, all the org's members are listed with their names, a hundred per request,
+        so a whole cohort costs a few requests when the directory is cold and none when it is warm. """
+    def display_name(self, login):
+        if login not in self.names and not self._listed_member_names:
+            self._listed_member_names = True
+            for member in self.graphql.organization_members(self.config["org"]):
+                self.names.put(member["login"], member["name"])
+        if login not in self.names: # not a member of the org, e.g. an outside collaborator
+            user = self.ghe.user(login) or None # github3 gives a (falsy) NullObject for a 404
+            self.names.put(login, user.name if user else None)
+        return self.names.name(login)
+
+    # the reports are per run, and the same Goatcabin can be used for several runs
+    def print_http_report(self):
+        print(self.scheduler.report())
+        self.scheduler.reset()
+        if self.http_cache is not None:
+            print(self.http_cache.report())
+            self.http_cache.reset()
+
+    # commit and push everything that was written to the local mirrors, one commit per repo
+    def push_mirrors(self, message):
+        if self.mirrors is None:
+            return
+        failed = self.mirrors.push_all(message)
+        if failed:
+            print("WARNING: could not push to %s. The changes are in the local mirrors in %s, but will be thrown away the next time they are synced." % \
+                (", ".join(failed), self.mirrors.directory))
+
+    # the local mirror of repo, if it is one of the repos that are worked on locally, and None otherwise
+    def _mirror(self, repo, branch="master"):
+        if self.mirrors is None or repo is None or branch != "master":
+            return None
+        if repo.name in (self.config["staff-repo"], self.config["grades-repo"]) or \
+                (self.config.get("mirror-student-repos", False) and is_student_grades_repo_name(repo.name, self.config)):
+            return self.mirrors.get(repo.name)
+        return None
+
+    # print where the time went, and save the spans for chrome://tracing if the trace setting is a file name
+    def print_trace_report(self):
+        if not self.tracer.enabled:
+            return
+        print(self.tracer.summary())
+        if isinstance(self.config["trace"], str):
+            self.tracer.export_chrome_trace(self.config["trace"])
+            print("Saved a trace of this run to %s (open it in chrome://tracing or https://ui.perfetto.dev)." % self.config["trace"])
+        self.tracer.reset()
+
     @property
     def students_teams(self):
         if isinstance(self.config["students-team"], str):
@@ -121,14 +278,16 @@ class Goatcabin(object):
 
 
     def _file_exists(self, repo, filename):
-        repo_contents_info = self._get_all_files_in_repo_at_path(repo, get_contents=False)
-        return filename in repo_contents_info
+        if self._mirror(repo) is not None:
+            return filename in self._get_all_files_in_repo_at_path(repo, get_contents=False)
+        return self.repo_queries.file_exists(repo.name, filename)
 
 
     def _create_branch(self, repo, new_branch_name, source_branch_name="master"):
         if self.dry_run:
             print("DRY RUN: Now I would create a branch %s in repo %s." % (new_branch_name, repo.name))
             return
+        self.repo_queries.forget(repo.name)
 
         existing_branch = repo.branch(new_branch_name)
         if existing_branch:
@@ -153,48 +312,39 @@ class Goatcabin(object):
             print('DRY RUN: Now I would update the PR entitled "%s" in repo %s' % (title, repo.name))
             return
 
-        if not repo.branch(head):
+        head_sha = self.trees.head(repo, head)
+        if head_sha is None:
             print("Branch %s does not exist, therefore I can't create a PR from it. Aborting." % head)
+            return
 
-        # if the pull request already exists, update it
-        for existing_PR in repo.pull_requests(state="open"):
-            if existing_PR.as_dict()["title"] == title: # "hopefully you can't have multiple PR's the the same title... but you probably can :("
-                # TODO: need a better way of checking equality. Perhaps the base and head. yes i think so
-                print('FYI: an open pull request with title "%s" in repo %s already exists.' % (title, repo.name))
-
-                if existing_PR.as_dict()["head"]["sha"] == repo.branch(head).latest_sha().decode("UTF-8"):
-                    print("The latest sha of this PR matches the latest sha of the branch %s, so this PR is vacuous (I think). Skipping." % head)
-                    return
+        # if the pull request already exists, update it. there can only be one open pull request from head to base
+        for existing_PR in repo.pull_requests(state="open", head="%s:%s" % (repo.owner.login, head), base=base):
+            print('FYI: an open pull request from %s to %s in repo %s already exists.' % (head, base, repo.name))
 
-                PR = existing_PR.update(title=title, body=message) # or could call with no arguments, that would work too
-                if PR:
-                    print("Successfully updated Pull Request in %s from branch %s to %s" % (repo.name, head, "master"))
-                else:
-                    print("Failed to update Pull Request in %s from branch %s to %s" % (repo.name, head, "master"))
+            if existing_PR.as_dict()["head"]["sha"] == head_sha:
+                print("The latest sha of this PR matches the latest sha of the branch %s, so this PR is vacuous (I think). Skipping." % head)
                 return
 
-        # Need to check if the two branches are actually different. Because if not then `create_pull` will throw an error.
-        # if repo.branch(UPDATES_BRANCH_NAME).latest_sha() == repo.branch("master").latest_sha():
-            # print("You are trying to create a PR from branch %s to master in %s, but these two branches are already in sync. Skipping." % (UPDATES_BRANCH_NAME, repo.name))
-            # return
-
-        # what might be even better than the above is to see if the sha of the head of the PR is anywhere in the history of master
-        # because if so it means the person probably already merged the PR and then made further edits. and in that case we don't want to do it.
-        # if repo.branch(UPDATES_BRANCH_NAME).latest_sha() == repo.branch("master").latest_sha():
-            # print("You are trying to create a PR from branch %s to master in %s, but these two branches are already in sync. Skipping." % (UPDATES_BRANCH_NAME, repo.name))
-            # return
-        # another approach is to explitly check all merged PRs.
-        # if repo.branch(UPDATES_BRANCH_NAME).latest_sha().decode("UTF-8") in (rc.sha for rc in repo.commits(sha="master")): # this works too
-        if next(repo.commits(sha=head, number=1)) in repo.commits(sha="master"): # sha="master" is optional as that's already the default
-            # above: compare the actual RepoCommit objects themselves, instead of the sha strings. High five! Ok no one cares.
-            print("You are trying to create a PR from branch %s to master in %s, but the latest commit of %s (%s) already exists in master's history. Skipping." % (head, repo.name, head, repo.branch(UPDATES_BRANCH_NAME).latest_sha()))
+            PR = existing_PR.update(title=title, body=message) # or could call with no arguments, that would work too
+            if PR:
+                print("Successfully updated Pull Request in %s from branch %s to %s" % (repo.name, head, base))
+            else:
+                print("Failed to update Pull Request in %s from branch %s to %s" % (repo.name, head, base))
+            return
+
+        # if the latest commit of head is already in the history of base, the student probably already merged the PR and then
+        # made further edits. in that case we don't want to do it (and if the branches are the same, create_pull would fail).
+        # one compare tells us, however long the history of base is
+        comparison = repo.compare_commits(base, head)
+        if comparison and comparison.status in ("identical", "behind"):
+            print("You are trying to create a PR from branch %s to %s in %s, but the latest commit of %s (%s) already exists in %s's history. Skipping." % (head, base, repo.name, head, head_sha, base))
             return
 
-        PR = repo.create_pull(title=title, base="master", head=head, body=message)
+        PR = repo.create_pull(title=title, base=base, head=head, body=message)
         if PR:
-            print("Successfully created Pull Request in %s from branch %s to %s" % (repo.name, head, "master"))
+            print("Successfully created Pull Request in %s from branch %s to %s" % (repo.name, head, base))
         else:
-            print("Failed to create Pull Request in %s from branch %s to %s" % (repo.name, head, "master"))
+            print("Failed to create Pull Request in %s from branch %s to %s" % (repo.name, head, base))
 
 
     def _create_file(self, repo, filename, file_contents, overwrite=False, branch="master"):
@@ -205,6 +355,10 @@ class Goatcabin(object):
         if self.dry_run:
             print("DRY RUN: Now I would create/update a file named %s in repo %s with contents:\n%s" % (filename, repo.name, file_contents))
             return
+        self.repo_queries.forget(repo.name)
+
+        if self._mirror(repo, branch) is not None:
+            return bool(self._create_files(repo, {filename : file_contents}, "Update %s." % os.path.basename(filename), overwrite=overwrite, branch=branch))
 
         # check if this is a new branch
         # branch_obj = repo.branch(branch) # get the branch
@@ -226,12 +380,12 @@ class Goatcabin(object):
                 if not isinstance(file_contents, bytes):
                     file_contents = bytes(file_contents, "UTF-8")
 
-                # check if the file has actually changed
-                old_contents = self._file_contents(repo, filename, ref=branch, decode=False)
-                if file_contents == old_contents:
+                # check if the file has actually changed (the tree already tells us the sha of the old contents)
+                if git_blob_sha(file_contents) == repo_contents_info[basename]:
                     # print("Skipping: %-30s: the old and new files are exactly the same in repository %s on branch %s" % (filename, repo.name, branch))
                     return False
                 output = repo.create_file(filename, "Update %s."%basename, file_contents, sha=repo_contents_info[basename] if repo_contents_info else None, branch=branch)
+                self._record_contents_api_write(repo, branch, output)
                 print("Attempted to overwrite contents of %s/%s on branch %s" % (repo.name, filename, branch))
                 # (above) for some reason the output seems to be None when overwriting a file, not sure why...
                 # else:
@@ -239,7 +393,9 @@ class Goatcabin(object):
         else:
             if not isinstance(file_contents, bytes):
                 file_contents = bytes(file_contents, "UTF-8")
-            if repo.create_file(filename, "Create %s."%basename, file_contents, branch=branch):
+            output = repo.create_file(filename, "Create %s."%basename, file_contents, branch=branch)
+            self._record_contents_api_write(repo, branch, output)
+            if output:
                 print("Successfully created new file %s/%s on branch %s" % (repo.name, filename, branch))
                 return True
             else:
@@ -248,16 +404,137 @@ class Goatcabin(object):
 
         return True # not exactly right... ca nwe read output somehow?
 
+    # keep the tree cache up to date after writing a file through the contents API
+    def _record_contents_api_write(self, repo, branch, output):
+        if output and output.get("commit") and output.get("content") and output["commit"].parents:
+            commit = output["commit"]
+            self.trees.record_commit(repo, branch, commit.parents[0]["sha"], commit.sha, commit.tree.sha, {output["content"].path : output["content"].sha})
+        else: # e.g. the first commit in a repo, or the output went missing. the tree will be refetched next time
+            self.trees.invalidate(repo, branch)
+
+    # Create/update many files in a repo with a single commit. This goes through the Git Data API
+    # (build one tree, make one commit, move the branch ref once) instead of making one commit per file
+    # through the contents API like _create_file does.
+    # files: dict from path (in the repo) to contents (str or bytes)
+    # keep_existing: paths that are never overwritten, even with overwrite=True (e.g. grade forms that might have been filled in)
+    # Returns the list of paths that were actually written.
+    def _create_files(self, repo, files, message, overwrite=False, branch="master", keep_existing=()):
+        if repo is None:
+            print("Cannot create files because repo is None")
+            return []
+
+        if self.dry_run:
+            for filename, file_contents in files.items():
+                print("DRY RUN: Now I would create/update a file named %s in repo %s with contents:\n%s" % (filename, repo.name, file_contents))
+            return []
+        self.repo_queries.forget(repo.name)
+
+        files = {filename : file_contents if isinstance(file_contents, bytes) else bytes(file_contents, "UTF-8")
+                    for filename, file_contents in files.items()}
+        written = []
+
+        mirror = self._mirror(repo, branch)
+        if mirror is not None: # written to the local clone now, and pushed at the end of the run
+            for filename, file_contents in sorted(files.items()):
+                existing_contents = mirror.read(filename)
+                if existing_contents is not None:
+                    if not overwrite or filename in keep_existing:
+                        print("Skipping: %-30s already exists in repository %s on branch %s." % (filename, repo.name, branch))
+                        continue
+                    if existing_contents == file_contents: # the file has not actually changed
+                        continue
+                mirror.write(filename, file_contents, note=message)
+                written.append(filename)
+            if written:
+                print("Wrote %d file(s) to the local mirror of %s: %s" % (len(written), repo.name, message))
+            return written
+
+        ref = self._get_branch_ref(repo, branch)
+        if ref is None and branch == "master" and files:
+            # the Git Data API refuses to work on an empty repo, so the first file goes in through the contents API.
+            # that also creates the master branch for us.
+            first_filename = README if README in files else sorted(files)[0]
+            first_file_contents = files.pop(first_filename)
+            output = repo.create_file(first_filename, "Create %s." % os.path.basename(first_filename), first_file_contents, branch=branch)
+            self._record_contents_api_write(repo, branch, output)
+            if not output:
+                print("Failed to create new file %s/%s on branch %s" % (repo.name, first_filename, branch))
+                return []
+            written.append(first_filename)
+            ref = self._get_branch_ref(repo, branch)
+        if ref is None:
+            print("Branch %s does not exist in repo %s. Could not create files." % (branch, repo.name))
+            return written
+
+        # get the tree of the commit the ref points at (not just of the branch name, in case someone pushes in the meantime)
+        parent_sha = ref.object.sha
+        tree = self.trees.tree_at(repo, parent_sha)
+        if tree['truncated']:
+            print("Warning: there were too many files and not all were received through the GitHub API!")
+        existing_blobs = tree['blobs']
+
+        new_tree = []
+        for filename, file_contents in sorted(files.items()):
+            existing_blob = existing_blobs.get(filename)
+            if existing_blob:
+                if not overwrite or filename in keep_existing:
+                    print("Skipping: %-30s already exists in repository %s on branch %s." % (filename, repo.name, branch))
+                    continue
+                if existing_blob['sha'] == git_blob_sha(file_contents): # the file has not actually changed
+                    continue
+            tree_entry = {"path" : filename, "mode" : existing_blob['mode'] if existing_blob else "100644", "type" : "blob"}
+            try:
+                tree_entry["content"] = file_contents.decode("UTF-8") # text goes straight into the tree, no need for a separate blob
+            except UnicodeDecodeError: # e.g. an image
+                tree_entry["sha"] = repo.create_blob(base64.b64encode(file_contents).decode("ascii"), "base64")
+            new_tree.append(tree_entry)
+
+        if not new_tree:
+            return written
+
+        new_tree_obj = repo.create_tree(new_tree, base_tree=tree['tree'])
+        commit = repo.create_commit(message, new_tree_obj.sha, [parent_sha]) if new_tree_obj else None
+        if commit and ref.update(commit.sha):
+            print("Committed %d file(s) to %s on branch %s: %s" % (len(new_tree), repo.name, branch, message))
+            self.trees.record_commit(repo, branch, parent_sha, commit.sha, new_tree_obj.sha,
+                {tree_entry["path"] : tree_entry.get("sha") or git_blob_sha(files[tree_entry["path"]]) for tree_entry in new_tree})
+        else:
+            print("Failed to commit %d file(s) to %s on branch %s" % (len(new_tree), repo.name, branch))
+            return written
+
+        return written + [tree_entry["path"] for tree_entry in new_tree]
+
+    # the Reference for a branch, or None if it does not exist (or the repo is empty)
+    def _get_branch_ref(self, repo, branch):
+        try:
+            return repo.ref("heads/%s" % branch) or None
+        except github3.exceptions.ClientError: # 409 if the repo is empty
+            return None
+
     # repo: the repo
     # path: the path to the file in the repo
     # ref: the branch
     # decode: if true, *try* to decode from bytes type to string.
     def _file_contents(self, repo, path, ref=None, decode=True):
-        c1 = repo.file_contents(path, ref=ref)
-        if not c1:
+        # look up the sha of the file in the (cached) tree, and then get the contents by sha. or just read it, if we have a local mirror
+        mirror = self._mirror(repo, ref or "master")
+        tree = self.trees.get(repo, ref or "master") if mirror is None else None
+        if mirror is not None:
+            c2 = mirror.read(path)
+            if c2 is None:
+                print("The file %s/%s does not exist." % (repo.name, path))
+                return None
+        elif tree and path in tree['blobs']:
+            c2 = self._blob_contents(repo, tree['blobs'][path]['sha'])
+        elif tree and tree['truncated']: # the file might just be missing from the tree. ask for it directly
+            c1 = repo.file_contents(path, ref=ref)
+            if not c1:
+                print("The file %s/%s does not exist." % (repo.name, path))
+                return None
+            c2 = base64.b64decode(c1.content)
+        else:
             print("The file %s/%s does not exist." % (repo.name, path))
             return None
-        c2 = base64.b64decode(c1.content)
         if not decode:
             return c2
         else:
@@ -267,15 +544,19 @@ class Goatcabin(object):
                 return c2
             return c3
 
-    """ Check if repo is empty. Empty is defined as having no contents or only containing a README.md file. """
+    # the contents (bytes) of the blob with this sha. only downloaded if it isn't in the blob store already
+    def _blob_contents(self, repo, sha):
+        contents = self.blobs.get(sha)
+        if contents is None:
+            contents = repo.blob(sha).decoded
+            self.blobs.put(sha, contents)
+        return contents
+
+    """ Check if repo is empty. Empty is defined as having no contents or only containing a README.md file.
+        Call self.repo_queries.prefetch(..., top_level=True) first when checking many repos. """
     def _repo_is_empty(self, repo, branch="master"):
-        try:
-            tree = repo.tree(branch)
-        except github3.exceptions.ClientError:
-            return True
-        if len(tree.tree)==1 and tree.tree[0].path == README:
-            return True
-        return False
+        top_level = self.repo_queries.top_level(repo.name, branch)
+        return top_level is None or top_level == [README]
 
 
     """ Get all files in a Repository at a specific path (helper method)
@@ -288,30 +569,77 @@ class Goatcabin(object):
         if path and path[0] != "/": # if path non-empty, make sure it ends with "/"
             path += "/"
         data = dict()
-        try:
-            tree = repo.tree("%s?recursive=1" % branch)
-        except github3.exceptions.ClientError as e:
+        mirror = self._mirror(repo, branch)
+        if mirror is not None:
+            found = mirror.files(path) if get_contents else mirror.blob_shas(path)
+            return {elem_path[len(path):] if relative_path else elem_path : contents for elem_path, contents in found.items()}
+        tree = self.trees.get(repo, branch) # cached for the run; only refetched if the branch has moved
+        if tree is None:
             return dict() # return empty dict because repository is empty
-        tree = tree.as_dict()
         if tree['truncated']:
             print("Warning: there were too many files and not all were received through the GitHub API!")
-        for elem in tree['tree']:
-            if elem['path'].startswith(path):
-                if elem['type'] == 'blob':
-                    # get the actual contents
-                    contents = base64.b64decode(repo.file_contents(elem['path']).content) if get_contents else elem['sha']
-                    if relative_path:
-                        data[elem['path'][len(path):]] = contents
-                    else:
-                        data[elem['path']] = contents
+        for elem_path, blob in tree['blobs'].items():
+            if elem_path.startswith(path):
+                # get the actual contents
+                contents = self._blob_contents(repo, blob['sha']) if get_contents else blob['sha']
+                if relative_path:
+                    data[elem_path[len(path):]] = contents
+                else:
+                    data[elem_path] = contents
         return data
 
+    """ The contents (bytes) of the files at paths in repo, as a dict from path to contents. Files that don't exist are left out.
+        If many of them have never been downloaded before, the whole repo is downloaded as one archive instead of one
+        request per file, and everything in it goes into the blob store. """
+    def _get_files_in_bulk(self, repo, paths, branch="master"):
+        mirror = self._mirror(repo, branch)
+        if mirror is not None:
+            files = {path : mirror.read(path) for path in paths}
+            return {path : contents for path, contents in files.items() if contents is not None}
+        commit_sha = self.trees.head(repo, branch)
+        if commit_sha is None:
+            return dict()
+        tree = self.trees.tree_at(repo, commit_sha)
+        shas = {path : tree['blobs'][path]['sha'] for path in paths if path in tree['blobs']}
+        missing = set(sha for sha in shas.values() if sha not in self.blobs)
+        if len(missing) >= ARCHIVE_MIN_FILES:
+            wanted = set(shas)
+            for contents in self._read_archive(repo, commit_sha, keep=lambda path: path in wanted).values():
+                self.blobs.put(git_blob_sha(contents), contents)
+        # anything that was not in the archive is downloaded the usual way
+        return {path : self._blob_contents(repo, sha) for path, sha in shas.items()}
+
+    # the files in repo at commit ref for which keep(path) is true, as a dict from path to contents (bytes). the tarball
+    # is read as it streams in, and only the files we keep are held in memory (GitHub can't make an archive of just a directory)
+    def _read_archive(self, repo, ref, keep=lambda path: True):
+        response = self.ghe.session.get("%s/tarball/%s" % (repo._api, ref), stream=True)
+        if response.status_code != 200:
+            print("Failed to download %s as an archive. Getting the files one by one instead." % repo.name)
+            response.close()
+            return dict()
+        response.raw.decode_content = True
+        files = dict()
+        with tarfile.open(fileobj=response.raw, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile() or "/" not in member.name:
+                    continue
+                path = member.name.split("/", 1)[1] # everything is in a directory named after the repo and the commit
+                if keep(path):
+                    files[path] = archive.extractfile(member).read()
+        response.close()
+        return files
+
+    # the team (looked up by its id, from the snapshot) as it is now, or None if it was deleted or renamed
+    def _current_team(self, team_name, team):
+        current = self.org.team(team.id) or None
+        return current if current is not None and current.name == team_name else None
+
     def _create_team(self, team_name, privacy="closed"):
         if self.dry_run:
             print("DRY RUN: Now I would create a team %s" % (team_name))
             return
 
-        if team_name in self.teams:
+        if self.teams.exists(team_name):
             print("%-30s: team already exists." % team_name)
             return self.teams[team_name] # return the team since that's what this function is expected to do
 
@@ -328,7 +656,7 @@ class Goatcabin(object):
             print("DRY RUN: Now I would create a repo %s with private=%s" % (repo_name, private))
             return
 
-        if repo_name in self.repos:
+        if self.repos.exists(repo_name):
             print("Repo %s already exists... skipping." % (repo_name))
             return self.repos[repo_name] # return the repo since that's what this function is expected to do
         else:
@@ -346,13 +674,13 @@ class Goatcabin(object):
             print('DRY RUN: Now I would open an Issue entitled "%s" in repo %s' % (title, repo.name))
             return
 
-        if donotrepeat:
-            for existing_issue in repo.issues(state="open"):
-                if existing_issue.title == title: # and existing_issue.as_dict()['state']=="open":
-                    print('An open issue with title "%s" already exists in repo %s - skipping' % (title, repo.name))
-                    return
+        if donotrepeat and self.open_issues.find(repo, title) is not None:
+            print('An open issue with title "%s" already exists in repo %s - skipping' % (title, repo.name))
+            return
 
-        if repo.create_issue(title=title, body=body, labels=labels):
+        issue = repo.create_issue(title=title, body=body, labels=labels)
+        if issue:
+            self.open_issues.opened(repo, issue)
             print('Created issue "%s" in repository %s.' % (title, repo.name))
         else:
             print("Failed to create issue %s in repository %s." % (title, repo.name))
@@ -365,6 +693,7 @@ class Goatcabin(object):
         attributes = issue.as_dict()
         repo_name = attributes["repository_url"].split("/")[-1]
         if issue.close():
+            self.open_issues.closed(issue)
             print("Successfully closed issue #%d in %s with title %s" % (attributes["number"], repo_name, attributes["title"]))
         else:
             print("Failed to close close issue #%d in %s with title %s" % (attributes["number"], repo_name, attributes["title"]))
@@ -430,22 +759,27 @@ class Goatcabin(object):
             # lab_main_dir = os.path.split(self.course_config[aname]["main-file"])[0]
         source_repo_contents = self._get_all_files_in_repo_at_path(self.staff_repo, lab_main_dir)
 
-        for group in groups:
+        def gift_repo(group):
             # print("Gifting to %s" % group_to_pretty_str(group))
             repo_name = get_assessment_repo_name(group, self.config, aname)
             repo = self.repos[repo_name]
 
             # add content from course repo
-            for filename, file_contents_object in source_repo_contents.items():
-                self._create_file(repo, filename, file_contents_object, branch=branch, overwrite=overwrite)
+            files = dict(source_repo_contents)
 
             # add a README file
             readme_file_contents = '#%s\n\n%s %s for %s.\n\nTODO: improve this README file per the homework instructions.' % \
                 (repo_name, self.config["name"], aname, group_to_str(group))
-            self._create_file(repo, README, readme_file_contents, branch=branch, overwrite=overwrite)
+            files[README] = readme_file_contents
+
+            # everything goes in as a single commit
+            message = "%s %s for %s." % (self.config["name"], aname, group_to_str(group))
+            self._create_files(repo, files, message, branch=branch, overwrite=overwrite)
+
+        self.fanout.map(gift_repo, groups, "gift_repos")
 
     def create_updates_branches(self, groups, aname):
-        for group in groups:
+        def create_updates_branch(group):
             repo_name = get_assessment_repo_name(group, self.config, aname)
             repo = self.repos[repo_name]
 
@@ -458,6 +792,8 @@ class Goatcabin(object):
             # the instructor should be making commits to this branch. not that students were before,
             # but for future PRs we were branching off a ref that included their commits
 
+        self.fanout.map(create_updates_branch, groups, "create_updates_branches")
+
     def establish_and_save_student_groups(self, aname):
         if aname is None:
             raise Exception("Name cannot be None")
@@ -467,57 +803,26 @@ class Goatcabin(object):
         #     return self.load_student_groups(aname)
 
         all_logins = set(student.login for student in self.students)
+        logins_by_lowercase = defaultdict(list) # case-insensitivity, just to be nice
+        for login in all_logins:
+            logins_by_lowercase[login.lower()].append(login)
 
         # collect all partners
         partners = defaultdict(set)
-        for student in self.students:
-            repo_name = get_student_grades_repo_name(student.login, self.config)
-            repo = self.repos[repo_name]
-
-            for issue in repo.issues():
-                if get_partners_issue_title(aname) in issue.title:
-
-                    contents = issue.body
-                    requested_partners = contents.strip().split(",")
-
-                    if "max-group-size" in self.course_config[aname] and len(requested_partners) > self.course_config[aname]["max-group-size"]:
-                        print("%s requested a group larger than the max group size of %d for %s... ignoring." % (student.login, self.course_config[aname]["max-group-size"], aname))
-                        # do not honour the request
-                        continue
-                    for partner in requested_partners:
-                        # if partner in all_logins: # make sure this person is an actual student
-                        for lgn in all_logins:
-                            if partner.lower() == lgn.lower(): # case-insensitivity, just to be nice
-                                partners[student.login].add(lgn)
+        max_group_size = self.course_config[aname].get("max-group-size")
+        for login, request in self._get_partner_requests(aname, all_logins):
+            requested_partners = request.strip().split(",")
 
+            if max_group_size is not None and len(requested_partners) > max_group_size:
+                print("%s requested a group larger than the max group size of %d for %s... ignoring." % (login, max_group_size, aname))
+                # do not honour the request
+                continue
+            for partner in requested_partners:
+                for lgn in logins_by_lowercase.get(partner.lower(), ()): # make sure this person is an actual student
+                    partners[login].add(lgn)
 
         # form the actual groups
-        groups = list()
-        for cwl in all_logins:
-            if cwl in partners: # student asked for partners
-                if cwl in (member for group in groups for member in group): # this student already in a group -- skip. could cache this in a sepearate set for speed.
-                    # print("skipping %s because already in another group" % cwl)
-                    continue
-
-                # construct a list of the implied OVERALL GROUP implied by each student in this list
-                # and make sure these overall groups agree for all students
-                implied_group = partners[cwl] | {cwl}
-                for partner in partners[cwl]:
-                    if partner not in partners: # your request a partner but this person didn't request any partners
-                        groups.append((cwl,)) # you work alone
-                        print("%s requested partners but the partner %s did not request them back" % (cwl,partner))
-                        break
-
-                    if partners[partner] | {partner} != implied_group: # partners disagree on who's in the group
-                        groups.append((cwl,)) # you work alone
-                        print("%s requested partners but they did not reciprocate" % cwl)
-                        break
-                else:
-                    # success!
-                    groups.append(tuple(implied_group)) # use tuple instead of list in case the groups need to be hashable (as in a key of a dict)
-            else:
-                # the student did not request any partners
-                groups.append((cwl,)) # work alone
+        groups = form_groups(all_logins, partners)
 
         assert(set(member for group in groups for member in group) == all_logins)
 
@@ -527,6 +832,29 @@ class Goatcabin(object):
 
         return sorted(groups, key=group_to_str)
 
+    """ The partner requests for aname, as (login, issue body) for every open issue with <aname>_partner in its title
+        in the grades repo of one of logins. One search of the org's issues finds them all. GitHub only lets us see the
+        first 1000 results of a search, so if there are more than that, the issues of every grades repo are listed instead. """
+    def _get_partner_requests(self, aname, logins):
+        title = get_partners_issue_title(aname)
+        login_by_repo_name = {get_student_grades_repo_name(login, self.config) : login for login in logins}
+
+        results = self.ghe.search_issues('"%s" in:title org:%s type:issue state:open' % (title, self.config["org"]), per_page=100)
+        issues = []
+        for issue in results:
+            if results.total_count > SEARCH_RESULTS_LIMIT: # known as soon as the first page is in. don't bother with the rest
+                break
+            issues.append(issue)
+        if results.total_count <= SEARCH_RESULTS_LIMIT:
+            return [(login_by_repo_name[issue.issue.repository[1]], issue.issue.body or "") for issue in issues
+                    if issue.issue.repository[1] in login_by_repo_name and title in issue.issue.title] # the search is fuzzier than that
+
+        print("The search for %s issues found too many to page through (%d). Listing the issues of every grades repo instead." % (title, results.total_count))
+        def requests_in_repo(login):
+            repo = self.repos[get_student_grades_repo_name(login, self.config)]
+            return [(login, issue.body or "") for issue in repo.issues() if title in issue.title]
+        return [request for requests in self.fanout.map(requests_in_repo, sorted(logins), "_get_partner_requests").values() for request in requests]
+
     def load_student_groups(self, aname):
         groups_str = self._file_contents(self.grades_repo, "%s/groups.json" % aname)
         groups = json.loads(groups_str)
@@ -542,14 +870,15 @@ class Goatcabin(object):
 
         new_groups = []
         for group in groups:
-
-            # create repository
             repo_name = get_assessment_repo_name(group, self.config, aname)
-
-            if repo_name in self.repos:
+            if self.repos.exists(repo_name):
                 print("Repo %s already exists - skipping prepare_assessment" % repo_name)
-                continue
+            else:
+                new_groups.append(group) # don't re-gift if students already have it...
 
+        def prepare_repo(group):
+            # create repository
+            repo_name = get_assessment_repo_name(group, self.config, aname)
             repo = self._create_repo(repo_name, private=True)
             # repo.ignore() # ignore notifications ! otherwise all the PR merging sends lots of notifications
             # no longer doing this. workaround is to have a bot user open the PRs
@@ -560,10 +889,17 @@ class Goatcabin(object):
             # (above) "admin" allows TAs to close labs. but OTOH there's a fear of them getting too many notifications
             # if they are auto-watching repos.
 
-            new_groups.append(group) # don't re-gift if students already have it...
+        # only carry on with the groups whose repos were actually created. if some weren't, the others still get
+        # their contents, and then we stop
+        try:
+            new_groups, failed = list(self.fanout.map(prepare_repo, new_groups, "prepare_assessment")), None
+        except FanOutError as e:
+            new_groups, failed = list(e.results), e
 
         self.gift_repos(new_groups, aname)
         self.create_updates_branches(new_groups, aname) # these branches are protected
+        if failed is not None:
+            raise failed
 
         # DO NOT call copy_assessment_to_students_repo() here!!! otherwise if you prepare a quiz in advance they will see it too early. only do once assessment is actually opened
         # too bad there's inefficiency for getting all contents twice then, but has to be done this way.
@@ -576,7 +912,7 @@ class Goatcabin(object):
 
         # 2: create a PR from the updates branch to master
         current_time = datetime.strftime(datetime.now(), '%Y-%m-%d at %H:%M')
-        for group in groups:
+        def create_update_PR(group):
             repo_name = get_assessment_repo_name(group, self.config, aname)
             repo = self.repos[repo_name]
 
@@ -590,14 +926,18 @@ class Goatcabin(object):
                 (" @".join(group), self.config["name"], aname)
             self._create_pull_request(repo, title, body, "master", UPDATES_BRANCH_NAME)
 
+        self.fanout.map(create_update_PR, groups, "update_assessment_via_PR")
+
     """ Add students as a collaborators on their course repos """
     def add_students_as_collaborators(self, groups, aname, permission="push"):
-        for group in groups:
+        def add_group_as_collaborators(group):
             repo_name = get_assessment_repo_name(group, self.config, aname)
             repo = self.repos[repo_name]
             for student in group:
                 self._add_collaborator(repo, student, permission=permission)
 
+        self.fanout.map(add_group_as_collaborators, groups, "add_students_as_collaborators")
+
 
     # decided to have one per course, so that TAs can have read access (allowing them to push issues)
     # - b/c we don't want TAs to see grades from other courses
@@ -627,7 +967,7 @@ class Goatcabin(object):
     def create_course_config_file(self, ask_human=False):
         repo = self.staff_repo
 
-        default_config = DEFAULT_COURSE_CONFIG
+        default_config = load_default_course_config(self.config.get("default-course-config", DEFAULT_COURSE_CONFIG_FILENAME))
         default_config_str = json.dumps(default_config, indent=4)
 
         config_file_already_exists = self._file_exists(repo, COURSE_CONFIG_FILENAME)
@@ -657,6 +997,9 @@ class Goatcabin(object):
 
 
     def create_grades_csv(self):
+        import numpy as np
+        import pandas as pd
+
         grade_mapping = self.config.get("grade-mapping", None)
 
         # 0. read status.json
@@ -672,39 +1015,67 @@ class Goatcabin(object):
             if status_dict.get(aname, "n/a") in ("closed", "returned"):
                 # exercise_grades_df = self.student_info[[GRADES_DF_INDEX]]
 
-                # read in the weights
+                # forms that have not changed since the last tabulation are not graded again. the weights key
+                # stands for everything apart from the form that the grades depend on
                 weights_path = '%s/weights.json' % aname
-                weights_string = self._file_contents(self.grades_repo, weights_path)
-                weights = json.loads(weights_string)
-
-                grades_dict = dict()
-                individual_grades_dict = OrderedDict()
+                shas = self._get_all_files_in_repo_at_path(self.grades_repo, path=aname, get_contents=False, relative_path=False)
+                weights_key = "%s %s" % (shas.get(weights_path), json.dumps(grade_mapping, sort_keys=True))
 
                 ass_groups = self.load_student_groups(aname)
+                results = OrderedDict()
                 for group in ass_groups:
                     grades_path = "%s/forms/%s.json" % (aname, group_to_str(group))
-                    grades_string = self._file_contents(self.grades_repo, grades_path)
+                    results[group] = self.tabulation.get(aname, group_to_str(group), shas.get(grades_path), weights_key)
+
+                # the forms that did change are downloaded all at once
+                changed = [group for group, result in results.items() if result is None]
+                files = self._get_files_in_bulk(self.grades_repo, ["%s/forms/%s.json" % (aname, group_to_str(group)) for group in changed])
+                forms = OrderedDict()
+                for group in changed:
+                    grades_path = "%s/forms/%s.json" % (aname, group_to_str(group))
+                    if grades_path not in files:
+                        print("The file %s/%s does not exist." % (self.grades_repo.name, grades_path))
+                        forms[group] = None
+                        continue
                     try:
-                        student_grades = json.loads(grades_string, object_pairs_hook=OrderedDict)
-                    except json.decoder.JSONDecodeError as ex:
+                        forms[group] = json.loads(files[grades_path].decode("UTF-8"), object_pairs_hook=OrderedDict)
+                    except (UnicodeDecodeError, json.decoder.JSONDecodeError) as ex:
                         print("There is a problem with the JSON for %s %s: " % (aname, group), end="")
                         print(ex)
+                        forms[group] = None
                         # raise
-                    # need to convert all these grades from one assessment into a single score
-                    overall_assessment_grade = grades.calculate_single_assessment_grade_and_create_report(student_grades, weights, grade_mapping)["grade"]
-                    if overall_assessment_grade is None:
+
+                if forms:
+                    print("Grading %d of %d forms for %s (the others have not changed since the last tabulation)." % (len(forms), len(ass_groups), aname))
+
+                    # read in the weights
+                    weights_string = self._file_contents(self.grades_repo, weights_path)
+                    weights = json.loads(weights_string)
+
+                    # need to convert all these grades from one assessment into a single score. done for all groups at once
+                    cohort = grades.calculate_cohort_grades(forms, weights, grade_mapping)
+                    for i, group in enumerate(cohort["groups"]):
+                        results[group] = {
+                            "status" : str(cohort["status"][i]),
+                            "grade" : None if np.isnan(cohort["grade"][i]) else float(cohort["grade"][i]),
+                            "grades" : OrderedDict((exercise_name, float(grade)) for exercise_name, grade in zip(cohort["exercises"], cohort["grades"][i]) if not np.isnan(grade))
+                        }
+                        grades_path = "%s/forms/%s.json" % (aname, group_to_str(group))
+                        self.tabulation.put(aname, group_to_str(group), shas.get(grades_path), weights_key, results[group])
+
+                grades_dict = dict()
+                individual_grades_dict = OrderedDict()
+                for group, result in results.items():
+                    overall_assessment_grade = result["grade"]
+                    if result["status"] == grades.INVALID:
                         print("It seems like %s isn't completely graded yet for %s." % (aname, group_to_str(group)))
                         continue
                     if overall_assessment_grade == 0:
                         print("Note that %s got a grade of zero on %s" % (group_to_str(group), aname))
 
                     else: # get average grade for each question, but only include people who actually did it in the averages
-                        per_exercise_grades = grades.calculate_single_assessment_grade_and_create_report(student_grades, weights, grade_mapping)["grades"]
-                        for exercise_name, grade in per_exercise_grades.items():
-                            if exercise_name in individual_grades_dict:
-                                individual_grades_dict[exercise_name].append(grade)
-                            else:
-                                individual_grades_dict[exercise_name] = [grade]
+                        for exercise_name, grade in result["grades"].items():
+                            individual_grades_dict.setdefault(exercise_name, []).append(grade)
 
                     if CAP_INDIVIDUAL_ASSESSMENTS_AT_100:
                         overall_assessment_grade = min(overall_assessment_grade, 100)
@@ -752,27 +1123,47 @@ class Goatcabin(object):
         stats_table_str = "## %s grade statistics\n\n" % self.config["name"] + stats_table_str
 
         self._create_file(self.grades_repo, "stats.md", stats_table_str, overwrite=True)
-
+        self.tabulation.save()
+
+
+    """ The links in the README table of an assessment, worked out for all the groups before the table is made:
+        a dict from group to (the link to its submission, [the link to each member's report]). A submission
+        is only linked if its repo has something in it besides the README, and a report if it exists. Both
+        are asked about all the repos at once, in a few GraphQL queries, so making the rows costs nothing.
+        The reports are only looked for if report_filename is given. """
+    def _grades_readme_links(self, groups, aname, report_filename=None):
+        submission_repo_names = OrderedDict((group, get_assessment_repo_name(group, self.config, aname)) for group in groups)
+        self.repo_queries.prefetch(submission_repo_names.values(), top_level=True)
+        if report_filename is not None:
+            self.repo_queries.prefetch([get_student_grades_repo_name(cwl, self.config) for group in groups for cwl in group], files=[report_filename])
+
+        links = OrderedDict()
+        for group, repo_name in submission_repo_names.items():
+            # last_commit_sha = self.get_last_commit_before_due_date(course, aname, student)
+            submission_link = self._get_url_to_repo("submission", repo_name)#, particular_commit=last_commit_sha)
+            if report_filename is not None:
+                report_links = [self._get_url_to_file(cwl, get_student_grades_repo_name(cwl, self.config), file_name=report_filename) for cwl in group]
+            else:
+                report_links = []
+            links[group] = (submission_link, report_links)
+        return links
 
     # Create a Markdown table that will serve as the README.md file for the grades repository for a course FOR A PARTICULAR ASSESSMENT
     # report_filename is only used if report_column is True
     def create_grades_repo_readme(self, groups, aname, report_column=False, report_filename=None, get_actual_names=False):
+        links = self._grades_readme_links(groups, aname, report_filename=report_filename if report_column else None)
 
         readme_table = []
         for i, group in enumerate(groups):
-
-            # last_commit_sha = self.get_last_commit_before_due_date(course, aname, student)
-
-            submission_link = self._get_url_to_repo("submission", get_assessment_repo_name(group, self.config, aname))#, particular_commit=last_commit_sha)
+            submission_link, report_links = links[group]
             form_link = "[marks form](forms/%s.json)" % group_to_str(group)
             if get_actual_names:
-                actual_names = ", ".join(map(lambda m: self.members[m].refresh().name, group))
+                actual_names = ", ".join(self.display_name(m) or "" for m in group)
                 row = [i+1, ", ".join(group), actual_names, submission_link, form_link]
             else:
                 row = [i+1, ", ".join(group), submission_link, form_link]
             if report_column:
-                report_link = ", ".join(map(lambda cwl: self._get_url_to_file(cwl, get_student_grades_repo_name(cwl, self.config), file_name=report_filename), group))
-                row.append(report_link)
+                row.append(", ".join(report_links))
             readme_table.append(row)
         # pdb.set_trace()
         if get_actual_names:
@@ -918,36 +1309,48 @@ class Goatcabin(object):
 
         return assignments_dict
 
-    def calculate_late_days(self, group, aname):
-        repo_name = get_assessment_repo_name(group, self.config, aname)
-        repo = self.repos[repo_name]
+    """ When each group submitted aname: the time of the last push to its repo, or if there has never been
+        one, the time of the latest commit on the default branch. All the repos are looked up in a few
+        GraphQL queries, instead of going through the events of each repo (which expire) one by one.
+        Returns a dict from group string to {"repo", "submission" (UTC, as GitHub writes times), "commit"}.
+        Groups whose repo doesn't exist or has no commits are left out. """
+    def get_submission_times(self, groups, aname):
+        repo_names = OrderedDict((group_to_str(group), get_assessment_repo_name(group, self.config, aname)) for group in groups)
+        found = self.graphql.repositories(self.config["org"], repo_names.values(),
+            "pushedAt defaultBranchRef { target { ... on Commit { oid committedDate } } }")
+        submissions = OrderedDict()
+        for group_str, repo_name in repo_names.items():
+            repo = found.get(repo_name)
+            if repo is None:
+                print("Cannot find when %s was submitted because the repo does not exist" % repo_name)
+                continue
+            commit = (repo.get("defaultBranchRef") or dict()).get("target") or dict()
+            submitted = repo.get("pushedAt") or commit.get("committedDate")
+            if submitted is None:
+                print("Cannot find when %s was submitted because the repo has no commits" % repo_name)
+                continue
+            submissions[group_str] = {"repo" : repo_name, "submission" : submitted, "commit" : commit.get("oid")}
+        return submissions
 
+    # at close, when students can no longer push, so that return doesn't have to look them up again (or get a later time)
+    def record_submission_times(self, groups, aname):
+        submissions = self.get_submission_times(groups, aname)
+        self._create_file(self.grades_repo, "%s/%s" % (aname, SUBMISSIONS_FILENAME), json.dumps(submissions, indent=2), overwrite=True)
+        return submissions
+
+    # submitted is the time of the submission as GitHub writes times (see get_submission_times), or None if there was none
+    def calculate_late_days(self, aname, submitted):
         due_date_str = self.course_config[aname]["deadline"]
         due_date_obj = datetime.strptime(due_date_str, "%Y-%m-%d %H:%M").replace(tzinfo=tz.tzlocal())
-        
-        # find the last PushEvent
-        for e in repo.events():
-            # print(e.as_dict())
-            if e.type == "PushEvent":
-                submission_date_obj = e.created_at.astimezone(tz.tzlocal())
-                break
-        else:
-            # if no PushEvents were available, as a backup look at commits (since times GitHub seems
-            #   to not return Events, maybe they expire after some number of days?
-            #   it says 90 days but I'm experiencing faster expiry...)
-            cmt = next(repo.commits(number=1)) # assume this one it gives is the latest one...
-            cmt_date = cmt.commit.committer["date"] 
-            submission_date_obj = datetime.strptime(cmt_date, gh3_time_fmt).replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
-
-            # # raise Exception("It seems there were no PushEvents for %s" % repo_name)
-            # print("It seems there were no PushEvents for %s" % repo_name)
-            # return {
-            #    "deadline" : due_date_str,
-            #    "submission": "n/a",
-            #    "late days": 0
-            # }
 
-        
+        if submitted is None:
+            return {
+               "deadline" : due_date_str,
+               "submission": "n/a",
+               "late days": 0
+            }
+
+        submission_date_obj = datetime.strptime(submitted, gh3_time_fmt).replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
         submission_date_str = datetime.strftime(submission_date_obj, "%Y-%m-%d %H:%M")
 
         late_days = (submission_date_obj - due_date_obj).total_seconds()/3600/24
@@ -1001,41 +1404,83 @@ class Goatcabin(object):
                 " and ".join(urls), reviews_deadline, self.config["name"], self.config["org"], self.config["staff-team"], PEER_REVIEW_WEIGHT*100, aname)
             self._open_issue(reviewer_ass_repo, title=issue_title, body=issue_body)
 
-    def create_grade_forms(self, groups, aname):
-
+    """ The grades form and weights for an assessment, from the rubric snippets in its main file.
+        Parsing a big notebook takes a while, so the result is cached by the blob sha of the main file, and the main
+        file is only downloaded and parsed if it has changed since the last time. """
+    def compile_rubric(self, aname):
         main_file_name = self.get_assessment_main_file_name(aname)
-        print("Reading rubric snippets from %s" % main_file_name)
-
-        fcontents = self._file_contents(self.staff_repo, main_file_name)
-
         root, ext = os.path.splitext(main_file_name)
         doctype = "tex" if "tex" in ext else "md"
+        peer_review = self.course_config[aname].get("peer-review", False)
+        rubric_config, rubric_config_hash = rubrics.load_rubric_config(self.config.get("rubric-config", DEFAULT_RUBRIC_CONFIG_FILENAME))
+
+        main_file_sha = self._get_all_files_in_repo_at_path(self.staff_repo, get_contents=False).get(main_file_name)
+        key = "%s_%s_%s_%s" % (main_file_sha, rubric_config_hash, doctype, "peer" if peer_review else "nopeer")
+        cached = self.rubric_cache.get(key) if main_file_sha is not None else None
+        if cached is not None:
+            print("Using the rubric snippets read from %s before (it has not changed since)" % main_file_name)
+            return cached
+
+        print("Reading rubric snippets from %s" % main_file_name)
+        fcontents = self._file_contents(self.staff_repo, main_file_name)
         # snipgen.concatenate_for_assignment_inner(fcontents,is_ipynb,cfg=rubric_cfg,dry=False,concatenate=False,make_eval=True,files=get_stuff_dict)
-        grades_form_dict, rubric_weights = rubrics.parse_rubric_snippets(fcontents,
-            peer_review = self.course_config[aname].get("peer-review", False), doctype=doctype)
+        grades_form_dict, rubric_weights = rubrics.parse_rubric_snippets(fcontents, peer_review=peer_review, doctype=doctype, rubric_config=rubric_config)
+        if main_file_sha is not None:
+            self.rubric_cache.put(key, grades_form_dict, rubric_weights)
+        return grades_form_dict, rubric_weights
+
+    def create_grade_forms(self, groups, aname):
+
+        grades_form_dict, rubric_weights = self.compile_rubric(aname)
         grades_form_dict[OVERALL_FEEDBACK_STR] = ""
 
 
         grades_form_str = json.dumps(grades_form_dict, indent=4)
 
-        # repo_contents_info = self._get_all_files_in_repo_at_path(self.grades_repo, get_contents=False)
         # copy this into to grades repo, one per student
+        # don't overwrite forms that already exist, this can overwrite grading that was done
+        # (although I guess it would still be in the git history)
+        # the (possibly slightly old) cached tree saves sending forms that are already there. the final say is with
+        # _create_files, which checks against the tree it commits on top of, in case a form was pushed in the meantime
+        existing_files = self._get_all_files_in_repo_at_path(self.grades_repo, path=aname, get_contents=False, relative_path=False)
+        files = dict()
         for group in groups:
             eval_filename = "%s/forms/%s.json" % (aname, group_to_str(group))
-            self._create_file(self.grades_repo, eval_filename, grades_form_str) # don't set overwrite=True here, this can overwrite grading that was done
-                                                                            # (although I guess it would still be in the git history)
+            if eval_filename in existing_files:
+                print("Skipping: %-30s already exists in repository %s." % (eval_filename, self.grades_repo.name))
+                continue
+            files[eval_filename] = grades_form_str
+
         readme_table = self.create_grades_repo_readme(groups, aname)
         readme_path = '%s/%s' % (aname, README)
-        self._create_file(self.grades_repo, readme_path, readme_table, overwrite=True)
+        files[readme_path] = readme_table
 
         # create weights.json file for this particular assessment
+        # forms that are already there keep the exercise names the rubric had when they were made. if one of those isn't
+        # in the rubric any more (e.g. a name that is read differently now), tabulating with the new weights would fail on
+        # it, so the weights the forms were made with are kept instead
         weights_path = '%s/weights.json' % aname
-        weights_str = json.dumps(rubric_weights, indent=4)
+        existing_forms = sorted(filename for filename in existing_files if filename.startswith("%s/forms/" % aname))
+        missing_exercises = []
+        if existing_forms:
+            try:
+                existing_form = json.loads(self._file_contents(self.grades_repo, existing_forms[0]) or "{}")
+            except ValueError: # a form someone broke while grading says nothing about the rubric it was made from
+                existing_form = dict()
+            missing_exercises = [name for name, value in existing_form.items() if isinstance(value, dict) and name not in rubric_weights]
+        if missing_exercises and weights_path in existing_files:
+            print("Warning: keeping %s, because the existing forms have exercises that are not in the rubric any more: %s" % (weights_path, ", ".join(missing_exercises)))
+        else:
+            files[weights_path] = json.dumps(rubric_weights, indent=4)
 
-        self._create_file(self.grades_repo, weights_path, weights_str, overwrite=True)
+        # all forms, the README and the weights go in as a single commit. the README and the weights are overwritten, the forms never
+        forms = [filename for filename in files if filename.startswith("%s/forms/" % aname)]
+        self._create_files(self.grades_repo, files, "Create %s grade forms." % aname, overwrite=True, keep_existing=set(forms))
 
     # grade reports here
     def create_overall_course_grade_reports(self, dry_run=False, ask_human=True):
+        import pandas as pd
+
         # check if we are ready to return. need to have tabulated first. and need to have returned everything
         grades_csv_str = self._file_contents(self.grades_repo, "grades.csv")
         if grades_csv_str is None:
@@ -1081,70 +1526,87 @@ class Goatcabin(object):
         return True
 
     def create_grade_reports(self, groups, aname, score_only=True, dry_run=False, late_days=True):
-        course_repo_materials = self.staff_repo
-        main_file_name = self.get_assessment_main_file_name(aname)
-
+        # the weights, the submission times recorded at close and all the forms, in one go
         weights_path = '%s/weights.json' % aname
-        weights_string = self._file_contents(self.grades_repo, weights_path)
-        weights = json.loads(weights_string)
-        # don't validate! these weights don't add to 1
-
+        submissions_path = '%s/%s' % (aname, SUBMISSIONS_FILENAME)
+        grades_paths = OrderedDict((group, "%s/forms/%s.json" % (aname, group_to_str(group))) for group in groups)
+        files = self._get_files_in_bulk(self.grades_repo, [weights_path, submissions_path] + list(grades_paths.values()))
 
-        # just for making things pretty: grab the rubric snippets for all exercises (with links to images)
-
-        fcontents = self._file_contents(course_repo_materials, main_file_name)
-        is_ipynb = main_file_name.endswith(".ipynb")
+        weights = json.loads(files[weights_path].decode("UTF-8"))
+        # don't validate! these weights don't add to 1
 
-        for group in groups:
-            grades_path = "%s/forms/%s.json" % (aname, group_to_str(group))
-            grades_string = self._file_contents(self.grades_repo, grades_path)
-            grades_dict = json.loads(grades_string, object_pairs_hook=OrderedDict)
+        if late_days:
+            links = self._grades_readme_links(groups, aname) # the same links to the submissions as in the README
+            submissions = json.loads(files[submissions_path].decode("UTF-8")) if submissions_path in files else dict()
+            missing = [group for group in groups if group_to_str(group) not in submissions]
+            if missing: # closed before submission times were recorded, or the groups changed since
+                print("No submission times were recorded at close for %d group(s) of %s. Looking them up now." % (len(missing), aname))
+                submissions.update(self.get_submission_times(missing, aname))
 
-            grade_mapping = self.config.get("grade-mapping", None)
-            report = grades.calculate_single_assessment_grade_and_create_report(grades_dict, weights, grade_mapping, rubric_images=None, score_only=score_only)["report"]
+        # first make sure every group is graded, before anything gets pushed to anyone
+        grade_mapping = self.config.get("grade-mapping", None)
+        forms = OrderedDict()
+        for group, grades_path in grades_paths.items():
+            forms[group] = json.loads(files[grades_path].decode("UTF-8"), object_pairs_hook=OrderedDict)
 
-            if report is None:
+        cohort = grades.calculate_cohort_grades(forms, weights, grade_mapping)
+        for group, status in zip(cohort["groups"], cohort["status"]):
+            if status == grades.INVALID:
                 print("FAILURE: cannot return until all grading is finished. Please run tabulate first for more information.")
                 print(group)
                 sys.exit(0)
                 # raise Exception("Encountered a -1 in the grade report for %s" % student["student_name"])
+
+        # only now that we know they are all fine are the reports made
+        reports = OrderedDict()
+        for group, grades_dict in forms.items():
+            reports[group] = grades.calculate_single_assessment_grade_and_create_report(grades_dict, weights, grade_mapping, rubric_images=None, score_only=score_only)["report"]
             # forms_path = '%s/reports/%s.md' % (directory_name, student["student_name"])
             # self._create_file(grades_repo, forms_path, report_bytes)
 
+        report_filename = "%s_grades.md" % aname
+
+        # returns the files that need to go in the grades repo (only for a dry run)
+        def return_report(group):
+            report = reports[group]
             if late_days:
-                late_dict = self.calculate_late_days(group, aname)
+                late_dict = self.calculate_late_days(aname, submissions.get(group_to_str(group), dict()).get("submission"))
                 report += "\n\n"
                 report += "- Assignment deadline: %s\n" % late_dict["deadline"]
-                link_to_repo = self._get_url_to_repo("submission", get_assessment_repo_name(group, self.config, aname))
+                link_to_repo = links[group][0]
                 report += "- Time of %s: %s\n" % (link_to_repo, late_dict["submission"])
                 report += "- [Late days](https://github.ubc.ca/cpsc340/home/blob/master/homework_instructions.md#late-submissions) used on %s: **%d**\n" % (aname, late_dict["late days"])
 
             # next, open an issue with the report in the student repo
+            dry_run_files = dict()
             for student_cwl in group:
                 if dry_run:
-                    report_filename = "%s/reports_dry_run/%s_grades_report.md" % (aname, student_cwl)
-                    self._create_file(self.grades_repo, report_filename, report, overwrite=True)
+                    dry_run_files["%s/reports_dry_run/%s_grades_report.md" % (aname, student_cwl)] = report
                 else:
                     issue_title = "%s %s grade report is ready" % (self.config["name"], aname)
                     stud_repo_name = get_student_grades_repo_name(student_cwl, self.config)
                     stud_repo = self.repos[stud_repo_name]
-                    report_filename = "%s_grades.md" % aname
                     # print(report)
                     self._create_file(stud_repo, report_filename, report, overwrite=True)
                     issue_body = "@%s: %s is now graded and a report has been created in this repository. This is an automatically generated message." % (" @".join(group), aname)
                     self._open_issue(stud_repo, title=issue_title, body=issue_body)
+            return dry_run_files
+
+        grades_repo_files = dict() # written to the grades repo at the end, in a single commit
+        for dry_run_files in self.fanout.map(return_report, groups, "create_grade_reports").values():
+            grades_repo_files.update(dry_run_files)
 
         # update the README in the instructor repo to include an extra column for these reports
 
         status_json = self._file_contents(self.grades_repo, STATUS_FILENAME)
         status_dict = json.loads(status_json)
         make_report_column = status_dict[aname]=="returned" or not dry_run
-        if status_dict[aname]=="returned": # just a weird thing that if you return it and THEN later do a dry_run, we want to leave report_column as it was.
-            report_filename = "%s_grades.md" % aname
+        # (if you return it and THEN later do a dry_run, we want to leave report_column as it was.)
 
         table = self.create_grades_repo_readme(groups, aname, report_column=make_report_column, report_filename=report_filename)
         readme_path = '%s/%s' % (aname, README)
-        self._create_file(self.grades_repo, readme_path, table, overwrite=True)
+        grades_repo_files[readme_path] = table
+        self._create_files(self.grades_repo, grades_repo_files, "Update %s grade reports." % aname, overwrite=True)
 
     # links to a repo if that repo exists, otherwise doesn't make a link
     # if show_empty = False then we don't make links to empty repos.
@@ -1190,6 +1652,8 @@ class Goatcabin(object):
         print("Successfully created %s" % filename)
 
     def _get_final_grades(self):
+        import pandas as pd
+
         if self.grades_repo is None:
             print("No grades repo found for %s" % self.config["name"])
             return None
@@ -1220,11 +1684,12 @@ class Goatcabin(object):
         self._open_issue(self.grades_repo, title=issue_title, body=issue_body, labels=[aname+"_grading"])
 
     def close_grading_issue(self, aname):
-        for issue in self.grades_repo.issues(labels = aname+"_grading", state="open"):
+        for issue in self.open_issues.with_label(self.grades_repo, aname+"_grading"):
             self._close_issue(issue)
 
     # this should never be empty, since the initial commit from the instructor should alwaysa be before
     # the deadline. however, one could improve this function by dealing with the case where latest_commit is none/empty.
+    # for many groups, call self.repo_queries.prefetch(..., commits_before=...) with the same time first
     def get_last_commit_before_due_date(self, aname, group):
 
         due_date_str = self.course_config[aname]["deadline"]
@@ -1232,16 +1697,10 @@ class Goatcabin(object):
         due_date_object_utc = due_date_object.replace(tzinfo=tz.tzlocal()).astimezone(tz.tzutc())
         # above: convert due date to utc because commits are in utc and we want to compare them to the due date
 
-        repo = self.repos[get_assessment_repo_name(group, self.config, aname)]
-
-        get_time_f = lambda commit: datetime.strptime(commit.commit.committer["date"], gh3_time_fmt)
-        # # hopefully committer is the better choice than author?
-        latest_commit = max(repo.commits(until=due_date_object_utc), key=get_time_f)
-
-        return latest_commit.sha
+        repo_name = get_assessment_repo_name(group, self.config, aname)
 
-        # note: in the unlikely event of two commits at the same time, i think max takes the first one. which is good because
-        # i'm guessing the commits are ordered anyway? ok this is not really relevant.
+        # by committer date. hopefully committer is the better choice than author?
+        return self.repo_queries.last_commit_before(repo_name, datetime.strftime(due_date_object_utc, gh3_time_fmt))
 
     # TODO: fix this to work with multiple student teams
     def notify_students_of_open_assessment(self, aname):
@@ -1251,16 +1710,31 @@ class Goatcabin(object):
         issue_body = "@%s/%s: %s is now available. This is an automatically generated message; please do not reply." % (self.org.name, self.config["students-team"], aname)
         self._open_issue(course_repo, title=issue_title, body=issue_body)
 
-def main(mode, config_filename, aname=None, dry_run=False, gh_object=None, ask_human=True):
+def main(mode, config_filename, aname=None, dry_run=False, gh_object=None, ask_human=True, trace=None):
 
     if gh_object is None:
         with open(config_filename, "r") as f:
             config = json.load(f)
+        if trace is not None:
+            config["trace"] = trace
         g = Goatcabin(config, dry_run)
     else:
         g = gh_object
         config = g.config
 
+    try:
+        with g.tracer.span("main %s" % mode, aname=aname):
+            _run_mode(g, config, mode, aname, dry_run, ask_human)
+    finally:
+        # if some groups failed (see FanOutError), the work that was done for the others is kept, like it is without mirrors
+        g.push_mirrors("%s %s" % (mode, aname if aname else config["name"]))
+        g.save_snapshot()
+    g.print_http_report()
+    g.print_trace_report()
+    return g
+
+def _run_mode(g, config, mode, aname, dry_run, ask_human):
+
     # if mode ==  "tabulate" and course_number is None: # tabulate grades across courses
     #     g.tabulate_program_grades()
     #     return g
@@ -1376,6 +1850,7 @@ def main(mode, config_filename, aname=None, dry_run=False, gh_object=None, ask_h
         groups = g.load_student_groups(aname)
 
         g.add_students_as_collaborators(groups, aname, permission="pull") # revoke push access
+        g.record_submission_times(groups, aname) # for the late days, when it is returned
 
         if g.course_config[aname].get("peer-review", False):
             success = g.assign_peer_reviewees(groups, aname)
@@ -1427,14 +1902,13 @@ def main(mode, config_filename, aname=None, dry_run=False, gh_object=None, ask_h
             g.close_grading_issue(aname)
         # g.create_grades_csv() # this is slow and a little annoying sometimes.
 
-    return g
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("config", default=None, type=str, help="The path to the JSON config file.")
     parser.add_argument("mode", help="What needs to be done?", choices=['open', 'update', 'checkgroups', 'startgrading', 'close', 'regroup', 'tabulate', 'return', 'update', 'refresh', 'calendar', 'fsc'])
     parser.add_argument("--name", default=None, type=str, help="The name of the assessment (see course_config.json).")
     parser.add_argument("--dry", action="store_true", help="If present, reports are not pushed but just made internally.")
+    parser.add_argument("--trace", default=None, type=str, help="If present, time every API call and save the trace to this file (see the trace config setting).")
     args = parser.parse_args()
 
-    main(args.mode, args.config, aname=args.name, dry_run=args.dry)
+    main(args.mode, args.config, aname=args.name, dry_run=args.dry, trace=args.trace)
@@ -0,0 +1,181 @@
+"""
+Local git clones of the repos Goatcabin works on, so that most reads and writes happen on disk.
+
+With the local-mirror setting, the staff repo and the grades repo (and, if asked for, the students'
+grades repos) are cloned into the cache directory, or fetched if they were cloned in an earlier run,
+the first time they are used. Reading a file reads the working tree, and writing a file writes it.
+At the end of the run every repo that changed gets a single commit, which is pushed. Only the master
+branch is mirrored: everything on other branches still goes through the API.
+"""
+
+import os
+import base64
+import threading
+
+import git # gitpython
+
+from utils import git_blob_sha
+
+
+class RepoMirror(object):
+
+    def __init__(self, directory, url, env, author, branch="master"):
+        self.directory = directory
+        self.url = url
+        self.env = env # for git: how to authenticate, without writing the token to disk
+        self.author = author # (name, email)
+        self.branch = branch
+        self.changed = False
+        self.notes = [] # what was written, for the commit message
+        self._lock = threading.Lock()
+        self._blob_shas = None # path -> blob sha of every file in the working tree, worked out once after a sync
+        self.repo = None
+
+    # clone, or fetch and throw away anything left over from an earlier run that did not get pushed
+    def sync(self):
+        if os.path.isdir(os.path.join(self.directory, ".git")):
+            self.repo = git.Repo(self.directory)
+            with self.repo.git.custom_environment(**self.env):
+                self.repo.remotes.origin.fetch()
+            self.repo.git.checkout("-B", self.branch)
+            if "origin/%s" % self.branch in [ref.name for ref in self.repo.remotes.origin.refs]:
+                self.repo.git.reset("--hard", "origin/%s" % self.branch)
+            self.repo.git.clean("-fdq")
+        else:
+            os.makedirs(os.path.dirname(self.directory), exist_ok=True)
+            self.repo = git.Repo.clone_from(self.url, self.directory, env=self.env)
+            self.repo.git.checkout("-B", self.branch) # a clone of an empty repo has no branch yet
+        with self.repo.config_writer() as config:
+            config.set_value("user", "name", self.author[0])
+            config.set_value("user", "email", self.author[1])
+        with self._lock:
+            self._blob_shas = None
+
+    def _path(self, path):
+        return os.path.join(self.directory, *path.split("/"))
+
+    # the contents (bytes) of the file at path, or None if there is no such file
+    def read(self, path):
+        try:
+            with open(self._path(path), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    # a dict from path to contents (bytes) for every file under path
+    def files(self, path=""):
+        files = dict()
+        top = self._path(path) if path else self.directory
+        for directory, subdirectories, filenames in os.walk(top):
+            if ".git" in subdirectories:
+                subdirectories.remove(".git")
+            for filename in filenames:
+                full_path = os.path.join(directory, filename)
+                with open(full_path, "rb") as f:
+                    files[os.path.relpath(full_path, self.directory).replace(os.sep, "/")] = f.read()
+        return files
+
+    # a dict from path to blob sha for every file under path, like the tree that GitHub would give us.
+    # the whole working tree is only hashed once, and write keeps it up to date after that
+    def blob_shas(self, path=""):
+        with self._lock:
+            if self._blob_shas is None:
+                self._blob_shas = {file_path : git_blob_sha(contents) for file_path, contents in self.files().items()}
+            prefix = path.rstrip("/") + "/" if path else ""
+            return {file_path : sha for file_path, sha in self._blob_shas.items() if file_path.startswith(prefix)}
+
+    # note is a line for the commit message, e.g. what GitHub would have been told in a commit of its own
+    def write(self, path, contents, note=None):
+        if not isinstance(contents, bytes):
+            contents = bytes(contents, "UTF-8")
+        full_path = self._path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(contents)
+        with self._lock:
+            self.changed = True
+            if self._blob_shas is not None:
+                self._blob_shas[path] = git_blob_sha(contents)
+            if note and note not in self.notes:
+                self.notes.append(note)
+
+    """ Commit everything that was written, as one commit, and push it. If someone pushed in the meantime,
+        our commit is rebased onto theirs first. Returns True if there was nothing to push or the push worked. """
+    def push(self, message):
+        with self._lock:
+            if not self.changed:
+                return True
+            self.repo.git.add("-A")
+            if not self.repo.is_dirty(index=True, working_tree=False, untracked_files=False) and self.repo.head.is_valid():
+                self.changed = False
+                return True
+            self.repo.index.commit(message + ("\n\n" + "\n".join(self.notes) if self.notes else ""))
+            with self.repo.git.custom_environment(**self.env):
+                try:
+                    self.repo.git.push("origin", "HEAD:%s" % self.branch)
+                except git.GitCommandError:
+                    try: # most likely someone else pushed. put our commit on top of theirs and try once more
+                        self._blob_shas = None # their files are in the working tree now too
+                        self.repo.git.pull("--rebase", "origin", self.branch)
+                        self.repo.git.push("origin", "HEAD:%s" % self.branch)
+                    except git.GitCommandError as e:
+                        print("Failed to push to %s: %s" % (self.url, e))
+                        return False
+            self.changed = False
+            self.notes = []
+            return True
+
+
+""" The mirrors of an org's repos, made the first time each repo is asked for. url_template gives the
+    url to clone a repo from, with {org} and {repo} in it. """
+class MirrorSet(object):
+
+    def __init__(self, directory, url_template, org, token, author):
+        self.directory = directory
+        self.url_template = url_template
+        self.org = org
+        self.author = author
+        # the token goes into an HTTP header through git's environment, so that it is never written into .git/config
+        credentials = base64.b64encode(("x-access-token:%s" % token).encode()).decode("ascii")
+        self.env = {"GIT_CONFIG_COUNT" : "1", "GIT_CONFIG_KEY_0" : "http.extraHeader",
+                    "GIT_CONFIG_VALUE_0" : "Authorization: Basic %s" % credentials, "GIT_TERMINAL_PROMPT" : "0"}
+        self.mirrors = dict() # repo name -> RepoMirror, or None if it could not be cloned
+        self._lock = threading.Lock() # for mirrors and _repo_locks
+        self._repo_locks = dict() # repo name -> lock held while that repo is cloned or fetched
+
+    # the mirror of the repo called repo_name, synced with GitHub the first time it is asked for in this run.
+    # None if it could not be cloned (the caller should go through the API instead)
+    def get(self, repo_name):
+        with self._lock:
+            if repo_name in self.mirrors:
+                return self.mirrors[repo_name]
+            repo_lock = self._repo_locks.setdefault(repo_name, threading.Lock())
+        # only whoever wants the same repo waits for it to be synced. other repos are synced at the same time
+        with repo_lock:
+            with self._lock:
+                if repo_name in self.mirrors:
+                    return self.mirrors[repo_name]
+            mirror = RepoMirror(os.path.join(self.directory, repo_name), self.url_template.format(org=self.org, repo=repo_name), self.env, self.author)
+            try:
+                mirror.sync()
+                print("Synced the local mirror of %s." % repo_name)
+            except git.GitCommandError as e:
+                print("Could not make a local mirror of %s, so it will be used through the API: %s" % (repo_name, e))
+                mirror = None
+            with self._lock:
+                self.mirrors[repo_name] = mirror
+            return mirror
+
+    # one commit per repo that changed, pushed. returns the names of the repos that could not be pushed
+    def push_all(self, message):
+        failed = []
+        with self._lock:
+            mirrors = sorted(self.mirrors.items())
+        for repo_name, mirror in mirrors:
+            if mirror is None or not mirror.changed:
+                continue
+            if mirror.push(message):
+                print("Pushed the changes to %s in one commit." % repo_name)
+            else:
+                failed.append(repo_name)
+        return failed
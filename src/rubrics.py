@@ -1,8 +1,8 @@
 import re
 import json
-import yaml
+import hashlib
 from collections import OrderedDict
-from utils import validate_weights, PEER_REVIEW_WEIGHT
+from utils import validate_weights, PEER_REVIEW_WEIGHT, DEFAULT_RUBRIC_CONFIG_FILENAME
 import pdb
 
 DEFAULT_GRADES_FORM_SYMBOL = "FILL_THIS_IN_WITH_GRADE"
@@ -16,61 +16,179 @@ update_finder = re.compile("rub(r(ic)?)? *[=:]? *({.*})")
 header_finder_tex = re.compile(r'(?:sub?:)*section(?:\*?:)?.*')
 header_finder = re.compile("# .*")
 
+_header_finders = {"md" : header_finder, "tex" : header_finder_tex}
+
+# the exercise name in a header line (as found by header_finder or header_finder_tex)
+def _exercise_name_from_header(header, doctype="md"):
+    if doctype == "md":
+        return header.lstrip().lstrip("#").lstrip().rstrip().replace("\\n","").replace("\"","").rstrip(",").replace('\\"','"').replace('"','\\"') # header[2:]
+    elif doctype == "tex":
+        return header.lstrip().lstrip("section").lstrip("*").lstrip(r'{').lstrip().rstrip().replace("\\n","").replace("\"","").rstrip(",").replace('\\"','"').replace('"','\\"').rstrip(r'}')
+    return "Untitled Exercise"
+
 # TODO: just look on the previous line, instead of insisting on this
 def extract_exercise_name(text, location, doctype="md"):
     #find name by scanning through file for headers:
 
-    if doctype == "md":
-        m_header_l = reversed(header_finder.findall(text[:location]))
+    if doctype in _header_finders:
+        m_header_l = reversed(_header_finders[doctype].findall(text[:location]))
         m_first = next(m_header_l)
         if m_first is not None:
-            return m_first.lstrip().lstrip("#").lstrip().rstrip().replace("\\n","").replace("\"","").rstrip(",").replace('\\"','"').replace('"','\\"') # m_first[2:]
-
-    elif doctype == "tex":
-        m_header_l = reversed(header_finder_tex.findall(text[:location]))
-        m_first = next(m_header_l)
-        if m_first is not None:
-            return m_first.lstrip().lstrip("section").lstrip("*").lstrip(r'{').lstrip().rstrip().replace("\\n","").replace("\"","").rstrip(",").replace('\\"','"').replace('"','\\"').rstrip(r'}')
+            return _exercise_name_from_header(m_first, doctype=doctype)
 
     return "Untitled Exercise"
 
-with open("rubric_config.json", 'r') as f:
-    rubric_config = json.load(f)
+""" Go through text once, in order, and yield (match, exercise name) for every rubric snippet, where match is
+    the update_finder match and the exercise name comes from the nearest header before it. This is what
+    extract_exercise_name(text, match.start()) gives, without going back over the text before every snippet. """
+def scan_rubric_snippets(text, doctype="md"):
+    headers = _header_finders[doctype].finditer(text) if doctype in _header_finders else iter(())
+    header = None # the last header that starts before the current snippet
+    next_header = next(headers, None)
+
+    for m in update_finder.finditer(text):
+        while next_header is not None and next_header.start() < m.start():
+            header, next_header = next_header, next(headers, None)
+        if header is None:
+            yield m, "Untitled Exercise"
+        else: # a header on the same line as the snippet only counts up to where the snippet starts
+            yield m, _exercise_name_from_header(text[header.start():min(header.end(), m.start())], doctype=doctype)
+
+_rubric_configs = dict() # path -> (rubric config, hash)
+
+""" The rubric config at path, and a hash of it. Rubrics parsed with a different rubric_config.json come out differently,
+    so the hash is part of what a parsed rubric is cached under. Only read when it is needed, and then only once. """
+def load_rubric_config(path=DEFAULT_RUBRIC_CONFIG_FILENAME):
+    if path not in _rubric_configs:
+        with open(path, 'rb') as f:
+            rubric_config_bytes = f.read()
+        rubric_config = json.loads(rubric_config_bytes.decode("UTF-8"))
 
-# make sure weights add up to 1 for any rubrics that have weighted sub-rubrics.
-for rubric_name, cfg in rubric_config.items():
-    if "rows" in cfg:
-        validate_weights(cfg["rows"])
+        # make sure weights add up to 1 for any rubrics that have weighted sub-rubrics.
+        for rubric_name, cfg in rubric_config.items():
+            if "rows" in cfg:
+                validate_weights(cfg["rows"])
 
+        _rubric_configs[path] = (rubric_config, hashlib.sha1(rubric_config_bytes).hexdigest())
+    return _rubric_configs[path]
 
-# we use yaml.load instead of json.loads because
-# the snippets are in the form
-#   {code:1}
-# rather than
-#   {"code":1}
-# yaml handles this.
+
+class SnippetError(ValueError):
+
+    def __init__(self, message, position):
+        super(SnippetError, self).__init__(message)
+        self.position = position # where in the snippet (or, once parse_rubric_snippets has seen it, in the file) it went wrong
+
+
+_snippet_number = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_snippet_whitespace = re.compile(r"\s*")
+
+""" Read a rubric snippet like {code:1, reasoning:2} or {name:"Exercise 1", code:1} into an OrderedDict.
+    Every key is the name of a rubric and its value is a number of points (which may be in quotes), except for name, whose value is
+    the name of the exercise (in quotes if it has a comma or a brace in it; a colon is fine either way). Raises a SnippetError that
+    says where in the snippet the problem is. """
 def loadsnippet(snip):
-    return yaml.load(snip.replace("\t","").replace(":"," : "))
+    snippet = OrderedDict()
+    skip = lambda i: _snippet_whitespace.match(snip, i).end()
+
+    i = skip(0)
+    if not snip.startswith("{", i):
+        raise SnippetError('Expected "{" at the start of the rubric snippet %s' % snip, i)
+    i = skip(i + 1)
+    while not snip.startswith("}", i):
+        if i == len(snip):
+            raise SnippetError('Expected "}" at the end of the rubric snippet %s' % snip, i)
+
+        key_start = i
+        while i < len(snip) and snip[i] not in ":,{}":
+            i += 1
+        key = snip[key_start:i].strip()
+        if not key:
+            raise SnippetError('Expected the name of a rubric at column %d of the rubric snippet %s' % (key_start + 1, snip), key_start)
+        if not snip.startswith(":", i):
+            raise SnippetError('Expected ":" after "%s" in the rubric snippet %s' % (key, snip), i)
+        if key in snippet:
+            raise SnippetError('"%s" appears more than once in the rubric snippet %s' % (key, snip), key_start)
+        i = skip(i + 1)
+
+        if key == "name":
+            snippet[key], i = _read_snippet_name(snip, i)
+        else:
+            quote = snip[i] if snip[i:i+1] in ('"', "'") else ""
+            m = _snippet_number.match(snip, i + len(quote))
+            if m is None or not snip.startswith(quote, m.end()):
+                raise SnippetError('Expected a number of points for "%s" at column %d of the rubric snippet %s' % (key, i + 1, snip), i)
+            snippet[key] = int(m.group()) if m.group().lstrip("+-").isdigit() else float(m.group())
+            i = m.end() + len(quote)
+
+        i = skip(i)
+        if snip.startswith(",", i):
+            i = skip(i + 1)
+        elif not snip.startswith("}", i) and i < len(snip):
+            raise SnippetError('Expected "," or "}" at column %d of the rubric snippet %s' % (i + 1, snip), i)
+
+    i = skip(i + 1)
+    if i != len(snip):
+        raise SnippetError('Unexpected text at column %d of the rubric snippet %s' % (i + 1, snip), i)
+    return snippet
+
+# the name of an exercise in a snippet, starting at i: in quotes, or everything up to the next "," or "}".
+# returns the name and where it ends
+def _read_snippet_name(snip, i):
+    if snip.startswith('\\"', i): # in quotes, in the source of a notebook (which is JSON)
+        end = snip.find('\\"', i + 2)
+        if end == -1:
+            raise SnippetError('The name starting at column %d of the rubric snippet %s has no closing \\"' % (i + 1, snip), i)
+        # the \" stay part of the name, as they did when YAML read it, so that assessments closed back then
+        # keep the same exercise names in their forms and weights.json
+        return snip[i:end+2], end + 2
+    if snip[i:i+1] in ('"', "'"):
+        quote = snip[i]
+        name = []
+        j = i + 1
+        while j < len(snip) and snip[j] != quote:
+            if snip[j] == "\\" and quote == '"' and j + 1 < len(snip):
+                j += 1
+            name.append(snip[j])
+            j += 1
+        if j == len(snip):
+            raise SnippetError('The name starting at column %d of the rubric snippet %s has no closing %s' % (i + 1, snip, quote), i)
+        return "".join(name), j + 1
+    j = i
+    while j < len(snip) and snip[j] not in ",}":
+        j += 1
+    name = snip[i:j].strip()
+    if not name:
+        raise SnippetError('Expected the name of the exercise at column %d of the rubric snippet %s' % (i + 1, snip), i)
+    return name, j
 
 """
 Parse the rubric snippets from a homework file. Generate a JSON form for the TA to fill out,
-and also get the weights.
+and also get the weights. rubric_config defaults to the one in rubric_config.json in the current directory.
 """
-def parse_rubric_snippets(text, peer_review=False, doctype="md"):
+def parse_rubric_snippets(text, peer_review=False, doctype="md", rubric_config=None):
+    if rubric_config is None:
+        rubric_config, _ = load_rubric_config()
 
     grades_form = OrderedDict()
     weights = OrderedDict() # the relative weights of the different questions
     total_points = 0
 
-    for m in update_finder.finditer(text): # for each exercise in the assignment
+    for m, header_name in scan_rubric_snippets(text, doctype=doctype): # for each exercise in the assignment
         snippet_str = m.group(3)
         # if (is_ipynb):
             # snippet_str=snippet_str.replace("\\t","\t").replace('\\"','"')
-        snippet_dict = loadsnippet(snippet_str)
+        try:
+            snippet_dict = loadsnippet(snippet_str)
+        except SnippetError as e: # say where it is in the file, not just in the snippet
+            position = m.start(3) + e.position
+            line = text.count("\n", 0, position) + 1
+            column = position - text.rfind("\n", 0, position)
+            raise SnippetError("%s (line %d, column %d of the file)" % (e, line, column), position)
 
         # deal with exercise name
         if "name" not in snippet_dict: # you can manually specify the name of an exercise inside of a snippet!
-            exercise_name = extract_exercise_name(text, m.start(), doctype=doctype)
+            exercise_name = header_name
         else:
             exercise_name = snippet_dict["name"]
             del snippet_dict["name"]
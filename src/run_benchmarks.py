@@ -0,0 +1,367 @@
+"""
+API-cost benchmarks for the main() modes.
+
+Each mode (open, update, close, startgrading, return, tabulate, refresh) is run, in the order they happen
+during a term, against a fake GitHub Enterprise (see fake_ghe.py) holding a made-up course of 10, 100 and
+1000 students. For every mode we record how many requests it made, by endpoint, and how long it took.
+
+The request counts are compared against a recorded baseline (benchmark_baseline.json, next to this file).
+The run fails if any mode makes noticeably more requests than in the baseline, or if its request count grows
+faster with the number of students than it did in the baseline (e.g. a loop over students that started doing
+a request per student *per student*). Times are printed but not checked, since they depend on the machine.
+
+Run it from the directory containing default_course_config.json and rubric_config.json, like main.py:
+    python ../src/run_benchmarks.py test_config.json             # check against the baseline
+    python ../src/run_benchmarks.py test_config.json --record    # make the current numbers the new baseline
+
+--snippets instead times rubrics.loadsnippet against the YAML-based way snippets used to be read, on every
+rubric snippet in the given notebooks (or in a made-up one, if none are given):
+    python ../src/run_benchmarks.py --snippets lab1.ipynb lab2.ipynb
+"""
+
+import os
+import sys
+import math
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+try: import simplejson as json
+except ImportError: import json
+from collections import OrderedDict
+
+import fake_ghe
+from main import main
+import rubrics
+from utils import get_student_grades_repo_name, get_partners_issue_title
+
+DEFAULT_SIZES = (10, 100, 1000)
+DEFAULT_BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# a mode fails if it makes more than this fraction more requests than in the baseline (plus a few, for small counts)...
+REQUESTS_TOLERANCE = 0.10
+REQUESTS_SLACK = 5
+# ...or if its requests grow with the number of students with an exponent this much bigger than in the baseline
+# (1.0 means linear in the number of students, 2.0 quadratic)
+EXPONENT_TOLERANCE = 0.1
+
+ANAME = "lab1"
+FILES_PER_ASSESSMENT = 20
+
+# (name in the report, mode, assessment name) in the order they are run
+MODES = (
+    ("open course",  "open",         None),
+    ("open",         "open",         ANAME),
+    ("update",       "update",       ANAME),
+    ("close",        "close",        ANAME),
+    ("startgrading", "startgrading", ANAME),
+    ("return",       "return",       ANAME),
+    ("tabulate",     "tabulate",     None),
+    ("refresh",      "refresh",      None),
+)
+
+COURSE_CONFIG = OrderedDict([(ANAME, OrderedDict([
+    ("weight", 1.0),
+    ("peer-review", 0),
+    ("public-after-submit", True),
+    ("main-file", "labs/%s/%s.*" % (ANAME, ANAME)),
+    ("main-dir", "labs/%s" % ANAME),
+    ("deadline", "2016-09-30 18:00"),
+    ("max-group-size", 2)]))])
+
+LAB_CONTENTS = """# %s
+
+## Exercise 1
+rubric={code:5,writing:2}
+
+## Exercise 2
+rubric={reasoning:3}
+
+## Exercise 3
+rubric={viz:4,mechanics:1}
+
+## Exercise 4 (optional)
+rubric={code:1}
+""" % ANAME
+
+
+def _assessment_files():
+    files = {"labs/%s/%s.md" % (ANAME, ANAME) : LAB_CONTENTS}
+    for i in range(FILES_PER_ASSESSMENT - 1):
+        files["labs/%s/data/data%02d.csv" % (ANAME, i)] = "x,y\n%d,%d\n" % (i, i*i)
+    return files
+
+# students 1 and 2 ask to work together, and so do 3 and 4, and so on for the first half of the class
+def _request_partners(fake, config, students):
+    for i in range(0, len(students)//2, 2):
+        for me, partner in ((students[i], students[i+1]), (students[i+1], students[i])):
+            fake.add_issue(config["org"], get_student_grades_repo_name(me, config), get_partners_issue_title(ANAME), partner, user=me)
+
+# what the instructor does to the staff repo before running update
+def _edit_assessment(fake, config):
+    fake.commit_files(config["org"], config["staff-repo"], {"labs/%s/%s.md" % (ANAME, ANAME) : LAB_CONTENTS + "\nA correction.\n"},
+                      message="Fix a typo.", author="instructor")
+
+# what the TAs do before the assessment is returned: give everybody 2 on everything, with some feedback
+# (so that, like real forms, no two are the same)
+def _grade_everything(fake, config):
+    forms = dict()
+    for path, contents in fake.read_files(config["org"], config["grades-repo"]).items():
+        if path.startswith("%s/forms/" % ANAME):
+            form = json.loads(contents.decode("UTF-8"), object_pairs_hook=OrderedDict)
+            for exercise_name, row in form.items():
+                if isinstance(row, dict):
+                    for rubric_name, grade in row.items():
+                        if grade == rubrics.DEFAULT_GRADES_FORM_SYMBOL:
+                            row[rubric_name] = 2
+                    row["feedback"] = "Good work on %s, %s." % (exercise_name, os.path.basename(path)[:-len(".json")])
+            forms[path] = json.dumps(form, indent=4)
+    fake.commit_files(config["org"], config["grades-repo"], forms, message="Grading.", author="instructor")
+
+BEFORE_MODE = {
+    "open" : _request_partners,
+    "update" : lambda fake, config, students: _edit_assessment(fake, config),
+    "return" : lambda fake, config, students: _grade_everything(fake, config),
+}
+
+
+""" Run every mode against a fresh fake course with num_students students.
+    Returns {mode name : {"requests" : total, "seconds" : wall time, "endpoints" : {endpoint : [count, seconds]}}}. """
+def run_course(config, num_students, latency=0.0, verbose=False):
+    students = ["student%04d" % i for i in range(1, num_students + 1)]
+    fake = fake_ghe.FakeGitHub(latency=latency)
+    fake.seed_course(config, "instructor", students, COURSE_CONFIG, files=_assessment_files())
+    server = fake_ghe.start_server(fake)
+
+    cache_dir = tempfile.mkdtemp(prefix="rhomboid_benchmark_cache_")
+    fake_config = dict(config)
+    fake_config.update({"url" : "http://localhost:%d" % server.server_address[1], "cache-dir" : cache_dir, "write-interval" : 0})
+    fd, config_filename = tempfile.mkstemp(suffix=".json", prefix="rhomboid_benchmark_config_")
+    with os.fdopen(fd, "w") as f:
+        json.dump(fake_config, f)
+    os.environ["GITHUB_PAT"] = "fake-token"
+
+    results = OrderedDict()
+    devnull = open(os.devnull, "w")
+    try:
+        for name, mode, aname in MODES:
+            before = BEFORE_MODE.get(name)
+            if before is not None and aname is not None:
+                before(fake, config, students)
+            fake.reset_counts()
+
+            start_time = time.time()
+            # every mode gets its own Goatcabin, like separate runs of main.py, but the caches on disk carry over
+            with contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+                g = main(mode, config_filename, aname=aname, ask_human=False)
+                g.fanout.shutdown()
+            seconds = time.time() - start_time
+
+            results[name] = {
+                "requests" : sum(fake.request_counts.values()),
+                "seconds" : round(seconds, 2),
+                "endpoints" : OrderedDict((endpoint, [count, round(fake.request_seconds[endpoint], 3)])
+                                          for endpoint, count in fake.request_counts.most_common())
+            }
+    finally:
+        server.shutdown()
+        devnull.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.remove(config_filename)
+    return results
+
+# how rubric snippets were read before rubrics.loadsnippet, for comparison (PyYAML is only needed for this)
+def _loadsnippet_yaml(snip):
+    import yaml
+    return yaml.load(snip.replace("\t","").replace(":"," : "), Loader=yaml.Loader)
+
+# how numbers of points may be spelled for YAML 1.1 but not for loadsnippet: with underscores, in hex, octal (a leading 0)
+# or binary, .inf and .nan, and the booleans, which float() then turned into 1 or 0
+_yaml_only_number = re.compile(r"[-+]?(?:\d+_|0\d|0[xob]|\.(?:inf|nan)$)|(?:yes|no|true|false|on|off)$", re.IGNORECASE)
+# the value of every rubric in a snippet, other than the name
+_snippet_values = re.compile(r"[{,]\s*(?!name\s*:)[^:,{}]+:\s*([^,{}]*)")
+
+""" Which of the differences loadsnippet is meant to have from YAML explains it reading snip as new (None if it raised
+    new_error), where YAML read it as old, or None if none of them do. """
+def _known_snippet_difference(snip, old, new, new_error):
+    yaml_only_numbers = [value.strip() for value in _snippet_values.findall(snip) if _yaml_only_number.match(value.strip())]
+    if new is None:
+        if "appears more than once" in new_error:
+            return "a rubric that appears twice is an error, YAML kept the last one"
+        if yaml_only_numbers:
+            return "%s is only a number for YAML" % yaml_only_numbers[0]
+        return None
+
+    reasons = []
+    old_rest, new_rest = dict(old), dict(new)
+    old_name, new_name = old_rest.pop("name", None), new_rest.pop("name", None)
+    if old_name != new_name:
+        if not isinstance(old_name, str):
+            reasons.append("names are always strings")
+        elif new_name is not None and old_name == new_name.replace(":", " : "):
+            reasons.append("YAML put spaces around the colons in the name")
+        else:
+            return None
+    if old_rest != new_rest:
+        if not yaml_only_numbers:
+            return None
+        reasons.append("%s is read differently by YAML" % yaml_only_numbers[0])
+    return ", ".join(reasons)
+
+# a notebook like the ones we use in courses: lots of markdown and code, with a rubric snippet per exercise
+def _made_up_notebook(num_exercises=60, cells_per_exercise=20):
+    cells = []
+    for i in range(num_exercises):
+        cells.append({"cell_type" : "markdown", "metadata" : {}, "source" : ["## Exercise %d%s\n" % (i + 1, " (optional)" if i % 10 == 9 else ""),
+            "rubric={code:%d, reasoning:%d, writing:1}\n" % (i % 5 + 1, i % 3 + 1) if i % 4 else "rubric={name:\"Exercise %d: %s\", accuracy:2.5}\n" % (i + 1, "the data")]})
+        for j in range(cells_per_exercise):
+            cells.append({"cell_type" : "code", "execution_count" : j, "metadata" : {}, "outputs" : [],
+                "source" : ["df = pd.read_csv('data%02d.csv')\n" % j, "df.groupby('x').agg({'y' : 'mean'})\n"]})
+    return json.dumps({"cells" : cells, "metadata" : {}, "nbformat" : 4, "nbformat_minor" : 2}, indent=1)
+
+""" Time how long rubrics.loadsnippet and the YAML-based reader take on every snippet in the files, and check that
+    loadsnippet reads every snippet that YAML could read the same way, apart from the differences it is meant to have
+    (see _known_snippet_difference). Returns the number of snippets where it didn't. """
+def benchmark_snippets(filenames, repeat=20):
+    texts = OrderedDict()
+    for filename in filenames:
+        with open(filename, "r") as f:
+            texts[filename] = f.read()
+    if not texts:
+        texts["(made-up notebook)"] = _made_up_notebook()
+
+    disagreements = 0
+    rows = []
+    for filename, text in texts.items():
+        snippets = [m.group(3) for m in rubrics.update_finder.finditer(text)]
+        times = []
+        for load in (_loadsnippet_yaml, rubrics.loadsnippet):
+            start_time = time.time()
+            for _ in range(repeat):
+                for snip in snippets:
+                    try:
+                        load(snip)
+                    except Exception:
+                        pass
+            times.append((time.time() - start_time)/repeat)
+
+        # like parse_rubric_snippets_inner, which takes float() of every number of points
+        for snip in snippets:
+            try:
+                old = {key : value if key == "name" else float(value) for key, value in _loadsnippet_yaml(snip).items()}
+            except Exception:
+                old = None
+            try:
+                new = {key : value if key == "name" else float(value) for key, value in rubrics.loadsnippet(snip).items()}
+                new_error = None
+            except rubrics.SnippetError as e:
+                new, new_error = None, str(e)
+            if old is None and new is not None:
+                print("%s: the snippet %s could not be read with YAML, and is now read as %s" % (filename, snip, new))
+            elif old != new:
+                reason = _known_snippet_difference(snip, old, new, new_error) if old is not None else None
+                if reason:
+                    print("%s: the snippet %s is read as %s, but was read as %s (as intended: %s)" % (filename, snip, new if new is not None else "an error", old, reason))
+                else:
+                    print("FAILURE: %s: the snippet %s is read as %s, but was read as %s" % (filename, snip, new if new is not None else "an error", old))
+                    disagreements += 1
+        rows.append((filename, len(snippets), times[0], times[1]))
+
+    print("%-30s %8s %12s %12s %8s" % ("File", "Snippets", "YAML (ms)", "Parser (ms)", "Speedup"))
+    for filename, num_snippets, yaml_time, parser_time in rows:
+        print("%-30s %8d %12.2f %12.2f %7.1fx" % (filename[-30:], num_snippets, 1000*yaml_time, 1000*parser_time, yaml_time/max(parser_time, 1e-9)))
+    return disagreements
+
+# how fast the requests grow with the number of students between the smallest and biggest size, as an exponent
+def _growth_exponent(counts_by_size):
+    sizes = sorted(counts_by_size, key=int)
+    if len(sizes) < 2 or counts_by_size[sizes[0]] == 0:
+        return None
+    small, big = sizes[0], sizes[-1]
+    return math.log(max(1, counts_by_size[big])/counts_by_size[small])/math.log(int(big)/int(small))
+
+""" Compare results ({size : {mode : ...}}) with the baseline. Returns a list of problems (empty if all is well). """
+def compare_with_baseline(results, baseline):
+    problems = []
+    for name, _, _ in MODES:
+        for size, modes in results.items():
+            if size not in baseline or name not in baseline[size]:
+                continue
+            requests, baseline_requests = modes[name]["requests"], baseline[size][name]["requests"]
+            if requests > baseline_requests*(1 + REQUESTS_TOLERANCE) + REQUESTS_SLACK:
+                problems.append("%s with %s students made %d requests, up from %d in the baseline." % (name, size, requests, baseline_requests))
+
+        sizes = [size for size in results if size in baseline and name in baseline[size]]
+        exponent = _growth_exponent({size : results[size][name]["requests"] for size in sizes})
+        baseline_exponent = _growth_exponent({size : baseline[size][name]["requests"] for size in sizes})
+        if exponent is not None and baseline_exponent is not None and exponent > baseline_exponent + EXPONENT_TOLERANCE:
+            problems.append("%s scales worse than in the baseline: requests grow like n^%.2f with the number of students, up from n^%.2f." % \
+                (name, exponent, baseline_exponent))
+    return problems
+
+def print_results(results, show_endpoints=False):
+    sizes = list(results)
+    print("%-14s" % "Mode" + "".join("%20s" % ("%s students" % size) for size in sizes) + "%10s" % "Growth")
+    for name, _, _ in MODES:
+        row = "%-14s" % name
+        for size in sizes:
+            row += "%20s" % ("%d req %7.1fs" % (results[size][name]["requests"], results[size][name]["seconds"]))
+        exponent = _growth_exponent({size : results[size][name]["requests"] for size in sizes})
+        row += "%10s" % ("n^%.2f" % exponent if exponent is not None else "")
+        print(row)
+
+    if show_endpoints:
+        for size in sizes:
+            print("\nRequests by endpoint with %s students (count, mean latency in ms):" % size)
+            for name, _, _ in MODES:
+                print("  %s" % name)
+                for endpoint, (count, seconds) in results[size][name]["endpoints"].items():
+                    print("    %6d %8.1f  %s" % (count, 1000.0*seconds/count, endpoint))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", default="test_config.json", nargs="?", type=str, help="A config file to take the org, team and repo names from. Its url is not used.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), type=str, help="Comma-separated numbers of students to try.")
+    parser.add_argument("--latency", default=0.0, type=float, help="Seconds the fake server waits before answering each request.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILENAME, type=str, help="The baseline file.")
+    parser.add_argument("--record", action="store_true", help="If present, the results become the new baseline instead of being checked against it.")
+    parser.add_argument("--endpoints", action="store_true", help="If present, print the requests made by each mode by endpoint.")
+    parser.add_argument("--verbose", action="store_true", help="If present, show everything that the modes print.")
+    parser.add_argument("--snippets", nargs="*", default=None, type=str, help="Instead of the modes, time reading the rubric snippets in these files (or in a made-up notebook).")
+    args = parser.parse_args()
+
+    if args.snippets is not None:
+        if benchmark_snippets(args.snippets):
+            sys.exit(1)
+        sys.exit(0)
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    results = OrderedDict()
+    for size in map(int, args.sizes.split(",")):
+        print("Running all modes with %d students..." % size)
+        results[str(size)] = run_course(config, size, latency=args.latency, verbose=args.verbose)
+    print()
+    print_results(results, show_endpoints=args.endpoints)
+    print()
+
+    if args.record:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print("Recorded the results as the new baseline in %s." % args.baseline)
+    elif not os.path.isfile(args.baseline):
+        print("No baseline found at %s. Run with --record to make one." % args.baseline)
+    else:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f, object_pairs_hook=OrderedDict)
+        problems = compare_with_baseline(results, baseline)
+        if problems:
+            print("FAILURE: %d problem(s) compared to the baseline:" % len(problems))
+            for problem in problems:
+                print("  " + problem)
+            sys.exit(1)
+        print("No mode makes more requests, or scales worse, than in the baseline.")
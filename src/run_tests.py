@@ -1,8 +1,10 @@
 from main import main
 import utils
 import rubrics
+import fake_ghe
 import json
 import os
+import tempfile
 from collections import OrderedDict
 from datetime import datetime
 
@@ -21,6 +23,40 @@ test_config_filename = "test_config.json"
 lab_name="homework1"
 g = None
 
+# with RHOMBOID_FAKE_GHE=1 in the environment, run everything against a fake GitHub Enterprise on localhost (see fake_ghe.py)
+# instead of the one in test_config.json. nothing on the real GitHub is touched, and the fake prints how many requests
+# of each kind were made at the end. (a fake that is already running can also just be put in test_config.json as the url)
+USE_FAKE_GHE = os.environ.get("RHOMBOID_FAKE_GHE", "0") not in ("", "0")
+FAKE_GHE_LATENCY = 0.0 # seconds per request. try e.g. 0.1 to get a feel for how the real thing would do
+FAKE_GHE_STUDENTS = ["student%d" % i for i in range(1, 5)]
+
+if USE_FAKE_GHE:
+	with open(test_config_filename, "r") as f:
+		fake_config = json.load(f)
+
+	fake = fake_ghe.FakeGitHub(latency=FAKE_GHE_LATENCY)
+	course_config = OrderedDict([(lab_name, OrderedDict([
+		("weight", 1.0),
+		("peer-review", 0),
+		("public-after-submit", True),
+		("main-file", "%s/%s.*" % (lab_name, lab_name)),
+		("main-dir", lab_name),
+		("deadline", "2016-09-30 18:00")]))])
+	lab_contents = "# %s\n\n## Exercise 1\nrubric={code:5,writing:2}\n\n## Exercise 2\nrubric={reasoning:3}\n\n## Exercise 3 (optional)\nrubric={code:1}\n" % lab_name
+	fake.seed_course(fake_config, "instructor", FAKE_GHE_STUDENTS, course_config,
+		files={"%s/%s.md" % (lab_name, lab_name) : lab_contents, "%s/data/data.csv" % lab_name : "x,y\n1,2\n"})
+	server = fake_ghe.start_server(fake)
+
+	# same config, but pointing at the fake, and with a fresh cache so that nothing is left over from the real one
+	fake_config["url"] = "http://localhost:%d" % server.server_address[1]
+	fake_config["cache-dir"] = tempfile.mkdtemp(prefix="rhomboid_test_cache_")
+	fake_config["write-interval"] = 0 # the fake has no secondary rate limits, so there is no need to pace writes
+	fd, test_config_filename = tempfile.mkstemp(suffix=".json", prefix="fake_ghe_config_")
+	with os.fdopen(fd, "w") as f:
+		json.dump(fake_config, f)
+	os.environ["GITHUB_PAT"] = "fake-token"
+
+
 
 
 if THINGS_TO_TEST["open-course"]:
@@ -86,3 +122,9 @@ if THINGS_TO_TEST["return-one"]:
 if THINGS_TO_TEST["return-all"]:
 	print("Returning final grades\n")
 	g = main("return", test_config_filename, gh_object=g, ask_human=False)
+
+if USE_FAKE_GHE:
+	server.shutdown()
+	print("Requests to the fake GitHub Enterprise, by endpoint:")
+	for endpoint, count in fake.request_counts.most_common():
+		print("%6d %s" % (count, endpoint))
@@ -0,0 +1,163 @@
+"""
+Rate-limit-aware scheduling of GitHub API requests.
+
+SchedulingAdapter sits under the requests session that github3 uses, so every API call goes through
+it. It
+  * keeps track of X-RateLimit-Remaining / X-RateLimit-Reset and, once the primary rate limit is used
+    up, waits for the reset instead of letting requests fail,
+  * spaces out write requests (POST/PATCH/PUT/DELETE, but not GraphQL queries, which only read), which
+    is what GitHub's secondary rate limits are about. The spacing adapts: it doubles every time GitHub
+    tells us to slow down, and shrinks slowly back to the minimum while writes keep succeeding,
+  * retries 5xx responses and connection errors for idempotent requests, and secondary rate limit
+    ("abuse detection") responses for any request, with jittered exponential backoff.
+"""
+
+import time
+import random
+import threading
+
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+WRITE_METHODS = ("POST", "PATCH", "PUT", "DELETE")
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE") # safe to send again if we don't know whether the first one worked
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+GRAPHQL_PATH = "/graphql" # POSTs here are queries: reads, and safe to send again
+
+DEFAULT_WRITE_INTERVAL = 0.25 # seconds between write requests, at the fastest
+MAX_WRITE_INTERVAL = 10.0
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 1.0 # seconds
+MAX_BACKOFF = 60.0
+
+
+class SchedulingAdapter(BaseAdapter):
+
+    def __init__(self, inner, write_interval=DEFAULT_WRITE_INTERVAL, max_retries=DEFAULT_MAX_RETRIES):
+        super(SchedulingAdapter, self).__init__()
+        self.inner = inner # the adapter that actually talks to the server
+        self.min_write_interval = write_interval
+        self.write_interval = write_interval
+        self.max_retries = max_retries
+
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None # unix time
+        self._next_write_time = 0
+
+        self.retries = 0
+        self.seconds_waited = 0.0
+        self._lock = threading.Lock()
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self.seconds_waited += seconds
+            time.sleep(seconds)
+
+    # if the primary rate limit is used up, wait until it resets
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            remaining, reset = self.rate_limit_remaining, self.rate_limit_reset
+        if remaining is not None and remaining <= 0 and reset is not None and reset > time.time():
+            print("Rate limit used up. Waiting %.0f seconds for it to reset." % (reset - time.time() + 1))
+            self._sleep(reset - time.time() + 1)
+            with self._lock:
+                self.rate_limit_remaining = None
+
+    # writes go out one at a time, at least write_interval apart
+    def _pace_write(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_write_time)
+            self._next_write_time = slot + self.write_interval
+        self._sleep(slot - now)
+
+    def _record_rate_limit(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        with self._lock:
+            if remaining is not None:
+                self.rate_limit_remaining = int(remaining)
+            if reset is not None:
+                self.rate_limit_reset = int(reset)
+
+    def _is_primary_rate_limit(self, response):
+        return response.status_code in (403, 429) and response.headers.get("X-RateLimit-Remaining") == "0"
+
+    def _is_secondary_rate_limit(self, response):
+        if response.status_code not in (403, 429):
+            return False
+        if "Retry-After" in response.headers:
+            return True
+        message = response.content.lower()
+        return b"secondary rate limit" in message or b"abuse" in message
+
+    def _backoff(self, attempt):
+        delay = min(MAX_BACKOFF, BACKOFF_BASE * 2**attempt)
+        return delay/2 + random.uniform(0, delay/2) # jitter so that the threads don't all come back at once
+
+    def _slow_down_writes(self):
+        with self._lock:
+            self.write_interval = min(MAX_WRITE_INTERVAL, max(self.write_interval*2, 1.0))
+
+    def _speed_up_writes(self):
+        with self._lock:
+            self.write_interval = max(self.min_write_interval, self.write_interval*0.95)
+
+    def send(self, request, **kwargs):
+        is_query = request.method == "POST" and request.path_url.split("?")[0].endswith(GRAPHQL_PATH)
+        is_write = request.method in WRITE_METHODS and not is_query
+        is_idempotent = request.method in IDEMPOTENT_METHODS or is_query
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            self._wait_for_rate_limit()
+            if is_write:
+                self._pace_write()
+
+            try:
+                response = self.inner.send(request, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                if not is_idempotent or last_attempt:
+                    raise
+                delay = self._backoff(attempt)
+                print("%s on %s %s. Retrying in %.1f seconds." % (type(e).__name__, request.method, request.url, delay))
+            else:
+                if not is_query: # GraphQL has a rate limit of its own
+                    self._record_rate_limit(response)
+                if self._is_primary_rate_limit(response):
+                    delay = max(0, self.rate_limit_reset - time.time()) + 1 if self.rate_limit_reset else self._backoff(attempt)
+                    reason = "Rate limit used up"
+                elif self._is_secondary_rate_limit(response):
+                    self._slow_down_writes()
+                    retry_after = response.headers.get("Retry-After")
+                    delay = float(retry_after) if retry_after else self._backoff(attempt)
+                    reason = "Secondary rate limit hit"
+                elif response.status_code in RETRY_STATUS_CODES and is_idempotent:
+                    delay = self._backoff(attempt)
+                    reason = "Got %d" % response.status_code
+                else:
+                    if is_write and response.status_code < 400:
+                        self._speed_up_writes()
+                    return response
+
+                if last_attempt:
+                    return response
+                response.close()
+                print("%s on %s %s. Retrying in %.1f seconds." % (reason, request.method, request.url, delay))
+
+            with self._lock:
+                self.retries += 1
+            self._sleep(delay)
+
+    def close(self):
+        self.inner.close()
+
+    def reset(self):
+        with self._lock:
+            self.retries = 0
+            self.seconds_waited = 0.0
+
+    def report(self):
+        with self._lock:
+            return "Scheduler: %d retries, %.0f seconds spent waiting on rate limits and write pacing." % (self.retries, self.seconds_waited)
@@ -0,0 +1,201 @@
+"""
+Optional tracing of where the time goes during a run.
+
+When tracing is on, every GitHub API request and every call of a public Goatcabin method becomes a
+span: a name, a start time, a duration, and what it was about (the HTTP method and status, the repo,
+the group of students). Spans nest: an API request made while gift_repos is working on a group knows
+that group. At the end of a run the spans can be written out as Chrome trace-event JSON (open it in
+chrome://tracing or https://ui.perfetto.dev) and summarized as a table of time per endpoint.
+"""
+
+import os
+import re
+import time
+import inspect
+import threading
+import functools
+import contextlib
+import urllib.parse
+from collections import OrderedDict
+try: import simplejson as json
+except ImportError: import json
+
+from requests.adapters import BaseAdapter
+
+from utils import tabulate_github, group_to_str
+
+# for turning a request path into an endpoint like "/repos/:owner/:repo/git/trees/:sha", so that
+# requests for different repos (and different shas, ...) are counted together.
+# the name of a placeholder, for the path segment(s) that follow each of these
+_PLACEHOLDER_AFTER = {
+    "repos" : ":owner/:repo", "orgs" : ":org", "teams" : ":id", "users" : ":user", "members" : ":user",
+    "memberships" : ":user", "collaborators" : ":user", "branches" : ":branch", "trees" : ":sha", "blobs" : ":sha",
+    "commits" : ":sha", "issues" : ":number", "pulls" : ":number", "compare" : ":basehead", "labels" : ":name"
+}
+# after these the whole rest of the path is one placeholder
+_PLACEHOLDER_FOR_REST = {"refs" : ":ref", "contents" : ":path"}
+
+# the args of a span that the spans inside it get too
+INHERITED_ARGS = ("aname", "repo", "group")
+
+
+def endpoint_template(path):
+    segments = [s for s in path.split("/") if s]
+    if segments[:2] == ["api", "v3"]:
+        segments = segments[2:]
+    template = []
+    i = 0
+    while i < len(segments):
+        segment = segments[i]
+        template.append(segment)
+        i += 1
+        if segment in _PLACEHOLDER_FOR_REST and i < len(segments):
+            template.append(_PLACEHOLDER_FOR_REST[segment])
+            break
+        if segment in _PLACEHOLDER_AFTER and i < len(segments):
+            placeholder = _PLACEHOLDER_AFTER[segment]
+            template.append(placeholder)
+            i += placeholder.count("/") + 1
+    return "/" + "/".join(template)
+
+# the name of the repo a request path is about, if any
+def repo_from_path(path):
+    m = re.search(r"/repos/[^/]+/([^/?]+)", path)
+    return urllib.parse.unquote(m.group(1)) if m else None
+
+
+class Tracer(object):
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = [] # finished spans, as Chrome trace "complete" events
+        self._local = threading.local() # per-thread stack of the args of the spans that are open
+        self._thread_names = dict()
+        self._lock = threading.Lock()
+        self._origin = time.time()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    # the innermost value of key among the spans that are open on this thread (e.g. the group being worked on)
+    def context(self, key):
+        for args in reversed(self._stack()):
+            if args.get(key) is not None:
+                return args[key]
+        return None
+
+    # what the spans open on this thread are about, for carrying over to work done on other threads
+    def inherited(self):
+        return {key : self.context(key) for key in INHERITED_ARGS if self.context(key) is not None}
+
+    """ Time the body of the with statement as a span named name, in category category.
+        args (e.g. repo, group) are shown with the span and inherited by the spans inside it. The dict
+        that is yielded can be used to add args once they are known (e.g. the HTTP status). """
+    @contextlib.contextmanager
+    def span(self, name, category="goatcabin", **args):
+        if not self.enabled:
+            yield dict()
+            return
+        args = OrderedDict((key, value) for key, value in args.items() if value is not None)
+        for key, value in self.inherited().items(): # inherit what we are working on from the enclosing spans
+            if key not in args:
+                args[key] = value
+        stack = self._stack()
+        stack.append(args)
+        start_time = time.time()
+        try:
+            yield args
+        except Exception as e:
+            args["error"] = "%s: %s" % (type(e).__name__, e)
+            raise
+        finally:
+            end_time = time.time()
+            stack.pop()
+            thread = threading.current_thread()
+            with self._lock:
+                self._thread_names[thread.ident] = thread.name
+                self.spans.append({
+                    "name" : name, "cat" : category, "ph" : "X", "pid" : os.getpid(), "tid" : thread.ident,
+                    "ts" : int((start_time - self._origin)*1e6), "dur" : int((end_time - start_time)*1e6),
+                    "args" : OrderedDict((key, str(value)) for key, value in args.items())
+                })
+
+    """ Wrap fn (a method of a Goatcabin) so that every call is a span. If the call has arguments
+        called repo, group or aname, they are recorded with the span. """
+    def wrap(self, fn, name):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            try:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+            except TypeError: # let the call itself complain about its arguments
+                bound = dict()
+            repo = bound.get("repo")
+            group = bound.get("group")
+            with self.span(name, repo=getattr(repo, "name", repo), aname=bound.get("aname"),
+                           group=group_to_str(group) if isinstance(group, (tuple, list)) else group):
+                return fn(*args, **kwargs)
+        return traced
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self._origin = time.time()
+
+    def export_chrome_trace(self, filename):
+        with self._lock:
+            events = [{"name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : tid, "args" : {"name" : name}}
+                      for tid, name in self._thread_names.items()]
+            events += sorted(self.spans, key=lambda span: span["ts"])
+        with open(filename, "w") as f:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f)
+
+    """ A table of the API requests by endpoint (how many, how long in total, on average and at most, and how
+        many failed), followed by one of the Goatcabin methods. """
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+
+        def table(category, headers, with_errors):
+            rows = OrderedDict()
+            for span in spans:
+                if span["cat"] != category:
+                    continue
+                row = rows.setdefault(span["name"], [0, 0.0, 0.0, 0])
+                row[0] += 1
+                row[1] += span["dur"]/1e6
+                row[2] = max(row[2], span["dur"]/1e6)
+                status = span["args"].get("status", "")
+                if "error" in span["args"] or (status.isdigit() and int(status) >= 400):
+                    row[3] += 1
+            ordered = sorted(rows.items(), key=lambda item: item[1][1], reverse=True)
+            return tabulate_github([[name, count, "%.2f" % total, "%.0f" % (1000*total/count), "%.0f" % (1000*longest)] + ([errors] if with_errors else [])
+                                    for name, (count, total, longest, errors) in ordered], headers=headers)
+
+        return "API requests by endpoint:\n\n" + \
+            table("api", ["Endpoint", "Requests", "Total (s)", "Mean (ms)", "Max (ms)", "Errors"], True) + \
+            "\n\nGoatcabin methods (times include the methods and requests they call):\n\n" + \
+            table("goatcabin", ["Method", "Calls", "Total (s)", "Mean (ms)", "Max (ms)"], False)
+
+
+# a requests adapter that makes a span out of every request that goes through it
+class TracingAdapter(BaseAdapter):
+
+    def __init__(self, inner, tracer):
+        super(TracingAdapter, self).__init__()
+        self.inner = inner # the adapter that actually talks to the server
+        self.tracer = tracer
+
+    def send(self, request, **kwargs):
+        path = urllib.parse.urlsplit(request.url).path
+        with self.tracer.span("%s %s" % (request.method, endpoint_template(path)), category="api",
+                              method=request.method, repo=repo_from_path(path)) as args:
+            response = self.inner.send(request, **kwargs)
+            args["status"] = response.status_code
+            return response
+
+    def close(self):
+        self.inner.close()
@@ -1,32 +1,49 @@
 from tabulate import tabulate
 import json
 import os
-from collections import OrderedDict
+import hashlib
+from collections import OrderedDict, defaultdict
 
 
 STATUS_FILENAME = "status.json"
+SUBMISSIONS_FILENAME = "submissions.json" # in each assessment's directory of the grades repo
 README = "README.md"
 OVERALL_GRADE_COLUMN_NAME = "Course Grade"
 UPDATES_BRANCH_NAME = "instructor-updates"
 OVERALL_FEEDBACK_STR = "Overall feedback"
 CAP_INDIVIDUAL_ASSESSMENTS_AT_100 = False
 PEER_REVIEW_WEIGHT = 0.15 # peer review should be worth 15% of any assessment that is being reviewed
+SEARCH_RESULTS_LIMIT = 1000 # GitHub only lets us page through this many of the results of a search
+
+# where things that are worth keeping between runs (e.g. file contents downloaded from GitHub) are stored
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".rhomboid")
+
+# if at least this many of the files we want have never been downloaded, download the whole repo as one archive instead
+ARCHIVE_MIN_FILES = 20
 
 COURSE_CONFIG_FILENAME = "course_config.json"
 RUBRIC_CONFIG_FILENAME = os.path.join("rubric", "rubric_config.json")
+# these are read from the current directory, unless the config file says where they are (default-course-config, rubric-config)
 DEFAULT_COURSE_CONFIG_FILENAME = "default_course_config.json"
+DEFAULT_RUBRIC_CONFIG_FILENAME = "rubric_config.json"
+
+_default_course_configs = dict() # path -> what was read from it
 
-if not os.path.isfile(DEFAULT_COURSE_CONFIG_FILENAME):
-    raise Exception("There must be a file named %s in the current directory." % DEFAULT_COURSE_CONFIG_FILENAME)
-else:
-    with open(DEFAULT_COURSE_CONFIG_FILENAME, 'r') as f:
-        DEFAULT_COURSE_CONFIG = json.load(f, object_pairs_hook=OrderedDict)
+# the course config that a new course starts with. only read when it is needed, and then only once
+def load_default_course_config(path=DEFAULT_COURSE_CONFIG_FILENAME):
+    if path not in _default_course_configs:
+        if not os.path.isfile(path):
+            raise Exception("There must be a file named %s in the current directory (or set default-course-config in the config file)." % path)
+        with open(path, 'r') as f:
+            _default_course_configs[path] = json.load(f, object_pairs_hook=OrderedDict)
+    return _default_course_configs[path]
 
-def group_to_pretty_str(group):
-	return ", ".join(map(user_to_str, group))
+# display_name: login -> name or None, e.g. Goatcabin.display_name
+def group_to_pretty_str(group, display_name=None):
+	return ", ".join(user_to_str(login, display_name(login) if display_name else None) for login in group)
 
-def user_to_str(user):
-	return "%s (%s)" % (user.login, user.name) if user.name else user.login
+def user_to_str(login, name=None):
+	return "%s (%s)" % (login, name) if name else login
 
 def validate_weights(weights):
     assert(abs(sum(weights.values()) - 1.0) < 1e-6)
@@ -51,6 +68,37 @@ def get_assessment_repo_name(group, course, assname):
 def get_partners_issue_title(assname):
     return "%s_partner" % assname
 
+""" Put students into groups, given partners (a dict from login to the set of logins that student asked to work with).
+    A group is formed when everyone in it asked for exactly the others in it. Anyone whose request was not
+    reciprocated like that (and anyone who did not ask) works alone. Returns a list of tuples of logins.
+    Each request is checked against the partners it names only, and a union-find puts the groups together,
+    so this is linear in the number of students (for groups of bounded size). """
+def form_groups(logins, partners):
+    parent = {login : login for login in logins}
+    def find(login):
+        while parent[login] != login:
+            parent[login] = parent[parent[login]] # path halving
+            login = parent[login]
+        return login
+
+    for login in sorted(partners):
+        implied_group = partners[login] | {login}
+        for partner in sorted(partners[login]):
+            if partner not in partners: # you request a partner but this person didn't request any partners
+                print("%s requested partners but the partner %s did not request them back" % (login, partner))
+                break
+            if partners[partner] | {partner} != implied_group: # partners disagree on who's in the group
+                print("%s requested partners but they did not reciprocate" % login)
+                break
+        else: # success! everyone in implied_group will agree, so they all end up together
+            for partner in partners[login]:
+                parent[find(partner)] = find(login)
+
+    groups = defaultdict(list)
+    for login in logins:
+        groups[find(login)].append(login)
+    return [tuple(sorted(group)) for group in groups.values()] # tuples in case the groups need to be hashable (as in a key of a dict)
+
 def get_partners_file_name(assname):
     return "%s_partner.md" % assname
     
@@ -60,5 +108,18 @@ def get_student_grades_repo_name(cwl, course):
     else:
         return "%s_grades" % cwl
 
+# whether repo_name is the name get_student_grades_repo_name gives some student's grades repo
+def is_student_grades_repo_name(repo_name, course):
+    if "repo-prefix" in course:
+        return repo_name.startswith("%s_grades_" % course["repo-prefix"]) and repo_name != course.get("grades-repo")
+    else:
+        return repo_name.endswith("_grades")
+
+# the sha that git gives a blob with these contents. lets us tell if a file in a repo has changed without downloading it.
+def git_blob_sha(contents):
+    if not isinstance(contents, bytes):
+        contents = bytes(contents, "UTF-8")
+    return hashlib.sha1(b"blob %d\0" % len(contents) + contents).hexdigest()
+
 def tabulate_github(table, headers):
     return tabulate(table, headers=headers, tablefmt="orgtbl").replace("-+-", "-|-")